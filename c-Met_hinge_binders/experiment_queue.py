@@ -0,0 +1,215 @@
+#!/usr/local/bin/env python
+
+"""
+Directory-based queue of experiments shared by independent workers.
+
+Each worker claims an experiment by taking an exclusive lock (flock) on the
+experiment lock file in the queue directory and holds the lock while the
+experiment runs. The lock is released by the operating system when the
+worker exits, also if it crashes or is killed, so a claim never becomes
+stale and the next worker trying to claim the experiment resumes it.
+Completed experiments are marked with a done file, and experiments raising
+an error with a failed file so that they are not retried by every worker.
+
+The queue directory must be on a file system shared by all workers that
+supports flock (e.g., a local disk or NFS with locking enabled). The lock
+files are never removed while the workers run since a worker waiting on
+a removed file would hold a lock that nobody else sees.
+
+"""
+
+# =============================================================================================
+# GLOBAL IMPORTS
+# =============================================================================================
+
+import contextlib
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+
+
+# ==============================================================================
+# EXPERIMENT QUEUE
+# ==============================================================================
+
+class ExperimentQueue(object):
+    """Claim and complete experiments through files in a shared directory.
+
+    Parameters
+    ----------
+    queue_dir_path : str
+        The directory holding the lock and done files. It is created if it
+        doesn't exist.
+    check_interval : float, optional
+        The seconds between two checks that the lock file of a running
+        experiment has not been removed (default is 60). This is also the
+        time the workers wait before polling claimed experiments again.
+
+    Examples
+    --------
+    >>> queue = ExperimentQueue('queue')  # doctest: +SKIP
+    >>> with queue.claim('experiment-0') as lost:  # doctest: +SKIP
+    ...     if lost is not None:
+    ...         queue.mark_done('experiment-0')
+
+    """
+
+    LOCK_SUFFIX = '.lock'
+    DONE_SUFFIX = '.done'
+    FAILED_SUFFIX = '.failed'
+    SETUP_LOCK_FILE_NAME = 'setup.flock'
+
+    def __init__(self, queue_dir_path, check_interval=60.0):
+        self.queue_dir_path = os.path.abspath(queue_dir_path)
+        self.check_interval = check_interval
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        os.makedirs(self.queue_dir_path, exist_ok=True)
+
+    @staticmethod
+    def get_experiment_name(experiment_path):
+        """Convert an experiment path to a file name."""
+        return experiment_path.strip(os.sep).replace(os.sep, '--') or 'experiment'
+
+    def _get_file_path(self, experiment_name, suffix):
+        return os.path.join(self.queue_dir_path, experiment_name + suffix)
+
+    def is_done(self, experiment_name):
+        """True if the experiment has been completed."""
+        return os.path.exists(self._get_file_path(experiment_name, self.DONE_SUFFIX))
+
+    def is_failed(self, experiment_name):
+        """True if the experiment raised an error in a worker."""
+        return os.path.exists(self._get_file_path(experiment_name, self.FAILED_SUFFIX))
+
+    def is_finished(self, experiment_name):
+        """True if the experiment has been completed or has failed."""
+        return self.is_done(experiment_name) or self.is_failed(experiment_name)
+
+    def is_claimable(self, experiment_name):
+        """True if the experiment is not finished and not claimed by a live worker."""
+        if self.is_finished(experiment_name):
+            return False
+        lock_file = self._try_lock(experiment_name)
+        if lock_file is None:
+            return False
+        lock_file.close()
+        return True
+
+    def mark_done(self, experiment_name):
+        """Mark the experiment as completed."""
+        with open(self._get_file_path(experiment_name, self.DONE_SUFFIX), 'w') as f:
+            f.write(self.worker_id + '\n')
+
+    def mark_failed(self, experiment_name, message):
+        """Mark the experiment as failed so that the other workers do not retry it.
+
+        Remove the .failed file to put the experiment back in the queue.
+        """
+        with open(self._get_file_path(experiment_name, self.FAILED_SUFFIX), 'w') as f:
+            f.write(self.worker_id + '\n' + message)
+
+    def get_owner(self, experiment_name):
+        """Return the id of the worker holding the lock of the experiment or None if it is not claimed."""
+        try:
+            with open(self._get_file_path(experiment_name, self.LOCK_SUFFIX), 'r') as f:
+                return json.load(f)['worker']
+        except (FileNotFoundError, ValueError, KeyError):
+            # The lock of an experiment that is not running is empty.
+            return None
+
+    def _try_lock(self, experiment_name):
+        """Return the open lock file if this worker could lock it, None otherwise."""
+        lock_file = open(self._get_file_path(experiment_name, self.LOCK_SUFFIX), 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def _is_lock_removed(lock_file):
+        """True if the file locked through lock_file has been removed or replaced."""
+        try:
+            return os.stat(lock_file.name).st_ino != os.fstat(lock_file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    @contextlib.contextmanager
+    def setup_lock(self):
+        """Context manager serializing a block of code (e.g., the system setup) among the workers.
+
+        The lock is released automatically by the operating system if the
+        worker dies, so it never becomes stale.
+
+        """
+        with open(os.path.join(self.queue_dir_path, self.SETUP_LOCK_FILE_NAME), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def claim(self, experiment_name, on_lost=None):
+        """Context manager claiming an experiment and holding its lock until the block exits.
+
+        Parameters
+        ----------
+        experiment_name : str
+            The name of the experiment (see get_experiment_name).
+        on_lost : callable, optional
+            Called without arguments from a background thread if the lock
+            file is removed while the block runs (e.g., the queue directory
+            is reset by hand). It should stop the block promptly.
+
+        Yields
+        ------
+        lost : threading.Event or None
+            None if the experiment is finished or claimed by another worker.
+            Otherwise, an event set if the lock file is removed, in which
+            case another worker can claim the experiment and the block must
+            stop working on it as soon as possible.
+
+        """
+        if self.is_finished(experiment_name):
+            yield None
+            return
+        lock_file = self._try_lock(experiment_name)
+        if lock_file is None:
+            yield None
+            return
+
+        with lock_file:
+            # The experiment may have been finished between the
+            # check and the claim by the worker that just released it.
+            if self.is_finished(experiment_name):
+                yield None
+                return
+            lock_file.truncate(0)
+            json.dump({'worker': self.worker_id, 'claimed': time.time()}, lock_file)
+            lock_file.flush()
+
+            lost = threading.Event()
+            stop_event = threading.Event()
+            def check_lock():
+                while not stop_event.wait(self.check_interval):
+                    if self._is_lock_removed(lock_file):
+                        print('WARNING: the lock of experiment {} has been removed'.format(experiment_name))
+                        lost.set()
+                        if on_lost is not None:
+                            on_lost()
+                        return
+            check_thread = threading.Thread(target=check_lock, daemon=True)
+            check_thread.start()
+            try:
+                yield lost
+            finally:
+                stop_event.set()
+                check_thread.join()
+                # Leave the file in place (see module docstring).
+                lock_file.truncate(0)
+                lock_file.flush()
@@ -3,24 +3,142 @@
 """
 Generate protocol for RMSD-based annihilation
 
+Without arguments, the uniform protocol is printed. With --pilot, the states
+are redistributed along the same path so that they are equally spaced in
+thermodynamic length, using the reduced potentials stored in the NetCDF file
+of a short pilot simulation run with the uniform protocol, and the smallest
+number of states whose predicted overlap between neighbors is above
+--target-overlap is printed as a YAML alchemical_path block.
+
 """
 
-import numpy as np
+import argparse
+import math
 from collections import OrderedDict
 
+import numpy as np
+
 nelectrostatics = 80
 nsterics = 80
 nrestraints = 20
 
-lambdas = OrderedDict()
-lambdas['lambda_restraints'] = np.append(np.append(np.linspace(0.0, 0.5, nelectrostatics), np.linspace(0.5, 0.5, nsterics)), np.linspace(0.5, 1.0, nrestraints+1))
-lambdas['lambda_electrostatics'] = np.append(np.append(np.linspace(1.0, 0.0, nelectrostatics), np.linspace(0.0, 0.0, nsterics)), np.linspace(0.0, 0.0, nrestraints+1))
-lambdas['lambda_sterics'] = np.append(np.append(np.linspace(1.0, 1.0, nelectrostatics), np.linspace(1.0, 0.0, nsterics)), np.linspace(0.0, 0.0, nrestraints+1))
-
-for name in lambdas:
-    s = '%32s: [' % name
-    for i, val in enumerate(lambdas[name]):
-        if i > 0: s += ', '
-        s += '%5.3f' % val
-    s += ']'
-    print(s)
+
+def uniform_protocol(nelectrostatics=nelectrostatics, nsterics=nsterics, nrestraints=nrestraints):
+    lambdas = OrderedDict()
+    lambdas['lambda_restraints'] = np.append(np.append(np.linspace(0.0, 0.5, nelectrostatics), np.linspace(0.5, 0.5, nsterics)), np.linspace(0.5, 1.0, nrestraints+1))
+    lambdas['lambda_electrostatics'] = np.append(np.append(np.linspace(1.0, 0.0, nelectrostatics), np.linspace(0.0, 0.0, nsterics)), np.linspace(0.0, 0.0, nrestraints+1))
+    lambdas['lambda_sterics'] = np.append(np.append(np.linspace(1.0, 1.0, nelectrostatics), np.linspace(1.0, 0.0, nsterics)), np.linspace(0.0, 0.0, nrestraints+1))
+    return lambdas
+
+
+def read_pilot_energies(nc_file_path, n_discarded=1):
+    """Read the reduced potentials and the sampled states of a YANK NetCDF file.
+
+    Returns the energies u[iteration, replica, state] and the state of each
+    replica states[iteration, replica] after discarding the first iterations.
+    """
+    import netCDF4
+    ncfile = netCDF4.Dataset(nc_file_path, 'r')
+    try:
+        energies = np.array(ncfile.variables['energies'][n_discarded:])
+        states = np.array(ncfile.variables['states'][n_discarded:])
+    finally:
+        ncfile.close()
+    return energies, states
+
+
+def neighbor_distances(energies, states):
+    """Estimate the thermodynamic length between each pair of neighbor states.
+
+    The distance between states i and i+1 is the standard deviation of the
+    reduced potential difference u_{i+1} - u_i, averaged over the samples
+    collected in state i and in state i+1.
+    """
+    n_states = energies.shape[2]
+    distances = np.zeros(n_states - 1)
+    for i in range(n_states - 1):
+        stds = []
+        for k in (i, i+1):
+            du = (energies[:, :, i+1] - energies[:, :, i])[states == k]
+            if len(du) > 1:
+                stds.append(du.std(ddof=1))
+        if len(stds) == 0:
+            raise ValueError('States {} and {} were not sampled by the pilot simulation.'.format(i, i+1))
+        distances[i] = np.mean(stds)
+    return distances
+
+
+def overlap(distance):
+    """Predicted overlap of two states at a thermodynamic distance assuming Gaussian energy differences."""
+    return math.erfc(distance / (2 * math.sqrt(2)))
+
+
+def max_distance(target_overlap):
+    """Invert overlap() by bisection."""
+    low, high = 0.0, 100.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if overlap(middle) > target_overlap:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def optimize_protocol(lambdas, distances, target_overlap):
+    """Redistribute the states along the path at equal thermodynamic length.
+
+    The path is the piecewise linear interpolation of the pilot states, so
+    the new states only interpolate between neighbor pilot states.
+    """
+    length = np.append(0.0, np.cumsum(distances))
+    n_intervals = max(1, int(math.ceil(length[-1] / max_distance(target_overlap))))
+    new_length = np.linspace(0.0, length[-1], n_intervals + 1)
+    new_lambdas = OrderedDict()
+    for name, values in lambdas.items():
+        new_lambdas[name] = np.interp(new_length, length, values)
+    return new_lambdas, length[-1] / n_intervals
+
+
+def format_lambdas(lambdas):
+    lines = []
+    for name in lambdas:
+        s = '%32s: [' % name
+        for i, val in enumerate(lambdas[name]):
+            if i > 0: s += ', '
+            s += '%5.3f' % val
+        s += ']'
+        lines.append(s)
+    return '\n'.join(lines)
+
+
+def format_alchemical_path(lambdas, indent=6):
+    lines = [' '*indent + 'alchemical_path:']
+    for name, values in lambdas.items():
+        lines.append(' '*(indent + 2) + '{}: [{}]'.format(name, ', '.join('%.3f' % val for val in values)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the protocol for RMSD-based annihilation.')
+    parser.add_argument('--pilot', dest='nc_file_path', default=None,
+                        help='NetCDF file of a pilot simulation run with the uniform protocol.')
+    parser.add_argument('--target-overlap', type=float, dest='target_overlap', default=0.3,
+                        help='Minimum predicted overlap between neighbor states (default is 0.3).')
+    parser.add_argument('--discard', type=int, dest='n_discarded', default=1,
+                        help='Number of initial pilot iterations to discard (default is 1).')
+    args = parser.parse_args()
+
+    lambdas = uniform_protocol()
+    if args.nc_file_path is None:
+        print(format_lambdas(lambdas))
+    else:
+        energies, states = read_pilot_energies(args.nc_file_path, args.n_discarded)
+        n_states = len(lambdas['lambda_sterics'])
+        if energies.shape[2] != n_states:
+            parser.error('The pilot has {} states, but the uniform protocol has {}.'.format(energies.shape[2], n_states))
+        distances = neighbor_distances(energies, states)
+        new_lambdas, distance = optimize_protocol(lambdas, distances, args.target_overlap)
+        print('# {} states (pilot {}), thermodynamic length {:.1f}, predicted neighbor overlap {:.2f}'.format(
+            len(new_lambdas['lambda_sterics']), n_states, distances.sum(), overlap(distance)))
+        print(format_alchemical_path(new_lambdas))
@@ -1,6 +1,9 @@
 """
 List the residues near the binding pocket
 """
+import os
+import sys
+
 import numpy as np
 import mdtraj as md
 
@@ -26,3 +29,15 @@ assert np.array_equal(id_select, index_select)
 print("Residue Indices: {}".format(indices))
 print("Residue Indices Select:\n"
       "{}".format(residue_index_md_select))
+
+# Select the same heavy atoms directly with the atom indices
+# rather than through a selection string with a term per residue.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+from pocket import read_pdb_atoms, select_residue_atoms
+atoms = read_pdb_atoms('met_4r1y_mae_prot.pdb')
+_, first_atoms = np.unique(atoms.residue_index, return_index=True)
+residues = atoms[first_atoms][np.isin(atoms.resseq[first_atoms], pocket)]
+_, atom_indices = select_residue_atoms(atoms, residues.chain, residues.resseq, residues.resname)
+assert np.array_equal(id_select, atom_indices)
+print("Pocket Atom Indices:\n"
+      "{}".format(atom_indices.tolist()))
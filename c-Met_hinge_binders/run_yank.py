@@ -20,13 +20,162 @@ The script assumes
 # GLOBAL IMPORTS
 # =============================================================================================
 
+import _thread
 import copy
-
+import glob
+import heapq
+import json
+import os
+import time
+import traceback
+
+import numpy as np
 from simtk import openmm, unit
 
+from yank import analyze, mpi, utils
 from yank.experiment import AlchemicalPhaseFactory, ExperimentBuilder
 from yank.restraints import RMSD
 
+from experiment_queue import ExperimentQueue
+
+
+# ==============================================================================
+# EXPERIMENT COST MODEL
+# ==============================================================================
+
+# Number of TIP3P water molecules per cubic angstrom at 300 K.
+WATER_DENSITY = 0.0334
+
+# Estimated number of states of the protocols that are not given explicitly (e.g., 'auto').
+DEFAULT_N_STATES = 100
+
+# Defaults of YANK when the YAML script doesn't specify them.
+DEFAULT_N_STEPS = 500
+DEFAULT_N_ITERATIONS = 1
+
+
+def _read_file_coords(file_path):
+    """Return the coordinates of all the molecules in a PDB, mol2, or SDF file in angstroms.
+
+    The file is read in a single pass. A PDB file is a single molecule.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    molecules_coords = [[]]
+    with open(file_path, 'r') as f:
+        if extension == '.pdb':
+            molecules_coords[0] = [[float(line[30:38]), float(line[38:46]), float(line[46:54])]
+                                   for line in f if line.startswith(('ATOM  ', 'HETATM'))]
+        elif extension == '.mol2':
+            molecules_coords, in_atoms = [], False
+            for line in f:
+                if line.startswith('@<TRIPOS>'):
+                    if line.startswith('@<TRIPOS>MOLECULE'):
+                        molecules_coords.append([])
+                    in_atoms = line.startswith('@<TRIPOS>ATOM') and len(molecules_coords) > 0
+                elif in_atoms and line.strip():
+                    molecules_coords[-1].append([float(x) for x in line.split()[2:5]])
+        elif extension in ('.sdf', '.sd', '.mol'):
+            line_in_record, n_atoms = 0, 0
+            for line in f:
+                line_in_record += 1
+                if line.startswith('$$$$'):
+                    molecules_coords.append([])
+                    line_in_record = 0
+                elif line_in_record == 4:
+                    n_atoms = int(line[0:3])
+                elif 4 < line_in_record <= 4 + n_atoms:
+                    molecules_coords[-1].append([float(line[0:10]), float(line[10:20]), float(line[20:30])])
+            # Drop the empty record after the last $$$$.
+            if len(molecules_coords) > 1 and len(molecules_coords[-1]) == 0:
+                molecules_coords.pop()
+    return [np.array(coords).reshape(-1, 3) for coords in molecules_coords]
+
+
+def estimate_n_atoms(solute_coords, solvent):
+    """Estimate the number of atoms of a phase from the solute coordinates.
+
+    The number of water molecules of explicit solvents is estimated from the
+    volume of the box determined by the solute extent and the clearance.
+    """
+    n_atoms = len(solute_coords)
+    clearance = solvent.get('clearance', None)
+    if clearance is not None and len(solute_coords) > 0:
+        if isinstance(clearance, str):
+            clearance = utils.quantity_from_string(clearance)
+        clearance = clearance.value_in_unit(unit.angstroms)
+        box_edges = solute_coords.max(axis=0) - solute_coords.min(axis=0) + 2*clearance
+        n_atoms += int(3 * WATER_DENSITY * np.prod(box_edges))
+    return n_atoms
+
+
+# ==============================================================================
+# CONVERGENCE
+# ==============================================================================
+
+def estimate_free_energy(experiment_dir_path):
+    """Estimate the binding free energy of a running experiment from the stored energies.
+
+    The free energy is computed with MBAR from the reduced potentials in the
+    phase NetCDF files without the standard state correction, which is a
+    constant that does not affect the convergence.
+
+    Parameters
+    ----------
+    experiment_dir_path : str
+        The directory with the NetCDF files of the complex and solvent phases.
+
+    Returns
+    -------
+    free_energy : float or None
+        The binding free energy in kT, or None if the phases are not stored yet.
+    uncertainty : float or None
+        The standard deviation of the estimate in kT.
+
+    """
+    nc_file_paths = [file_path for file_path in sorted(glob.glob(os.path.join(experiment_dir_path, '*.nc')))
+                     if not file_path.endswith('_checkpoint.nc')]
+    if len(nc_file_paths) < 2:
+        return None, None
+
+    free_energy, variance = 0.0, 0.0
+    for nc_file_path in nc_file_paths:
+        phase_analyzer = analyze.get_analyzer(nc_file_path)
+        try:
+            Deltaf_ij, dDeltaf_ij = phase_analyzer.get_free_energy()
+        finally:
+            phase_analyzer.reporter.close()
+        # The free energy of decoupling the ligand enters with opposite signs in the two phases.
+        sign = -1 if 'complex' in os.path.basename(nc_file_path) else 1
+        free_energy += sign * Deltaf_ij[0, -1]
+        variance += dDeltaf_ij[0, -1]**2
+    return free_energy, np.sqrt(variance)
+
+
+def is_converged(estimates, target_uncertainty=None, plateau_tolerance=None, plateau_window=5):
+    """Check the stopping rule on the history of the free energy estimates.
+
+    Parameters
+    ----------
+    estimates : list of (float, float)
+        The free energy and uncertainty estimates in kcal/mol in the order
+        in which they were computed.
+    target_uncertainty : float, optional
+        Stop when the uncertainty of the last estimate is below this value.
+    plateau_tolerance : float, optional
+        Stop when the last plateau_window estimates span less than this value.
+    plateau_window : int, optional
+        The number of estimates used to detect a plateau (default is 5).
+
+    """
+    if len(estimates) == 0:
+        return False
+    if target_uncertainty is not None and estimates[-1][1] < target_uncertainty:
+        return True
+    if plateau_tolerance is not None and len(estimates) >= plateau_window:
+        free_energies = [free_energy for free_energy, _ in estimates[-plateau_window:]]
+        return max(free_energies) - min(free_energies) < plateau_tolerance
+    return False
+
 
 # ==============================================================================
 # SUPPORTING CLASS
@@ -71,6 +220,7 @@ class TwoRestraintsPhaseFactory(AlchemicalPhaseFactory):
         alchemical_phase = super(TwoRestraintsPhaseFactory, self).initialize_alchemical_phase()
 
         # Skip fully interacting state minimization and minimize replicas.
+        # The sampler already distributes the replicas among the MPI processes.
         if minimize:
             tolerance = self.options['minimize_tolerance']
             max_iterations = self.options['minimize_max_iterations']
@@ -111,13 +261,329 @@ class TwoRestraintsPhaseFactory(AlchemicalPhaseFactory):
 
 
 class TwoRestraintsBuilder(ExperimentBuilder):
-    """Experiment builder using TwoRestraintsPhaseFactory instead of AlchemicalPhaseFactory."""
+    """Experiment builder using TwoRestraintsPhaseFactory instead of AlchemicalPhaseFactory.
+
+    Parameters
+    ----------
+    partition : str, optional
+        How the experiments are split among jobs when job_id and n_jobs are
+        given. 'round-robin' uses the YANK assignment. 'cost' (default)
+        estimates the cost of each experiment (see estimate_experiment_cost)
+        and assigns the experiments with the longest-processing-time-first
+        rule: in order of decreasing cost, each experiment goes to the job
+        with the lowest total cost so far. If a molecule is not read from a
+        file (e.g., it is defined by SMILES), the cost cannot be estimated
+        and the round-robin assignment is used.
+    queue_dir_path : str, optional
+        If given, job_id and n_jobs are ignored, and the experiments are
+        claimed one at a time from an ExperimentQueue in this directory
+        shared by independent workers, which run until all experiments are
+        completed. The workers resume each other's experiments, so the YAML
+        script must set resume_setup and resume_simulation.
+    target_uncertainty : float, optional
+        If given, an experiment is stopped before number_of_iterations when
+        the uncertainty of its binding free energy falls below this value in
+        kcal/mol. The free energy is estimated every time the experiment is
+        paused, so this requires a switch_experiment_interval option.
+    plateau_tolerance : float, optional
+        If given, an experiment is also stopped when its last plateau_window
+        free energy estimates span less than this value in kcal/mol.
+    plateau_window : int, optional
+        The number of estimates used to detect a plateau (default is 5).
+
+    """
+
+    CONVERGENCE_FILE_NAME = 'convergence.json'
+
+    def __init__(self, *args, partition='cost', queue_dir_path=None, target_uncertainty=None,
+                 plateau_tolerance=None, plateau_window=5, **kwargs):
+        if partition not in ('round-robin', 'cost'):
+            raise ValueError('Unknown partition scheme {}'.format(partition))
+        self._partition = partition
+        self._stopping_rule = dict(target_uncertainty=target_uncertainty, plateau_tolerance=plateau_tolerance,
+                                   plateau_window=plateau_window)
+        self._file_coords = {}
+        self._cost_partition = None
+        if queue_dir_path is None:
+            self._queue = None
+        else:
+            mpicomm = mpi.get_mpicomm()
+            if mpicomm is not None and mpicomm.size > 1:
+                raise ValueError('The queue mode requires independent single-process workers.')
+            self._queue = ExperimentQueue(queue_dir_path)
+        self._queue_experiment_names = []
+        super(TwoRestraintsBuilder, self).__init__(*args, **kwargs)
+
+    def _expand_experiments(self):
+        """Override parent method to assign the experiments to the jobs by cost."""
+        if self._queue is not None:
+            # Each worker tries all the experiments.
+            job_id, self._job_id = self._job_id, None
+            try:
+                experiments = list(super(TwoRestraintsBuilder, self)._expand_experiments())
+            finally:
+                self._job_id = job_id
+            self._queue_experiment_names = [ExperimentQueue.get_experiment_name(experiment_path)
+                                            for experiment_path, _ in experiments]
+            for experiment in experiments:
+                yield experiment
+            return
+
+        if self._partition == 'round-robin' or self._job_id is None:
+            for experiment in super(TwoRestraintsBuilder, self)._expand_experiments():
+                yield experiment
+            return
+
+        # The experiments are expanded again at every switch between them,
+        # so the partition is computed and printed only the first time.
+        if self._cost_partition is None:
+            job_id, self._job_id = self._job_id, None
+            try:
+                experiments = list(super(TwoRestraintsBuilder, self)._expand_experiments())
+            finally:
+                self._job_id = job_id
+
+            costs = [self.estimate_experiment_cost(experiment) for _, experiment in experiments]
+            if None in costs:
+                mpi.run_single_node(0, print, 'WARNING: cannot estimate the cost of experiments with molecules '
+                                    'not read from a file. Falling back to the round-robin partition.')
+                self._partition = 'round-robin'
+                for experiment in super(TwoRestraintsBuilder, self)._expand_experiments():
+                    yield experiment
+                return
+            assignments, job_costs = self.partition_experiments(costs, self._n_jobs)
+            mpi.run_single_node(0, self._print_partition, experiments, costs, assignments, job_costs)
+            self._cost_partition = experiments, assignments
+
+        experiments, assignments = self._cost_partition
+        for (experiment_path, experiment), assigned_job in zip(experiments, assignments):
+            if assigned_job == self._job_id - 1:
+                yield experiment_path, copy.deepcopy(experiment)
+
+    @staticmethod
+    def partition_experiments(costs, n_jobs):
+        """Assign the experiments to jobs with the longest-processing-time-first rule.
+
+        Parameters
+        ----------
+        costs : list of float
+            The estimated cost of each experiment.
+        n_jobs : int
+            The number of jobs.
+
+        Returns
+        -------
+        assignments : list of int
+            The 0-based job index of each experiment.
+        job_costs : list of float
+            The total estimated cost of each job.
+
+        """
+        assignments = [None] * len(costs)
+        job_heap = [(0.0, job_idx) for job_idx in range(n_jobs)]
+        # Ties are broken by experiment order so that all jobs compute the same partition.
+        for experiment_idx in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+            job_cost, job_idx = heapq.heappop(job_heap)
+            assignments[experiment_idx] = job_idx
+            heapq.heappush(job_heap, (job_cost + costs[experiment_idx], job_idx))
+        job_costs = [0.0] * n_jobs
+        for job_cost, job_idx in job_heap:
+            job_costs[job_idx] = job_cost
+        return assignments, job_costs
+
+    def estimate_experiment_cost(self, experiment):
+        """Estimate the relative cost of an experiment.
+
+        The cost is the sum over the phases of the number of atoms times the
+        number of states, MCMC steps per iteration, and iterations.
+
+        Parameters
+        ----------
+        experiment : dict
+            The experiment description (see _expand_experiments).
+
+        Returns
+        -------
+        cost : float or None
+            The cost in units of atoms * MD steps, or None if the size of a
+            molecule is unknown because it is not read from a file (e.g.,
+            it is defined by SMILES or name).
+
+        """
+        system = self._db.systems[experiment['system']]
+        protocol = self._protocols[experiment['protocol']]
+        sampler = self._samplers.get(experiment.get('sampler', None), {})
+        options = self._get_experiment_options(experiment)
+
+        # Number of iterations and MD steps per iteration.
+        n_iterations = sampler.get('number_of_iterations', options.get('default_number_of_iterations',
+                                                                       DEFAULT_N_ITERATIONS))
+        if n_iterations is None or n_iterations == float('inf'):
+            n_iterations = DEFAULT_N_ITERATIONS
+        mcmc_move = self._mcmc_moves.get(sampler.get('mcmc_moves', None), {})
+        n_steps = mcmc_move.get('n_steps', DEFAULT_N_STEPS)
+
+        # The complex phase contains receptor and ligand, the solvent phase only the ligand.
+        ligand_coords = self._get_solute_coords(system.get('ligand', system.get('solute', None)))
+        receptor_coords = self._get_solute_coords(system.get('receptor', None))
+        if ligand_coords is None or receptor_coords is None:
+            return None
+
+        cost = 0.0
+        for phase_name in protocol:
+            if 'complex' in phase_name:
+                coords = np.concatenate([receptor_coords, ligand_coords])
+                solvent_id = system.get('solvent1', system.get('solvent', None))
+            else:
+                coords = ligand_coords
+                solvent_id = system.get('solvent2', system.get('solvent', None))
+            alchemical_path = protocol[phase_name].get('alchemical_path', None)
+            if isinstance(alchemical_path, dict):
+                n_states = len(next(iter(alchemical_path.values())))
+            else:
+                n_states = DEFAULT_N_STATES
+            solvent = self._db.solvents.get(solvent_id, {})
+            cost += estimate_n_atoms(coords, solvent) * n_states * n_steps * n_iterations
+        return float(cost)
+
+    def _get_experiment_options(self, experiment):
+        """Return the general options updated with the options of the experiment description."""
+        options = dict(self._options)
+        options.update(experiment.get('options', {}))
+        return options
+
+    def _get_solute_coords(self, molecule_id):
+        """Return the coordinates of a molecule of the YAML script or None if it has no file.
+
+        Each file is read once, and the coordinates of all its molecules are cached.
+        """
+        if molecule_id is None:
+            return np.zeros((0, 3))
+        molecule = self._db.molecules[molecule_id]
+        file_path = molecule.get('filepath', None)
+        if file_path is None:
+            return None
+        if file_path not in self._file_coords:
+            self._file_coords[file_path] = _read_file_coords(file_path)
+        molecules_coords = self._file_coords[file_path]
+        select = molecule.get('select', None)
+        molecule_index = select if isinstance(select, int) and len(molecules_coords) > 1 else 0
+        if molecule_index < len(molecules_coords):
+            return molecules_coords[molecule_index]
+        return np.zeros((0, 3))
+
+    def _print_partition(self, experiments, costs, assignments, job_costs):
+        """Print the experiments assigned to each job and the predicted makespan."""
+        total_cost = sum(costs)
+        print('Cost-based partition of {} experiments among {} jobs:'.format(len(experiments), len(job_costs)))
+        for job_idx, job_cost in enumerate(job_costs):
+            experiment_paths = [experiment_path for (experiment_path, _), assigned_job
+                                in zip(experiments, assignments) if assigned_job == job_idx]
+            print('  job {}: {} experiments, predicted cost {:.3g} ({:.1%}): {}'.format(
+                job_idx + 1, len(experiment_paths), job_cost,
+                job_cost / total_cost if total_cost > 0 else 0.0, ', '.join(experiment_paths)))
+        mean_cost = total_cost / len(job_costs)
+        print('Predicted makespan {:.3g} ({:.2f}x the mean job cost)'.format(
+            max(job_costs), max(job_costs) / mean_cost if mean_cost > 0 else 1.0))
+
+    def _run_experiment(self, experiment):
+        """Override parent method to run only the experiments claimed from the queue.
+
+        Returns True if the experiment has been completed or has failed in any worker.
+        An experiment raising an error is marked as failed in the queue.
+        """
+        if self._queue is None:
+            return self._run_until_converged(experiment)
+
+        experiment_name = ExperimentQueue.get_experiment_name(experiment[0])
+        if self._queue.is_finished(experiment_name):
+            return True
+        # If the lock is lost, another worker can claim the experiment so we
+        # interrupt the simulation rather than waiting for the end of the segment.
+        with self._queue.claim(experiment_name, on_lost=_thread.interrupt_main) as lost:
+            if lost is not None:
+                try:
+                    if lost.is_set():
+                        raise KeyboardInterrupt()
+                    completed = self._run_until_converged(experiment)
+                except KeyboardInterrupt:
+                    if not lost.is_set():
+                        raise
+                    print('Stopping experiment {}: its lock has been lost'.format(experiment[0]))
+                    return False
+                except Exception:
+                    # Don't let the other workers crash on the same experiment.
+                    print('Experiment {} failed'.format(experiment[0]))
+                    self._queue.mark_failed(experiment_name, traceback.format_exc())
+                    return True
+                if lost.is_set():
+                    print('Stopping experiment {}: its lock has been lost'.format(experiment[0]))
+                    return False
+                if completed:
+                    self._queue.mark_done(experiment_name)
+                return completed
+
+        # The experiment is running in another worker. Wait before
+        # polling again if there is nothing else left to claim.
+        if not any(self._queue.is_claimable(name) for name in self._queue_experiment_names):
+            time.sleep(self._queue.check_interval)
+        return False
+
+    def _run_until_converged(self, experiment):
+        """Run the experiment for switch_experiment_interval iterations and check the stopping rule.
+
+        Returns True if the experiment has been completed or has converged.
+        """
+        if self._stopping_rule['target_uncertainty'] is None and self._stopping_rule['plateau_tolerance'] is None:
+            return super(TwoRestraintsBuilder, self)._run_experiment(experiment)
+
+        # The estimates are stored in the experiment directory to survive restarts.
+        experiment_dir_path = self._get_experiment_dir(experiment[0])
+        convergence_file_path = os.path.join(experiment_dir_path, self.CONVERGENCE_FILE_NAME)
+        try:
+            with open(convergence_file_path, 'r') as f:
+                convergence = json.load(f)
+        except (IOError, ValueError):
+            # Missing or corrupted by a worker killed while writing it.
+            convergence = {'converged': False, 'estimates': []}
+        if convergence['converged']:
+            return True
+
+        completed = super(TwoRestraintsBuilder, self)._run_experiment(experiment)
+        if completed:
+            return True
+
+        # Estimate the free energy on a single MPI process.
+        free_energy, uncertainty = mpi.run_single_node(0, estimate_free_energy, experiment_dir_path,
+                                                       broadcast_result=True)
+        if free_energy is None:
+            return False
+        temperature = self._get_experiment_options(experiment[1])['temperature']
+        if isinstance(temperature, str):
+            temperature = utils.quantity_from_string(temperature)
+        kT = (unit.MOLAR_GAS_CONSTANT_R * temperature).value_in_unit(unit.kilocalories_per_mole)
+        convergence['estimates'].append([free_energy * kT, uncertainty * kT])
+        convergence['converged'] = is_converged(convergence['estimates'], **self._stopping_rule)
+        if convergence['converged']:
+            print('Stopping experiment {}: uncorrected DeltaG = {:.2f} +- {:.2f} kcal/mol '
+                  '(without standard state and restraint corrections)'.format(
+                      experiment[0], *convergence['estimates'][-1]))
+
+        def write_convergence():
+            # Write atomically so that a killed worker doesn't leave a truncated file.
+            tmp_file_path = convergence_file_path + '.tmp'
+            with open(tmp_file_path, 'w') as f:
+                json.dump(convergence, f)
+            os.replace(tmp_file_path, convergence_file_path)
+        mpi.run_single_node(0, write_convergence)
+        return convergence['converged']
 
     def _build_experiment(self, *args, **kwargs):
         """Prepare a single experiment.
 
         Override parent method to build an experiment composed of two
         TwoRestraintsPhaseFactories instead of AlchemicalPhaseFactories.
+        In queue mode, the workers set up the systems one at a time.
 
         Returns
         -------
@@ -125,7 +591,11 @@ class TwoRestraintsBuilder(ExperimentBuilder):
             A Experiment object.
 
         """
-        experiment = super(TwoRestraintsBuilder, self)._build_experiment(*args, **kwargs)
+        if self._queue is None:
+            experiment = super(TwoRestraintsBuilder, self)._build_experiment(*args, **kwargs)
+        else:
+            with self._queue.setup_lock():
+                experiment = super(TwoRestraintsBuilder, self)._build_experiment(*args, **kwargs)
         # Convert AlchemicalPhaseFactories to TwoRestraintsPhaseFactories.
         for phase_idx, phase in enumerate(experiment.phases):
             # Check if we're resuming or not before converting.
@@ -138,8 +608,9 @@ class TwoRestraintsBuilder(ExperimentBuilder):
 # MAIN
 # ==============================================================================
 
-def main(yaml_script_path, job_id, n_jobs):
-    experiment_builder = TwoRestraintsBuilder(yaml_script_path, job_id, n_jobs)
+def main(yaml_script_path, job_id, n_jobs, partition='cost', queue_dir_path=None, **stopping_rule):
+    experiment_builder = TwoRestraintsBuilder(yaml_script_path, job_id, n_jobs, partition=partition,
+                                              queue_dir_path=queue_dir_path, **stopping_rule)
     experiment_builder.run_experiments()
 
 
@@ -150,6 +621,23 @@ if __name__ == '__main__':
                         help='Path to the YAML script specifying options and/or how to set up and run the experiment.')
     parser.add_argument('--jobid', type=int, dest='job_id', default=None, help='Identifier for the job: 1 <= jobid <= njobs.')
     parser.add_argument('--njobs', type=int, dest='n_jobs', default=None, help='Total number of parallel executions.')
+    parser.add_argument('--partition', choices=['cost', 'round-robin'], default='cost',
+                        help='How experiments are split among the jobs: by estimated cost (default) or round-robin.')
+    parser.add_argument('--queue', type=str, dest='queue_dir_path', default=None,
+                        help='Claim the experiments from a queue in this directory shared by independent workers '
+                             'instead of using --jobid/--njobs.')
+    parser.add_argument('--target-uncertainty', type=float, dest='target_uncertainty', default=None,
+                        help='Stop an experiment when the uncertainty of its free energy is below this value '
+                             'in kcal/mol. Checked every switch_experiment_interval iterations.')
+    parser.add_argument('--plateau-tolerance', type=float, dest='plateau_tolerance', default=None,
+                        help='Stop an experiment when its last free energy estimates span less than this value '
+                             'in kcal/mol.')
+    parser.add_argument('--plateau-window', type=int, dest='plateau_window', default=5,
+                        help='Number of free energy estimates used to detect a plateau (default is 5).')
 
     args = parser.parse_args()
-    main(args.yaml_script_path, args.job_id, args.n_jobs)
+    if args.queue_dir_path is not None and args.job_id is not None:
+        parser.error('--queue cannot be used with --jobid/--njobs')
+    main(args.yaml_script_path, args.job_id, args.n_jobs, args.partition, args.queue_dir_path,
+         target_uncertainty=args.target_uncertainty, plateau_tolerance=args.plateau_tolerance,
+         plateau_window=args.plateau_window)
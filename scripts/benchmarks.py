@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Performance benchmarks of the input preparation scripts.
+
+The benchmarks run on synthetic data so that they do not require MCCE,
+OpenEye, or network access. Run a benchmark with
+
+    python benchmarks.py mcce-parser --n-residues 10000
+
+The docking benchmark can also time the FRED backend on a real protein
+when OpenEye is available
+
+    python benchmarks.py docking --backend fred --protein protein.pdb --box -9 -9 -9 9 9 9
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+
+import mcce
+import rename
+import docking
+import neighbors
+
+
+# =============================================================================
+# UTILITIES
+# =============================================================================
+
+@contextlib.contextmanager
+def timer(description):
+    """Context manager printing the wall-clock time spent in its block."""
+    start = time.perf_counter()
+    yield
+    print('{}: {:.3f}s'.format(description, time.perf_counter() - start))
+
+
+# =============================================================================
+# SYNTHETIC MCCE OUTPUT
+# =============================================================================
+
+# Conformers of the synthetic residues as (charge, heavy atoms) pairs.
+# Residues with a single conformer do not titrate.
+_SYNTHETIC_CONFORMERS = {
+    'ALA': [('0', ['CB', '1HB', '2HB', '3HB'])],
+    'ILE': [('0', ['CB', 'CG1', '1HG1', '2HG1', 'CD1'])],
+    'CYS': [('0', ['CB', 'SG', 'HG'])],
+    'GLU': [('0', ['CB', 'CG', 'CD', 'OE1', 'OE2', 'HE2']),
+            ('-', ['CB', 'CG', 'CD', 'OE1', 'OE2'])],
+    'ASP': [('0', ['CB', 'CG', 'OD1', 'OD2', 'HD2']),
+            ('-', ['CB', 'CG', 'OD1', 'OD2'])],
+    'LYS': [('0', ['CB', 'NZ', '1HZ', '2HZ']),
+            ('+', ['CB', 'NZ', '1HZ', '2HZ', '3HZ'])],
+    'HIS': [('0', ['CB', 'ND1', 'HD1', 'NE2']),
+            ('0', ['CB', 'ND1', 'NE2', 'HE2']),
+            ('+', ['CB', 'ND1', 'HD1', 'NE2', 'HE2'])],
+}
+
+
+def write_synthetic_mcce_output(n_residues, output_dir_path, seed=0):
+    """Write a synthetic step2_out.pdb and fort.38 in the MCCE format.
+
+    Parameters
+    ----------
+    n_residues : int
+        The number of residues of the synthetic protein.
+    output_dir_path : str
+        The directory where the files are written.
+    seed : int, optional
+        The seed of the random number generator (default is 0).
+
+    """
+    rng = random.Random(seed)
+    pdb_lines = []
+    fort38_lines = [' ph           7.0\n']
+
+    def add_atoms(atom_names, residue_name, residue_id):
+        for atom_name in atom_names:
+            # Atom names shorter than 4 characters start at column 13.
+            if len(atom_name) < 4:
+                atom_name = ' ' + atom_name
+            x, y, z = [rng.uniform(-99.0, 99.0) for _ in range(3)]
+            pdb_lines.append('ATOM  {:5d} {:<4s} {:3s} {}{:8.3f}{:8.3f}{:8.3f}'
+                             '   1.500      -0.350      BK____M000\n'.format(
+                                 len(pdb_lines) + 1, atom_name, residue_name,
+                                 residue_id, x, y, z))
+
+    residue_names = sorted(_SYNTHETIC_CONFORMERS)
+    for residue_index in range(1, n_residues + 1):
+        residue_name = rng.choice(residue_names)
+        conformers = _SYNTHETIC_CONFORMERS[residue_name]
+        residue_id = 'A{:04d}'.format(residue_index % 10000)
+
+        # Backbone atoms are in the conformer 000.
+        add_atoms(['N', 'H', 'CA', 'HA', 'C', 'O'], residue_name, residue_id + '_000')
+
+        # Random occupancies normalized over the conformers of the residue.
+        occupancies = [rng.random() for _ in conformers]
+        occupancies = [occupancy / sum(occupancies) for occupancy in occupancies]
+        for conformer_index, ((charge, atom_names), occupancy) in enumerate(zip(conformers, occupancies)):
+            conformer_id = '{}_{:03d}'.format(residue_id, conformer_index + 1)
+            fort38_lines.append('{}{}{}{} {:.3f}\n'.format(residue_name, charge, conformer_index + 1,
+                                                          conformer_id, occupancy))
+            add_atoms(atom_names, residue_name, conformer_id)
+
+    with open(os.path.join(output_dir_path, 'step2_out.pdb'), 'w') as f:
+        f.writelines(pdb_lines)
+    with open(os.path.join(output_dir_path, 'fort.38'), 'w') as f:
+        f.writelines(fort38_lines)
+
+
+def generate_multidomain_sulfurs(n_domains, n_cysteines_per_domain=100, domain_radius=20.0, seed=0):
+    """Generate the SG coordinates of the cysteines of a synthetic multi-domain protein.
+
+    The domains are spheres placed on a cubic lattice. Half of the cysteines
+    of each domain form disulfide bonds (with a S-S distance of 2.05A).
+
+    Returns
+    -------
+    coords : numpy.ndarray of shape (n_domains * n_cysteines_per_domain, 3)
+        The coordinates of the sulfur atoms.
+
+    """
+    rng = np.random.RandomState(seed)
+    lattice_size = int(np.ceil(n_domains**(1/3)))
+    coords = []
+    for domain_index in range(n_domains):
+        center = np.array(np.unravel_index(domain_index, (lattice_size,)*3)) * 2.5 * domain_radius
+        n_pairs = n_cysteines_per_domain // 4
+        n_free = n_cysteines_per_domain - 2*n_pairs
+        # Uniform points in the sphere.
+        directions = rng.normal(size=(n_pairs + n_free, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        radii = domain_radius * rng.uniform(size=(n_pairs + n_free, 1))**(1/3)
+        positions = center + directions * radii
+        bond_directions = rng.normal(size=(n_pairs, 3))
+        bond_directions /= np.linalg.norm(bond_directions, axis=1)[:, np.newaxis]
+        coords.extend([positions, positions[:n_pairs] + 2.05 * bond_directions])
+    return np.concatenate(coords)
+
+
+def write_synthetic_protein(pdb_file_path, n_atoms=5000, cavity_radius=6.0, seed=0):
+    """Write a PDB file of carbon atoms filling a sphere around an empty cavity.
+
+    The atoms are uniformly distributed between cavity_radius and the
+    radius giving the density of a protein (about 1 heavy atom per 10A^3)
+    and the cavity is centered on the origin.
+
+    """
+    rng = np.random.RandomState(seed)
+    outer_radius = (cavity_radius**3 + n_atoms * 10.0 * 3 / (4 * np.pi))**(1/3)
+    directions = rng.normal(size=(n_atoms, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    radii = rng.uniform(cavity_radius**3, outer_radius**3, size=(n_atoms, 1))**(1/3)
+    coords = directions * radii
+    with open(pdb_file_path, 'w') as f:
+        for atom_index, (x, y, z) in enumerate(coords):
+            f.write('ATOM  {:5d}  CA  ALA A{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C\n'.format(
+                atom_index % 100000, atom_index % 10000, x, y, z))
+
+
+# Ligands of the T4 lysozyme L99A benchmark set.
+_BENCHMARK_SMILES = ['c1ccccc1', 'Cc1ccccc1', 'CCc1ccccc1', 'CCCc1ccccc1', 'CCCCc1ccccc1',
+                     'Cc1ccc(C)cc1', 'c1ccc2occc2c1', 'CC(C)Cc1ccccc1', 'c1ccc2[nH]ccc2c1']
+
+
+# =============================================================================
+# BENCHMARKS
+# =============================================================================
+
+def benchmark_mcce_parser(n_residues=10000):
+    """Time the post-processing of the MCCE output of a synthetic protein."""
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        with timer('Generating synthetic MCCE output ({} residues)'.format(n_residues)):
+            write_synthetic_mcce_output(n_residues, tmp_dir_path)
+        with timer('read_fort38'):
+            titration_points, conformers = mcce.read_fort38(os.path.join(tmp_dir_path, 'fort.38'))
+        with timer('mostlikely_conformers'):
+            mcce.mostlikely_conformers(conformers)
+        with timer('ps_processmcce'):
+            pdbarr = mcce.ps_processmcce(tmp_dir_path, labeledPDBOnly=True)
+    print('{} conformers, {} atoms in the protonated structure'.format(len(conformers), len(pdbarr)))
+
+
+def benchmark_rename(n_residues=10000):
+    """Time the conversion of the MCCE output of a synthetic protein to the AMBER naming scheme."""
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        write_synthetic_mcce_output(n_residues, tmp_dir_path)
+        pdbarr = mcce.ps_processmcce(tmp_dir_path, labeledPDBOnly=True)
+    with timer('rename_residues ({} atoms)'.format(len(pdbarr))):
+        # Silence the debug output of rename_residues.
+        with contextlib.redirect_stdout(None):
+            pdbarr = rename.rename_residues(pdbarr, renameTermini=False)
+    with timer('pdb_cleanup'):
+        rename.pdb_cleanup(pdbarr)
+
+
+def benchmark_disulfides(n_domains=(1, 4, 16, 64, 256), n_cysteines_per_domain=100):
+    """Compare the scaling of the cell-list and all-pairs disulfide searches."""
+    min_dist, max_dist = 1.8, 2.2
+    for n in n_domains:
+        coords = generate_multidomain_sulfurs(n, n_cysteines_per_domain)
+        print('{} domains, {} cysteines'.format(n, len(coords)))
+
+        with timer('    all pairs'):
+            all_pairs = []
+            for i in range(len(coords)):
+                delta = coords[i] - coords[i+1:]
+                distances = np.sqrt(delta[:, 0]*delta[:, 0] + delta[:, 1]*delta[:, 1] + delta[:, 2]*delta[:, 2])
+                all_pairs.extend((i, j) for j in np.flatnonzero((distances >= min_dist) &
+                                                                (distances <= max_dist)) + i + 1)
+        with timer('    cell list'):
+            pairs = neighbors.pairs_within(coords, max_dist, min_dist=min_dist)
+        assert pairs.tolist() == [list(pair) for pair in all_pairs]
+        print('    {} disulfide bonds'.format(len(pairs)))
+
+
+def benchmark_docking(backend='grid', n_ligands=90, n_workers=1, protein_pdb_path=None, box=None):
+    """Time the creation of the receptor and the docking throughput of a backend.
+
+    Parameters
+    ----------
+    backend : str, optional
+        The name of the docking backend in docking.DOCKING_BACKENDS.
+    n_ligands : int, optional
+        The number of ligands to dock, cycling over the T4 lysozyme ligands.
+    n_workers : int, optional
+        The number of docking processes (see docking.dock_molecules).
+    protein_pdb_path : str, optional
+        The receptor PDB file. If None, a synthetic protein with a cavity
+        at the origin is used.
+    box : list of float, optional
+        The docking box [xmin, ymin, zmin, xmax, ymax, zmax] (required if
+        protein_pdb_path is given).
+
+    """
+    backend = docking.DOCKING_BACKENDS[backend]()
+    molecules_smiles = [_BENCHMARK_SMILES[i % len(_BENCHMARK_SMILES)] for i in range(n_ligands)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        if protein_pdb_path is None:
+            protein_pdb_path = os.path.join(tmp_dir_path, 'protein.pdb')
+            write_synthetic_protein(protein_pdb_path)
+            box = [-9.5, -9.5, -9.5, 9.5, 9.5, 9.5]
+        receptor_file_path = os.path.join(tmp_dir_path, 'receptor' + backend.receptor_suffix)
+
+        with timer('{}: create receptor'.format(backend.name)):
+            backend.save_receptor(backend.create_receptor(protein_pdb_path, box), receptor_file_path)
+
+        # The docker is initialized once per worker so this includes the loading of the receptor.
+        start = time.perf_counter()
+        with timer('{}: dock {} ligands'.format(backend.name, n_ligands)):
+            docked_mol2s = list(docking.dock_molecules(receptor_file_path, molecules_smiles,
+                                                       n_workers=n_workers,
+                                                       docker_class=backend.docker_class))
+        elapsed = time.perf_counter() - start
+    print('{}: {:.2f} ligands/s with {} workers'.format(backend.name, len(docked_mol2s) / elapsed, n_workers))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the performance benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    mcce_parser = subparsers.add_parser('mcce-parser', help='Time the parser of the MCCE output.')
+    mcce_parser.add_argument('--n-residues', type=int, default=10000,
+                             help='Number of residues of the synthetic protein (default is 10000).')
+    mcce_parser.set_defaults(function=benchmark_mcce_parser)
+
+    rename_parser = subparsers.add_parser('rename', help='Time the renaming of the MCCE output.')
+    rename_parser.add_argument('--n-residues', type=int, default=10000,
+                               help='Number of residues of the synthetic protein (default is 10000).')
+    rename_parser.set_defaults(function=benchmark_rename)
+
+    disulfides_parser = subparsers.add_parser('disulfides', help='Time the disulfide bond search.')
+    disulfides_parser.add_argument('--n-domains', type=int, nargs='+', default=[1, 4, 16, 64, 256],
+                                   help='Numbers of domains of the synthetic proteins (default is 1 4 16 64 256).')
+    disulfides_parser.add_argument('--n-cysteines-per-domain', type=int, default=100,
+                                   help='Number of cysteines in each domain (default is 100).')
+    disulfides_parser.set_defaults(function=benchmark_disulfides)
+
+    docking_parser = subparsers.add_parser('docking', help='Time the receptor creation and the docking throughput.')
+    docking_parser.add_argument('--backend', choices=sorted(docking.DOCKING_BACKENDS), default='grid',
+                                help='The docking backend (default is grid).')
+    docking_parser.add_argument('--n-ligands', type=int, default=90,
+                                help='Number of ligands to dock (default is 90).')
+    docking_parser.add_argument('--n-workers', type=int, default=1,
+                                help='Number of docking processes (default is 1).')
+    docking_parser.add_argument('--protein', dest='protein_pdb_path', default=None,
+                                help='The receptor PDB file (default is a synthetic protein).')
+    docking_parser.add_argument('--box', type=float, nargs=6, default=None,
+                                help='The docking box xmin ymin zmin xmax ymax zmax of --protein.')
+    docking_parser.set_defaults(function=benchmark_docking)
+
+    args = vars(parser.parse_args())
+    del args['benchmark']
+    args.pop('function')(**args)
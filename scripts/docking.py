@@ -1,9 +1,18 @@
 #!/usr/local/bin/env python
 
 import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-import openmoltools as moltools
-from openeye import oechem, oedocking
+import numpy as np
+
+import instrumentation
+from neighbors import CellList
+from pipeline import FileCache, hash_file, hash_parameters
+
+# OpenEye is imported only when needed so that the batch docking
+# machinery can be used (and tested) with other dockers.
 
 
 def create_receptor(protein_pdb_path, box):
@@ -23,6 +32,8 @@ def create_receptor(protein_pdb_path, box):
         The OpenEye receptor object.
 
     """
+    from openeye import oechem, oedocking
+
     input_mol_stream = oechem.oemolistream(protein_pdb_path)
     protein_oemol = oechem.OEGraphMol()
     oechem.OEReadMolecule(input_mol_stream, protein_oemol)
@@ -34,8 +45,16 @@ def create_receptor(protein_pdb_path, box):
     return receptor
 
 
+def save_receptor(receptor, receptor_oeb_path):
+    """Save an OpenEye receptor to a file in oeb format."""
+    from openeye import oedocking
+    if not oedocking.OEWriteReceptorFile(receptor, receptor_oeb_path):
+        raise RuntimeError('Could not write receptor to {}'.format(receptor_oeb_path))
+
+
 def load_receptor(receptor_oeb_path):
     """Load an OpenEye receptor file in oeb format."""
+    from openeye import oechem, oedocking
     if not os.path.exists(receptor_oeb_path):
         raise FileNotFoundError('Could not find ', receptor_oeb_path)
     receptor = oechem.OEGraphMol()
@@ -43,9 +62,607 @@ def load_receptor(receptor_oeb_path):
     return receptor
 
 
+class ReceptorCache(object):
+    """Persistent cache of docking receptors.
+
+    Generating the receptor grid is expensive so the receptors are saved
+    (in oeb format for FRED) and keyed by the hash of the content of the
+    protein PDB file, the docking box, and the backend and its parameters.
+    Docking a new batch of ligands against an existing receptor then only
+    needs to load the receptor. The least recently used receptors are
+    evicted when the cache exceeds max_size.
+
+    Parameters
+    ----------
+    cache_dir_path : str
+        The directory where the receptors are stored.
+    max_size : int or None, optional
+        The maximum total size of the cache in bytes. If None, receptors
+        are never evicted.
+    backend : FREDBackend or GridBackend, optional
+        The docking backend creating the receptors (default is FREDBackend).
+
+    """
+
+    def __init__(self, cache_dir_path, max_size=None, backend=None):
+        if backend is None:
+            backend = FREDBackend()
+        self.backend = backend
+        self._file_cache = FileCache(cache_dir_path, max_size=max_size, suffix=backend.receptor_suffix)
+
+    def get_key(self, protein_pdb_path, box):
+        """The hash identifying a receptor in the cache."""
+        return hash_parameters({'protein': hash_file(protein_pdb_path),
+                                'box': [float(x) for x in box],
+                                'backend': self.backend.name,
+                                'backend_parameters': self.backend.parameters})
+
+    def get_receptor_path(self, protein_pdb_path, box):
+        """Return the path to the receptor file, creating the receptor if not cached.
+
+        Parameters
+        ----------
+        protein_pdb_path : str
+            Path to the receptor PDB file.
+        box : 1x6 array of float
+            The box representing the binding site (see create_receptor).
+
+        Returns
+        -------
+        receptor_path : str
+            The path to the cached receptor file.
+
+        """
+        key = self.get_key(protein_pdb_path, box)
+        receptor_path = self._file_cache.get(key)
+        if receptor_path is None:
+            with instrumentation.stage('receptor-create', backend=self.backend.name):
+                receptor = self.backend.create_receptor(protein_pdb_path, box)
+                receptor_path = self._file_cache.put(
+                    key, lambda file_path: self.backend.save_receptor(receptor, file_path))
+        return receptor_path
+
+    def get_receptor(self, protein_pdb_path, box):
+        """Return the receptor, creating it if not cached (see get_receptor_path)."""
+        return self.backend.load_receptor(self.get_receptor_path(protein_pdb_path, box))
+
+
+class ChargedMoleculeCache(object):
+    """Persistent cache of charged multi-conformer molecules.
+
+    Charging with AM1-BCC and expanding the conformers is the slowest
+    part of docking. The charged molecules are stored in oeb format and
+    keyed by canonical isomeric SMILES, charge model, and number of
+    conformers so that a molecule is charged only once even if it
+    appears in several ligand sets or with a different SMILES string.
+    The least recently used molecules are evicted when the cache exceeds
+    max_size.
+
+    Parameters
+    ----------
+    cache_dir_path : str
+        The directory where the molecules are stored.
+    max_size : int or None, optional
+        The maximum total size of the cache in bytes. If None, molecules
+        are never evicted.
+
+    """
+
+    # The charge model used by openmoltools.openeye.get_charges().
+    CHARGE_MODEL = 'am1bcc'
+
+    def __init__(self, cache_dir_path, max_size=None):
+        self._file_cache = FileCache(cache_dir_path, max_size=max_size, suffix='.oeb')
+
+    @staticmethod
+    def get_key(canonical_smiles, n_conformations, charge_model=CHARGE_MODEL):
+        """The hash identifying a charged molecule in the cache."""
+        return hash_parameters({'smiles': canonical_smiles, 'charge_model': charge_model,
+                                'n_conformations': n_conformations})
+
+    def get_charged_oemol(self, molecule_smiles, n_conformations):
+        """Return the charged multi-conformer molecule, charging it if not cached.
+
+        Parameters
+        ----------
+        molecule_smiles : str
+            The SMILES string of the molecule.
+        n_conformations : int
+            The number of conformations to keep.
+
+        Returns
+        -------
+        molecule_oemol : openeye.oechem.OEMol
+            The charged molecule.
+
+        """
+        import openmoltools as moltools
+        from openeye import oechem
+
+        molecule_oemol = moltools.openeye.smiles_to_oemol(molecule_smiles)
+        key = self.get_key(oechem.OECreateIsoSmiString(molecule_oemol), n_conformations)
+
+        cached_file_path = self._file_cache.get(key)
+        if cached_file_path is not None:
+            charged_oemol = oechem.OEMol()
+            input_mol_stream = oechem.oemolistream(cached_file_path)
+            is_read = oechem.OEReadMolecule(input_mol_stream, charged_oemol)
+            input_mol_stream.close()
+            if is_read:
+                charged_oemol.SetTitle(molecule_oemol.GetTitle())
+                return charged_oemol
+
+        charged_oemol = moltools.openeye.get_charges(molecule_oemol, keep_confs=n_conformations)
+
+        def write_molecule(file_path):
+            output_mol_stream = oechem.oemolostream(file_path)
+            oechem.OEWriteMolecule(output_mol_stream, charged_oemol)
+            output_mol_stream.close()
+        self._file_cache.put(key, write_molecule)
+        return charged_oemol
+
+
+class FREDDocker(object):
+    """OpenEye multi-conformer docker initialized once for a receptor.
+
+    Parameters
+    ----------
+    receptor : openeye.oedocking.OEReceptor or str
+        The openeye receptor or the path to the receptor file in oeb format.
+    n_conformations : int, optional
+        The number of omega conformations to pass to the multi-conformer
+        docker (default is 10).
+    n_poses : int, optional
+        Number of binding poses to return (default is 1).
+    molecule_cache : ChargedMoleculeCache, optional
+        If given, the charged molecules are retrieved from this cache
+        instead of being charged from scratch.
+
+    """
+
+    def __init__(self, receptor, n_conformations=10, n_poses=1, molecule_cache=None):
+        from openeye import oedocking
+        if isinstance(receptor, str):
+            receptor = load_receptor(receptor)
+        self.n_conformations = n_conformations
+        self.n_poses = n_poses
+        self.molecule_cache = molecule_cache
+        self._dock = oedocking.OEDock()
+        self._dock.Initialize(receptor)
+
+    def dock_oemol(self, molecule_smiles):
+        """Dock a molecule.
+
+        Parameters
+        ----------
+        molecule_smiles : str
+            The SMILES string of the molecule.
+
+        Returns
+        -------
+        docked_oemol : openeye.oechem.OEMol
+            The docked multi-conformer OpenEye molecule.
+
+        """
+        import openmoltools as moltools
+        from openeye import oechem
+
+        # Charging and generating the conformers.
+        with instrumentation.stage('ligand-prepare', n_items=1):
+            if self.molecule_cache is not None:
+                molecule_oemol = self.molecule_cache.get_charged_oemol(molecule_smiles, self.n_conformations)
+            else:
+                molecule_oemol = moltools.openeye.smiles_to_oemol(molecule_smiles)
+                molecule_oemol = moltools.openeye.get_charges(molecule_oemol, keep_confs=self.n_conformations)
+
+        with instrumentation.stage('ligand-dock', backend='fred', n_items=1):
+            docked_oemol = oechem.OEMol()
+            self._dock.DockMultiConformerMolecule(docked_oemol, molecule_oemol, self.n_poses)
+        return docked_oemol
+
+    def dock(self, molecule_smiles):
+        """Dock a molecule and return the poses in mol2 format.
+
+        OpenEye molecules cannot be pickled so, unlike dock_oemol(),
+        this can be used to return the poses from a worker process.
+
+        Parameters
+        ----------
+        molecule_smiles : str
+            The SMILES string of the molecule.
+
+        Returns
+        -------
+        docked_mol2 : str
+            The content of the mol2 file of the docked molecule, with
+            residue name MOL.
+
+        """
+        import openmoltools as moltools
+
+        docked_oemol = self.dock_oemol(molecule_smiles)
+        with tempfile.TemporaryDirectory() as tmp_dir_path:
+            mol2_file_path = os.path.join(tmp_dir_path, 'docked.mol2')
+            moltools.openeye.molecule_to_mol2(docked_oemol, mol2_file_path, residue_name='MOL')
+            with open(mol2_file_path, 'r') as f:
+                return f.read()
+
+
+class DummyDocker(object):
+    """Deterministic stand-in for FREDDocker that does not require OpenEye.
+
+    The "pose" of a molecule is a mol2 record with one atom per character
+    of its SMILES string placed on a line. This is meant to test the
+    batch docking machinery.
+
+    Parameters
+    ----------
+    receptor : object
+        Ignored, but it must be picklable to be passed to worker processes.
+
+    Attributes
+    ----------
+    n_initializations : int
+        The number of DummyDocker objects created in this process.
+
+    """
+
+    n_initializations = 0
+
+    def __init__(self, receptor, **kwargs):
+        DummyDocker.n_initializations += 1
+        self.receptor = receptor
+
+    def dock(self, molecule_smiles):
+        """Return a deterministic mol2 record for the molecule."""
+        lines = ['@<TRIPOS>MOLECULE', molecule_smiles,
+                 '{} 0 1 0 0'.format(len(molecule_smiles)), 'SMALL', 'NO_CHARGES', '',
+                 '@<TRIPOS>ATOM']
+        for atom_index, element in enumerate(molecule_smiles):
+            lines.append('{:7d} {:<4s} {:10.4f} {:10.4f} {:10.4f} Du 1 MOL 0.0000'.format(
+                atom_index + 1, element, 1.5 * atom_index, 0.0, 0.0))
+        return '\n'.join(lines) + '\n'
+
+
+# Atoms of the SMILES organic subset (two-letter elements first), bracket
+# atoms, ring closures, branches, and bonds.
+_SMILES_TOKEN_PATTERN = re.compile(r'\[[^\]]+\]|Br|Cl|[BCNOPSFI]|[bcnops]|%\d\d|\d|[()]|[-=#:/\\.]')
+
+
+def parse_smiles(molecule_smiles):
+    """Return the heavy atoms and bonds of a SMILES string.
+
+    Bond orders, charges, and stereochemistry are ignored.
+
+    Returns
+    -------
+    elements : list of str
+        The element of each heavy atom.
+    bonds : list of tuple of int
+        The pairs of bonded atom indices.
+
+    """
+    elements, bonds = [], []
+    branch_stack = []
+    open_rings = {}
+    previous_atom = None
+    for token in _SMILES_TOKEN_PATTERN.findall(molecule_smiles):
+        if token[0] == '[' or token[0].isalpha():
+            if token.startswith('['):
+                element = re.match(r'\[\d*([A-Za-z][a-z]?)', token).group(1)
+                if element == 'H':
+                    continue
+            else:
+                element = token
+            elements.append(element.capitalize())
+            if previous_atom is not None:
+                bonds.append((previous_atom, len(elements) - 1))
+            previous_atom = len(elements) - 1
+        elif token == '(':
+            branch_stack.append(previous_atom)
+        elif token == ')':
+            previous_atom = branch_stack.pop()
+        elif token == '.':
+            previous_atom = None
+        elif token[0] in '%0123456789':
+            if token in open_rings:
+                bonds.append((open_rings.pop(token), previous_atom))
+            else:
+                open_rings[token] = previous_atom
+    return elements, bonds
+
+
+def embed_molecule(n_atoms, bonds, random_state, n_iterations=300):
+    """Generate 3D coordinates of a molecular graph with a simple force field.
+
+    Bonded atoms are kept at 1.5A, atoms separated by two bonds at 2.5A,
+    and the other atoms are pushed farther than 3.0A apart by minimizing
+    harmonic penalties with gradient descent.
+
+    Returns
+    -------
+    coords : numpy.ndarray of shape (n_atoms, 3)
+        The coordinates in angstroms, centered on the origin.
+
+    """
+    # Target distances and lower bounds between all pairs of atoms.
+    adjacency = np.zeros((n_atoms, n_atoms), dtype=bool)
+    for i, j in bonds:
+        adjacency[i, j] = adjacency[j, i] = True
+    two_bonds = (adjacency.astype(int) @ adjacency.astype(int) > 0) & ~adjacency
+    np.fill_diagonal(two_bonds, False)
+    target = np.where(adjacency, 1.5, np.where(two_bonds, 2.5, 0.0))
+    lower_bound = np.where(target > 0, 0.0, 3.0)
+    np.fill_diagonal(lower_bound, 0.0)
+
+    # Added to the distances to avoid dividing by zero on the diagonal.
+    identity = np.eye(n_atoms)
+
+    coords = random_state.uniform(-1.0, 1.0, size=(n_atoms, 3)) * max(1.0, n_atoms**(1/3))
+    for _ in range(n_iterations):
+        delta = coords[:, np.newaxis, :] - coords[np.newaxis, :, :]
+        distances = np.sqrt((delta**2).sum(axis=2)) + identity
+        violation = np.where(target > 0, distances - target, np.minimum(distances - lower_bound, 0.0))
+        gradient = ((violation / distances)[:, :, np.newaxis] * delta).sum(axis=1)
+        coords -= 0.1 * gradient
+    return coords - coords.mean(axis=0)
+
+
+def _random_rotations(n_rotations, random_state):
+    """Uniformly distributed rotation matrices from random unit quaternions."""
+    q = random_state.normal(size=(n_rotations, 4))
+    q /= np.linalg.norm(q, axis=1)[:, np.newaxis]
+    w, x, y, z = q.T
+    return np.stack([
+        np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis=1),
+        np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis=1),
+        np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=1),
+    ], axis=1)
+
+
+def _read_heavy_atom_coords(pdb_file_path):
+    """Return the coordinates of the heavy atoms of a PDB file."""
+    coords = []
+    with open(pdb_file_path, 'r') as f:
+        for line in f:
+            if not line.startswith(('ATOM', 'HETATM')):
+                continue
+            element = line[76:78].strip() or line[12:16].strip().lstrip('0123456789')[:1]
+            if element.upper() == 'H':
+                continue
+            coords.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+    return np.array(coords).reshape(-1, 3)
+
+
+class GridBackend(object):
+    """Pure NumPy reference docking backend.
+
+    The receptor is a grid of scores covering the docking box. Each grid
+    point is penalized for every protein heavy atom closer than
+    CLASH_DISTANCE and rewarded for every heavy atom within
+    CONTACT_DISTANCE. The receptors are saved in npz format.
+
+    This backend does not require OpenEye and is meant to test and time
+    the docking pipeline, not to generate accurate poses.
+
+    Parameters
+    ----------
+    grid_spacing : float, optional
+        The spacing of the score grid in angstroms (default is 0.5).
+
+    """
+
+    name = 'grid'
+    receptor_suffix = '.npz'
+
+    CLASH_DISTANCE = 3.0  # In angstroms.
+    CONTACT_DISTANCE = 5.0  # In angstroms.
+    CLASH_PENALTY = 10.0
+    CONTACT_SCORE = -1.0
+
+    def __init__(self, grid_spacing=0.5):
+        self.grid_spacing = grid_spacing
+
+    @property
+    def docker_class(self):
+        return GridDocker
+
+    @property
+    def parameters(self):
+        """The parameters determining the receptor grid."""
+        return {'grid_spacing': float(self.grid_spacing), 'clash_distance': self.CLASH_DISTANCE,
+                'contact_distance': self.CONTACT_DISTANCE, 'clash_penalty': self.CLASH_PENALTY,
+                'contact_score': self.CONTACT_SCORE}
+
+    def create_receptor(self, protein_pdb_path, box):
+        """Create the score grid of the docking box.
+
+        Parameters
+        ----------
+        protein_pdb_path : str
+            Path to the receptor PDB file.
+        box : 1x6 array of float
+            The coordinates of two opposite corners of the box
+            representing the binding site.
+
+        Returns
+        -------
+        receptor : dict
+            The grid 'origin', 'spacing', and 'scores'.
+
+        """
+        box = np.asarray(box, dtype=float)
+        box_min, box_max = np.minimum(box[:3], box[3:]), np.maximum(box[:3], box[3:])
+        shape = np.floor((box_max - box_min) / self.grid_spacing).astype(int) + 1
+        grid_points = box_min + self.grid_spacing * np.indices(shape).reshape(3, -1).T
+
+        # Score the grid points by their distance to the protein heavy atoms.
+        protein_coords = _read_heavy_atom_coords(protein_pdb_path)
+        cell_list = CellList(protein_coords, cell_size=self.CONTACT_DISTANCE)
+        pairs = cell_list.query_points(grid_points, self.CONTACT_DISTANCE)
+        distances = np.linalg.norm(grid_points[pairs[:, 0]] - protein_coords[pairs[:, 1]], axis=1)
+        pair_scores = np.where(distances < self.CLASH_DISTANCE, self.CLASH_PENALTY, self.CONTACT_SCORE)
+        scores = np.bincount(pairs[:, 0], weights=pair_scores, minlength=len(grid_points))
+        return dict(origin=box_min, spacing=np.array(self.grid_spacing), scores=scores.reshape(shape))
+
+    @staticmethod
+    def save_receptor(receptor, receptor_npz_path):
+        # Pass an open file so that numpy does not append the .npz extension.
+        with open(receptor_npz_path, 'wb') as f:
+            np.savez(f, **receptor)
+
+    @staticmethod
+    def load_receptor(receptor_npz_path):
+        with np.load(receptor_npz_path) as npz_file:
+            return {name: npz_file[name] for name in npz_file.files}
+
+
+class GridDocker(object):
+    """Rigid-body docker on the score grid of GridBackend.
+
+    Each molecule is embedded in n_conformations random rigid conformers
+    (heavy atoms only) that are placed on a regular lattice of positions
+    in the box with n_orientations random orientations. The poses with
+    the lowest sum of the grid scores at the atom positions are returned.
+
+    Parameters
+    ----------
+    receptor : dict or str
+        The receptor created by GridBackend.create_receptor() or the path
+        to the receptor file in npz format.
+    n_conformations : int, optional
+        The number of rigid conformers of each molecule (default is 10).
+    n_poses : int, optional
+        Number of binding poses to return (default is 1).
+    n_orientations : int, optional
+        The number of random orientations of each conformer (default is 30).
+    translation_spacing : float, optional
+        The spacing in angstroms of the lattice of ligand centers (default
+        is 2.0).
+    molecule_cache : object, optional
+        Ignored. The grid docker does not charge the molecules.
+
+    """
+
+    # Score of the atoms outside the grid.
+    OUTSIDE_SCORE = 10.0
+
+    def __init__(self, receptor, n_conformations=10, n_poses=1, n_orientations=30,
+                 translation_spacing=2.0, molecule_cache=None):
+        if isinstance(receptor, str):
+            receptor = GridBackend.load_receptor(receptor)
+        self.n_conformations = n_conformations
+        self.n_poses = n_poses
+        self.n_orientations = n_orientations
+        self._origin = receptor['origin']
+        self._spacing = float(receptor['spacing'])
+        # Pad the grid with one layer of OUTSIDE_SCORE so that out-of-box
+        # atoms can be scored by clipping their indices.
+        self._scores = np.pad(receptor['scores'], 1, mode='constant', constant_values=self.OUTSIDE_SCORE)
+
+        # Lattice of ligand centers.
+        box_size = self._spacing * (np.array(receptor['scores'].shape) - 1)
+        n_translations = np.floor(box_size / translation_spacing).astype(int) + 1
+        self._translations = self._origin + translation_spacing * np.indices(n_translations).reshape(3, -1).T
+
+    def score(self, coords):
+        """Return the grid score of an array of atom coordinates of shape (..., n_atoms, 3)."""
+        indices = np.rint((coords - self._origin) / self._spacing).astype(int) + 1
+        flat_indices = np.ravel_multi_index(np.moveaxis(indices, -1, 0), self._scores.shape, mode='clip')
+        return self._scores.ravel()[flat_indices].sum(axis=-1)
+
+    def dock_coords(self, molecule_smiles):
+        """Dock a molecule.
+
+        Returns
+        -------
+        elements : list of str
+            The elements of the heavy atoms.
+        bonds : list of tuple of int
+            The pairs of bonded atom indices.
+        poses : list of numpy.ndarray of shape (n_atoms, 3)
+            The coordinates of the n_poses best poses.
+        scores : list of float
+            The scores of the poses.
+
+        """
+        elements, bonds = parse_smiles(molecule_smiles)
+        # The docking of a molecule is reproducible.
+        random_state = np.random.RandomState(int(hash_parameters(molecule_smiles)[:8], 16))
+
+        poses, scores = [], []
+        for _ in range(self.n_conformations):
+            conformer = embed_molecule(len(elements), bonds, random_state)
+            rotations = _random_rotations(self.n_orientations, random_state)
+            # Shape (n_orientations, n_translations, n_atoms, 3).
+            rotated = np.einsum('rij,aj->rai', rotations, conformer)
+            placed = rotated[:, np.newaxis] + self._translations[np.newaxis, :, np.newaxis]
+            placed_scores = self.score(placed)
+            for flat_index in np.argsort(placed_scores, axis=None)[:self.n_poses]:
+                rotation_index, translation_index = np.unravel_index(flat_index, placed_scores.shape)
+                poses.append(placed[rotation_index, translation_index])
+                scores.append(float(placed_scores[rotation_index, translation_index]))
+
+        best = np.argsort(scores, kind='stable')[:self.n_poses]
+        return elements, bonds, [poses[i] for i in best], [scores[i] for i in best]
+
+    def dock(self, molecule_smiles):
+        """Dock a molecule and return the poses in mol2 format with residue name MOL."""
+        with instrumentation.stage('ligand-dock', backend='grid', n_items=1):
+            elements, bonds, poses, scores = self.dock_coords(molecule_smiles)
+        records = []
+        for pose, score in zip(poses, scores):
+            lines = ['@<TRIPOS>MOLECULE', molecule_smiles,
+                     '{} {} 1 0 0'.format(len(elements), len(bonds)), 'SMALL', 'NO_CHARGES',
+                     '', 'grid score {:.1f}'.format(score), '@<TRIPOS>ATOM']
+            for atom_index, (element, (x, y, z)) in enumerate(zip(elements, pose)):
+                lines.append('{:7d} {:<4s} {:10.4f} {:10.4f} {:10.4f} {} 1 MOL 0.0000'.format(
+                    atom_index + 1, element + str(atom_index + 1), x, y, z, element))
+            lines.append('@<TRIPOS>BOND')
+            for bond_index, (i, j) in enumerate(bonds):
+                lines.append('{:6d} {:5d} {:5d} 1'.format(bond_index + 1, i + 1, j + 1))
+            records.append('\n'.join(lines) + '\n')
+        return ''.join(records)
+
+
+class FREDBackend(object):
+    """OpenEye FRED docking backend (receptors in oeb format)."""
+
+    name = 'fred'
+    receptor_suffix = '.oeb'
+
+    @property
+    def docker_class(self):
+        return FREDDocker
+
+    @property
+    def parameters(self):
+        """The parameters determining the receptor (FRED has none)."""
+        return {}
+
+    @staticmethod
+    def create_receptor(protein_pdb_path, box):
+        return create_receptor(protein_pdb_path, box)
+
+    @staticmethod
+    def save_receptor(receptor, receptor_oeb_path):
+        save_receptor(receptor, receptor_oeb_path)
+
+    @staticmethod
+    def load_receptor(receptor_oeb_path):
+        return load_receptor(receptor_oeb_path)
+
+
+# The docking backends by name.
+DOCKING_BACKENDS = {backend.name: backend for backend in [FREDBackend, GridBackend]}
+
+
 def dock_molecule(receptor, molecule_smiles, n_conformations=10, n_poses=1):
     """Run the multi-conformer docker.
 
+    To dock many molecules against the same receptor, use dock_molecules()
+    which initializes the docker only once.
+
     Parameters
     ----------
     receptor : openeye.oedocking.OEReceptor
@@ -64,13 +681,65 @@ def dock_molecule(receptor, molecule_smiles, n_conformations=10, n_poses=1):
         The docked multi-conformer OpenEye molecule.
 
     """
-    dock = oedocking.OEDock()
-    dock.Initialize(receptor)
+    docker = FREDDocker(receptor, n_conformations=n_conformations, n_poses=n_poses)
+    return docker.dock_oemol(molecule_smiles)
+
+
+# The docker of each worker process of dock_molecules().
+_worker_docker = None
+
 
-    molecule_oemol = moltools.openeye.smiles_to_oemol(molecule_smiles)
-    molecule_oemol = moltools.openeye.get_charges(molecule_oemol, keep_confs=n_conformations)
+def _initialize_docking_worker(docker_class, receptor, docker_kwargs):
+    global _worker_docker
+    _worker_docker = docker_class(receptor, **docker_kwargs)
 
-    docked_oemol = oechem.OEMol()
-    dock.DockMultiConformerMolecule(docked_oemol, molecule_oemol, n_poses)
 
-    return docked_oemol
+def _dock_in_worker(molecule_smiles):
+    return _worker_docker.dock(molecule_smiles)
+
+
+def dock_molecules(receptor, molecules_smiles, n_workers=None, docker_class=FREDDocker,
+                   **docker_kwargs):
+    """Dock a batch of molecules against the same receptor in parallel.
+
+    The docker is initialized only once in each worker process and the
+    molecules are distributed over a pool of processes.
+
+    Parameters
+    ----------
+    receptor : str or object
+        The receptor passed to docker_class. For FREDDocker, this is the
+        path to the receptor file in oeb format since OpenEye receptors
+        cannot be pickled. The receptor object can be used only if
+        n_workers is 1.
+    molecules_smiles : iterable of str
+        The SMILES strings of the molecules to dock.
+    n_workers : int or None, optional
+        The number of worker processes. If 1, the molecules are docked in
+        this process. If None, the number of CPUs is used.
+    docker_class : type, optional
+        The docker class (default is FREDDocker). It is instantiated as
+        docker_class(receptor, **docker_kwargs), and its dock(smiles)
+        method must return a picklable result.
+    **docker_kwargs
+        Other keyword arguments for the docker (e.g., n_conformations or
+        molecule_cache).
+
+    Yields
+    ------
+    result
+        The result of docker.dock() for each molecule (for FREDDocker, the
+        mol2 string of the docked molecule) in the same order of
+        molecules_smiles, as soon as it becomes available.
+
+    """
+    if n_workers == 1:
+        docker = docker_class(receptor, **docker_kwargs)
+        for molecule_smiles in molecules_smiles:
+            yield docker.dock(molecule_smiles)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_initialize_docking_worker,
+                             initargs=(docker_class, receptor, docker_kwargs)) as executor:
+        for result in executor.map(_dock_in_worker, molecules_smiles):
+            yield result
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Concurrent and cached download of the input files.
+
+The ``Downloader`` fetches files on a bounded thread pool and stores
+them in a content-addressed local cache. Before using a cached file,
+its ETag and size are validated against the server so that files are
+downloaded again only if they changed upstream.
+
+In offline mode, relative URLs are resolved against a local mirror
+directory reproducing the structure of the remote base URL, which
+allows preparing the input files on nodes without internet access.
+
+Any URL scheme supported by ``urllib`` works, so the downloader can be
+exercised against a local ``file://`` base URL or a localhost server.
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import warnings
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+# =============================================================================
+# DOWNLOADER
+# =============================================================================
+
+class Downloader(object):
+    """Download files concurrently through a content-addressed cache.
+
+    Parameters
+    ----------
+    base_url : str, optional
+        The base URL used to resolve relative URLs.
+    cache_dir_path : str or None, optional
+        The directory of the local cache. If None, files are not cached.
+    mirror_dir_path : str or None, optional
+        If given, the downloader works offline and resolves relative URLs
+        against this directory instead of base_url.
+    max_workers : int, optional
+        The maximum number of concurrent downloads (default is 8).
+
+    """
+
+    _INDEX_FILE_NAME = 'index.json'
+
+    def __init__(self, base_url='', cache_dir_path=None, mirror_dir_path=None, max_workers=8):
+        self.base_url = base_url
+        self.cache_dir_path = cache_dir_path
+        self.mirror_dir_path = mirror_dir_path
+        self.max_workers = max_workers
+
+        self._index_lock = threading.Lock()
+        self._index = {}
+        if cache_dir_path is not None:
+            os.makedirs(os.path.join(cache_dir_path, 'objects'), exist_ok=True)
+            try:
+                with open(self._index_file_path, 'r') as f:
+                    self._index = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def is_offline(self):
+        """True if relative URLs are resolved against the local mirror."""
+        return self.mirror_dir_path is not None
+
+    def download(self, url, file_path, relative_url=True):
+        """Download and save a single file.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the file to download.
+        file_path : str
+            The path of the file to save.
+        relative_url : bool, optional
+            If True, url is interpreted as relative to base_url (or to the
+            mirror directory in offline mode).
+
+        """
+        # Create the directory if it doesn't exist.
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+
+        # Offline mode: copy the file from the local mirror.
+        if relative_url and self.is_offline:
+            shutil.copyfile(os.path.join(self.mirror_dir_path, url), file_path)
+            return
+
+        if relative_url:
+            url = self.base_url + url
+
+        # Offline mode: absolute URLs can be served only from the cache.
+        if self.is_offline:
+            object_path = self._get_cached_object_path(url, validate=False)
+            if object_path is None:
+                raise FileNotFoundError('{} is not cached and the downloader '
+                                        'is offline.'.format(url))
+            shutil.copyfile(object_path, file_path)
+        elif self.cache_dir_path is None:
+            with urllib.request.urlopen(url) as response, open(file_path, 'wb') as f:
+                shutil.copyfileobj(response, f)
+        else:
+            shutil.copyfile(self._get_cached_object_path(url), file_path)
+
+    def download_files(self, urls, file_paths, relative_url=True):
+        """Download and save multiple files concurrently.
+
+        Parameters
+        ----------
+        urls : list of str
+            The URLs of the files to download.
+        file_paths : list of str
+            The paths of the files to save.
+        relative_url : bool, optional
+            If True, the urls are interpreted as relative to base_url.
+
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.download, url, file_path, relative_url)
+                       for url, file_path in zip(urls, file_paths)]
+            # Propagate eventual exceptions.
+            for future in futures:
+                future.result()
+
+    # -------------------------------------------------------------------------
+    # Cache.
+    # -------------------------------------------------------------------------
+
+    @property
+    def _index_file_path(self):
+        return os.path.join(self.cache_dir_path, self._INDEX_FILE_NAME)
+
+    def _get_object_path(self, sha256):
+        return os.path.join(self.cache_dir_path, 'objects', sha256[:2], sha256)
+
+    def _get_cached_object_path(self, url, validate=True):
+        """Return the path to the cached copy of url, downloading it if stale.
+
+        If validate is False, the cached copy is never checked against
+        the server and None is returned if url is not in the cache. If
+        the server cannot be reached, the cached copy is used with a
+        warning.
+        """
+        with self._index_lock:
+            entry = self._index.get(url)
+
+        if not validate:
+            if entry is None or self.cache_dir_path is None:
+                return None
+            object_path = self._get_object_path(entry['sha256'])
+            return object_path if os.path.exists(object_path) else None
+
+        # Validate the cached object against the remote ETag and size.
+        if entry is not None and os.path.exists(self._get_object_path(entry['sha256'])):
+            try:
+                etag, size = self._get_remote_metadata(url)
+            except (urllib.error.URLError, OSError) as e:
+                warnings.warn('Could not validate the cached copy of {} ({}). '
+                              'Using the cached copy.'.format(url, e))
+                return self._get_object_path(entry['sha256'])
+            is_valid = (os.path.getsize(self._get_object_path(entry['sha256'])) == entry['size'] and
+                        (size is None or size == entry['size']) and
+                        (etag is None or etag == entry['etag']))
+            if is_valid:
+                return self._get_object_path(entry['sha256'])
+
+        # Download the file while computing its hash.
+        sha256 = hashlib.sha256()
+        tmp_dir_path = os.path.join(self.cache_dir_path, 'objects')
+        f = tempfile.NamedTemporaryFile(dir=tmp_dir_path, delete=False)
+        tmp_file_path = f.name
+        try:
+            with f, urllib.request.urlopen(url) as response:
+                etag = response.headers.get('ETag')
+                for block in iter(lambda: response.read(2**16), b''):
+                    sha256.update(block)
+                    f.write(block)
+        except BaseException:
+            # Do not leave partial downloads in the cache.
+            os.remove(tmp_file_path)
+            raise
+        sha256 = sha256.hexdigest()
+
+        # Store the object under its content hash.
+        object_path = self._get_object_path(sha256)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(tmp_file_path, object_path)
+
+        with self._index_lock:
+            self._index[url] = {'sha256': sha256, 'etag': etag,
+                                'size': os.path.getsize(object_path)}
+            self._write_index()
+        return object_path
+
+    def _write_index(self):
+        """Atomically write the url index. Must be called with the lock held."""
+        tmp_file_path = self._index_file_path + '.tmp'
+        with open(tmp_file_path, 'w') as f:
+            json.dump(self._index, f, indent=1, sort_keys=True)
+        os.replace(tmp_file_path, self._index_file_path)
+
+    @staticmethod
+    def _get_remote_metadata(url):
+        """Return the ETag and size of the remote file (None if unknown)."""
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request) as response:
+            etag = response.headers.get('ETag')
+            size = response.headers.get('Content-Length')
+        if size is not None:
+            size = int(size)
+        return etag, size
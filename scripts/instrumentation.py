@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Per-stage timing and memory instrumentation of the input preparation.
+
+The code of the pipeline is wrapped in ``stage()`` context managers that,
+when tracing is enabled, append one JSON record per executed block to a
+trace file with the wall-clock time, the CPU time of the process and of
+its terminated subprocesses (e.g., MCCE), the peak resident memory (the
+high-water mark of the process and its children at the end of the block),
+and the number of processed items (e.g., ligands). Tracing is enabled with
+``enable_tracing()`` or by setting the environment variable
+``PREPARE_TRACE_FILE``, which is inherited by the worker processes.
+
+Stages can be nested (e.g., the charging of each ligand is recorded
+inside the docking stage), so the totals of different stages overlap.
+Nested stages, also in subprocesses, inherit the system of the enclosing
+stage if they don't specify one.
+
+Aggregate a trace by stage and/or system with
+
+    python instrumentation.py summarize trace.jsonl --by stage system
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import contextlib
+from collections import OrderedDict
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+# The environment variable holding the path to the trace file.
+TRACE_FILE_ENV_VAR = 'PREPARE_TRACE_FILE'
+
+# The environment variable holding the system of the enclosing stage.
+_SYSTEM_ENV_VAR = 'PREPARE_TRACE_SYSTEM'
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+_MAXRSS_TO_MB = 1 / 2**20 if sys.platform == 'darwin' else 1 / 2**10
+
+
+# =============================================================================
+# TRACING
+# =============================================================================
+
+def enable_tracing(trace_file_path):
+    """Append the stage records to the given JSONL file.
+
+    The setting is stored in the environment so that it is inherited by
+    the subprocesses (e.g., the docking workers).
+
+    """
+    os.environ[TRACE_FILE_ENV_VAR] = os.path.abspath(trace_file_path)
+
+
+def disable_tracing():
+    """Stop writing the stage records."""
+    os.environ.pop(TRACE_FILE_ENV_VAR, None)
+
+
+def get_trace_file_path():
+    """The path to the trace file or None if tracing is disabled."""
+    return os.environ.get(TRACE_FILE_ENV_VAR, None)
+
+
+def _get_resource_usage():
+    """Return the CPU times of the process and its children and the peak RSS in MB."""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = self_usage.ru_utime + self_usage.ru_stime
+    children_cpu_time = children_usage.ru_utime + children_usage.ru_stime
+    peak_rss = max(self_usage.ru_maxrss, children_usage.ru_maxrss) * _MAXRSS_TO_MB
+    return cpu_time, children_cpu_time, peak_rss
+
+
+def write_record(record):
+    """Append a record to the trace file if tracing is enabled."""
+    trace_file_path = get_trace_file_path()
+    if trace_file_path is None:
+        return
+    # A single write of a line in append mode does not interleave
+    # with the records written by other processes.
+    line = json.dumps(record, default=str) + '\n'
+    with open(trace_file_path, 'a') as f:
+        f.write(line)
+
+
+@contextlib.contextmanager
+def stage(stage_name, system=None, set_environment=True, **labels):
+    """Context manager recording the resources used by a block of code.
+
+    Parameters
+    ----------
+    stage_name : str
+        The name of the stage (e.g., 'mcce-run').
+    system : str, optional
+        The system processed by the stage (e.g., 'l99a-55'). By default,
+        this is the system of the enclosing stage.
+    set_environment : bool, optional
+        If True (default), the system is stored in the environment while
+        the block runs so that the nested stages, also in subprocesses,
+        inherit it. Pass False in generators and coroutines, which can be
+        suspended inside the block, and give the system explicitly.
+    **labels
+        Other JSON-serializable fields added to the record.
+
+    Yields
+    ------
+    record : dict
+        The record written to the trace at the end of the block. The
+        block can update it (e.g., ``record['n_items'] = n_ligands``).
+
+    """
+    if get_trace_file_path() is None:
+        yield dict(labels)
+        return
+
+    enclosing_system = os.environ.get(_SYSTEM_ENV_VAR, None)
+    if system is None:
+        system = enclosing_system
+    elif set_environment and system != enclosing_system:
+        os.environ[_SYSTEM_ENV_VAR] = system
+    record = OrderedDict([('stage', stage_name), ('system', system), ('n_items', None)])
+    record.update(labels)
+
+    start_time = time.time()
+    start_wall = time.perf_counter()
+    start_cpu, start_children_cpu, _ = _get_resource_usage()
+    status = 'ok'
+    try:
+        yield record
+    except Exception:
+        status = 'error'
+        raise
+    except BaseException:
+        # E.g., KeyboardInterrupt or a generator closed early.
+        status = 'interrupted'
+        raise
+    finally:
+        if set_environment and enclosing_system is None:
+            os.environ.pop(_SYSTEM_ENV_VAR, None)
+        elif set_environment:
+            os.environ[_SYSTEM_ENV_VAR] = enclosing_system
+        cpu, children_cpu, peak_rss = _get_resource_usage()
+        record.update([
+            ('pid', os.getpid()),
+            ('start_time', start_time),
+            ('wall_time', time.perf_counter() - start_wall),
+            ('cpu_time', cpu - start_cpu),
+            ('children_cpu_time', children_cpu - start_children_cpu),
+            ('peak_rss_mb', peak_rss),
+            ('status', status),
+        ])
+        write_record(record)
+
+
+# =============================================================================
+# SUMMARY
+# =============================================================================
+
+def read_trace(trace_file_path):
+    """Return the list of records in a trace file."""
+    with open(trace_file_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records, group_by=('stage',)):
+    """Aggregate the trace records.
+
+    Parameters
+    ----------
+    records : list of dict
+        The records of the trace (see read_trace).
+    group_by : sequence of str, optional
+        The fields of the records identifying a group (default is stage).
+
+    Returns
+    -------
+    summary : list of OrderedDict
+        One row per group, sorted by decreasing total wall-clock time, with
+        the number of records, the total and mean wall-clock times, the
+        total CPU times, the maximum peak RSS, the total number of items,
+        and the throughput in items per second of wall-clock time.
+
+    """
+    groups = OrderedDict()
+    for record in records:
+        group = tuple(record.get(field) for field in group_by)
+        groups.setdefault(group, []).append(record)
+
+    summary = []
+    for group, group_records in groups.items():
+        wall_time = sum(record['wall_time'] for record in group_records)
+        n_items = sum(record.get('n_items') or 0 for record in group_records)
+        row = OrderedDict(zip(group_by, group))
+        row.update([
+            ('count', len(group_records)),
+            ('errors', sum(record['status'] == 'error' for record in group_records)),
+            ('wall_time', wall_time),
+            ('mean_wall_time', wall_time / len(group_records)),
+            ('cpu_time', sum(record['cpu_time'] for record in group_records)),
+            ('children_cpu_time', sum(record['children_cpu_time'] for record in group_records)),
+            ('peak_rss_mb', max(record['peak_rss_mb'] for record in group_records)),
+            ('n_items', n_items),
+            ('items_per_second', n_items / wall_time if n_items and wall_time > 0 else None),
+        ])
+        summary.append(row)
+    summary.sort(key=lambda row: row['wall_time'], reverse=True)
+    return summary
+
+
+def format_summary(summary):
+    """Return the summary as a text table."""
+    if len(summary) == 0:
+        return 'The trace is empty.'
+    header = list(summary[0].keys())
+    rows = [header]
+    for row in summary:
+        rows.append(['-' if value is None else
+                     '{:.2f}'.format(value) if isinstance(value, float) else str(value)
+                     for value in row.values()])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+                     for row in rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a trace of the input preparation.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    summarize_parser = subparsers.add_parser('summarize', help='Aggregate the trace records.')
+    summarize_parser.add_argument('trace_file_path', help='The JSONL trace file.')
+    summarize_parser.add_argument('--by', nargs='+', dest='group_by', default=['stage'],
+                                  help='The fields defining the groups (default is stage).')
+    args = parser.parse_args()
+
+    print(format_summary(summarize(read_trace(args.trace_file_path), group_by=args.group_by)))
@@ -1,5 +1,10 @@
-import tempfile, os, subprocess, re
+import tempfile, os, shutil, subprocess, re, json, time, asyncio, contextlib, logging, logging.handlers
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import rename 
+import instrumentation
+from pipeline import hash_file, hash_parameters
 
 """
 Calculation of residue pKa and likely protonation states using the MCCE (multiconformer continuum electrostatics) package.
@@ -234,29 +239,367 @@ def write_paramfile(mcceparams, filename):
     # Close the MCCE parameter file.
     runfile.close()
         
-def run_mcce(mcceparams):
+# Progress of an MCCE run: step number, description of the step as printed by MCCE, and seconds since the start.
+MCCEProgress = namedtuple('MCCEProgress', ['step', 'description', 'elapsed'])
+
+# MCCE announces each step with a line such as "Step 3. Compute energy lookup table".
+MCCE_STEP_PATTERN = re.compile(r'^\s*Step\s+(\d+)\.\s*(.*?)\s*$')
+
+def print_progress(progress):
+    """Default progress callback of run_mcce: print the step being run."""
+    print("MCCE step %d: %s (%.0fs elapsed)" % progress)
+
+class MCCEOutputMonitor(object):
+    """Consume the stdout of MCCE line by line.
+
+    Each line is written to a rotating log file, step markers are reported to a progress callback,
+    and only the last lines are kept in memory, so that the memory used does not grow with the output.
+
+    ARGUMENTS
+        logpath - path of the log file
+        progress - function called with an MCCEProgress at the start of each MCCE step (default is print_progress)
+        tailsize - number of output lines kept in memory
+        logmaxbytes - size in bytes at which the log file is rotated
+        logbackups - number of rotated log files kept
+    """
+
+    def __init__(self, logpath, progress=print_progress, tailsize=100, logmaxbytes=2**24, logbackups=3):
+        self.logpath = logpath
+        self.progress = progress
+        self.tail = deque(maxlen=tailsize)
+        self.starttime = time.time()
+        self.nsteps = 0
+        self.returncode = None
+        self.output = None
+
+        # Each run writes to its own handler so that the output of concurrent runs is not mixed up.
+        self.handler = logging.handlers.RotatingFileHandler(logpath, maxBytes=logmaxbytes, backupCount=logbackups)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def feed(self, line):
+        """Process a line of output."""
+        line = line.rstrip('\n')
+        self.handler.handle(logging.makeLogRecord({'msg': line, 'levelno': logging.INFO, 'levelname': 'INFO'}))
+        self.tail.append(line)
+        match = MCCE_STEP_PATTERN.match(line)
+        if match:
+            self.nsteps += 1
+        if match and self.progress is not None:
+            self.progress(MCCEProgress(int(match.group(1)), match.group(2), time.time() - self.starttime))
+
+    def close(self):
+        """Close the log file and return the last lines of output."""
+        if self.output is None:
+            self.handler.close()
+            self.output = '\n'.join(self.tail)
+        return self.output
+
+@contextlib.contextmanager
+def _mcce_run(mcceparams, workdir, logpath, progress, tailsize, system):
+    """Setup and teardown shared by run_mcce and run_mcce_async.
+
+    Writes run.prm, traces the run, and yields (mcce_exe, workdir, monitor). The block runs MCCE, feeds
+    its output to the monitor and sets monitor.returncode. A nonzero exit code raises a RuntimeError
+    with the last lines of output.
+    """
+
+    if workdir is None:
+        workdir = os.getcwd()
+    if logpath is None:
+        logpath = os.path.join(workdir, 'mcce.out')
+    write_paramfile(mcceparams, os.path.join(workdir, 'run.prm'))
+    mcce_exe = os.path.join(mcceparams['MCCE_HOME'], 'bin/mcce')
+
+    # The system is not stored in the environment, which is shared by the concurrent run_mcce_async coroutines.
+    with instrumentation.stage('mcce-run', system=system, set_environment=False,
+                               workdir=workdir, pH=mcceparams.get('TITR_PH0')) as record:
+        monitor = MCCEOutputMonitor(logpath, progress=progress, tailsize=tailsize)
+        try:
+            yield mcce_exe, workdir, monitor
+        finally:
+            monitor.close()
+            record['n_items'] = monitor.nsteps
+        if monitor.returncode != 0:
+            raise RuntimeError("MCCE exited with code %s in %s. Last lines of output:\n%s"
+                               % (monitor.returncode, workdir, monitor.output))
+
+def run_mcce(mcceparams, workdir=None, logpath=None, progress=print_progress, tailsize=100, system=None):
     """Run MCCE executable using specified parameter dictionary.
     
     ARGUMENTS
         mcceparams - Dictionary of MCCE parameters
+
+    OPTIONAL ARGUMENTS
+        workdir - Directory in which MCCE is run (default is the current working directory)
+        logpath - Rotating log file where the MCCE output is streamed (default is mcce.out in workdir)
+        progress - Function called with an MCCEProgress at the start of each MCCE step (default prints the step)
+        tailsize - Number of lines of output returned
+        system - System name traced with the run (default is the system of the enclosing stage)
     
     RETURNS 
-        output - stdout capture from MCCE run
+        output - last tailsize lines of stdout capture from MCCE run
         
-    Runs MCCE in the current working directory, using run parameters given in variable mcceparams (from the paramgen function).
-    This method will clobber file run.prm in the current directory, as well as any previous MCCE output files.
+    Runs MCCE in workdir, using run parameters given in variable mcceparams (from the paramgen function).
+    This method will clobber file run.prm in workdir, as well as any previous MCCE output files.
     It will generate all sorts of output files, which it is the caller's responsibility to clean up.
+    The working directory of the calling process is never changed so that multiple MCCE runs can be
+    executed concurrently in different directories. The output is streamed to the log file while MCCE
+    runs, so the whole output is never held in memory.
+    A RuntimeError with the last lines of output is raised if MCCE exits with a nonzero code.
+
+    If tracing is enabled (see instrumentation.py), the run is recorded as the stage mcce-run with the
+    number of MCCE steps as item count and the CPU time of MCCE as children CPU time.
     """
-        
-    os.chdir(os.getcwd())
-    write_paramfile(mcceparams, 'run.prm')
-    output = subprocess.getoutput( os.path.join(mcceparams['MCCE_HOME'],'bin/mcce') )
 
-    return output
+    with _mcce_run(mcceparams, workdir, logpath, progress, tailsize, system) as (mcce_exe, workdir, monitor):
+        process = subprocess.Popen([mcce_exe], cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        try:
+            for line in process.stdout:
+                monitor.feed(line)
+            monitor.returncode = process.wait()
+        finally:
+            # Do not leave MCCE running if we are interrupted.
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+    return monitor.output
+
+async def run_mcce_async(mcceparams, workdir=None, logpath=None, progress=print_progress, tailsize=100,
+                         system=None):
+    """Coroutine version of run_mcce.
+
+    Several MCCE runs (in different working directories) can be monitored from a single thread, e.g.
+        asyncio.get_event_loop().run_until_complete(asyncio.gather(*[run_mcce_async(params, workdir=d) for d in dirs]))
+
+    See run_mcce for the arguments. The CPU times traced for concurrent runs overlap since the children
+    CPU time of the process is updated only when each MCCE process terminates.
+    """
+
+    with _mcce_run(mcceparams, workdir, logpath, progress, tailsize, system) as (mcce_exe, workdir, monitor):
+        process = await asyncio.create_subprocess_exec(mcce_exe, cwd=workdir, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT)
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                monitor.feed(line.decode(errors='replace'))
+            monitor.returncode = await process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+    return monitor.output
     
+def read_fort38(fort38file):
+    """Load the conformer occupancies in a fort.38 file produced by MCCE into a NumPy record array.
+
+    The file is parsed in a single pass. Each conformer ID (e.g. GLU-1A0035_002) is split into its
+    fixed-width fields.
+
+    ARGUMENTS
+        fort38file - path to the fort.38 file
+
+    RETURNS
+        titrationpoints - array with the pH (or Eh) values in the header of the file
+        conformers - record array with one record per conformer and fields
+                     confid (full conformer ID), resname, charge ('0', '+' or '-' for most residues),
+                     chain, resnum (int), confname (chain + residue number + conformer number, e.g. A0035_002)
+                     and occupancy (array with one value per titration point)
+    """
+
+    f=open(fort38file,"rt")
+    lines=f.read().splitlines()
+    f.close()
+
+    titrationpoints = np.array(lines[0].split()[1:], dtype=float)
+    lines = [line for line in lines[1:] if line.strip() != '']
+    nconformers = len(lines)
+
+    # Split the fixed-width conformer IDs into columns of characters.
+    confids = np.array([line[0:14] for line in lines], dtype='U14')
+    chars = confids.view('U1').reshape(nconformers, 14)
+    def column(start, stop):
+        return np.ascontiguousarray(chars[:,start:stop]).view('U%d' % (stop-start)).ravel()
+
+    occupancy = np.array(' '.join([line[14:] for line in lines]).split(), dtype=float)
+    occupancy = occupancy.reshape(nconformers, -1)
+
+    conformers = np.rec.fromarrays(
+        [confids, column(0,3), column(3,4), column(5,6), column(6,10).astype(int), column(5,14), occupancy],
+        dtype=[('confid','U14'), ('resname','U3'), ('charge','U1'), ('chain','U1'), ('resnum',int),
+               ('confname','U9'), ('occupancy',float,(occupancy.shape[1],))])
+    return titrationpoints, conformers
+
+def mostlikely_conformers(conformers, manualProtonation={}, titrationindex=0):
+    """Select the most likely conformer of each residue.
+
+    Consecutive conformers with the same residue name and number belong to the same residue. For each
+    residue, the conformer with the highest occupancy is selected (the first one in case of ties).
+
+    ARGUMENTS
+        conformers - record array of conformers returned by read_fort38
+        manualProtonation - Manually specify protonation state of particular residues numbers (see protonatePDB).
+        titrationindex - index of the titration point (i.e. column of fort.38) to use (default 0)
+
+    RETURNS
+        selected - the records of the most likely conformers
+    """
+
+    groupstarts, groupids = group_residues(conformers)
+    occupancy = conformers.occupancy[:,titrationindex]
+    return conformers[_mostlikely_indices(conformers, occupancy, groupstarts, groupids, manualProtonation)]
+
+def group_residues(conformers):
+    """Group consecutive conformers with the same residue name and number into residues.
+
+    ARGUMENTS
+        conformers - record array of conformers returned by read_fort38
+
+    RETURNS
+        groupstarts - index of the first conformer of each residue
+        groupids - index of the residue of each conformer
+    """
+
+    residueids = np.char.add(conformers.resname, conformers.confname.astype('U5'))
+    isfirst = np.ones(len(conformers), dtype=bool)
+    isfirst[1:] = residueids[1:] != residueids[:-1]
+    return np.flatnonzero(isfirst), np.cumsum(isfirst) - 1
+
+def _mostlikely_indices(conformers, occupancy, groupstarts, groupids, manualProtonation={}):
+    """Return the index of the first conformer with the highest occupancy of each residue."""
+
+    # Conformers in the manually specified protonation state get a bonus occupancy.
+    occupancy = occupancy.copy()
+    for resnum, charge in manualProtonation.items():
+        occupancy[(conformers.resnum == resnum) & (conformers.charge == charge)] += 1.0
+
+    nconformers = len(conformers)
+    groupmax = np.maximum.reduceat(occupancy, groupstarts)
+    indices = np.where(occupancy == groupmax[groupids], np.arange(nconformers), nconformers)
+    return np.minimum.reduceat(indices, groupstarts)
+
+def conformer_labels(conformers):
+    """Map the conformer names used in step2_out.pdb to their charge states.
+
+    ARGUMENTS
+        conformers - record array of conformers (see read_fort38)
+
+    RETURNS
+        labels - dictionary mapping e.g. 'GLU A0035_002' (residue name and conformer name as they appear
+                 in columns 17-29 of step2_out.pdb) to the charge state character ('0', '+', or '-')
+    """
+
+    keys = np.char.add(np.char.add(conformers.resname, ' '), conformers.confname)
+    return dict(zip(keys.tolist(), conformers.charge.tolist()))
+
+# Net charge of the conformers by charge state character.
+CONFORMER_CHARGES = {'+': 1.0, '-': -1.0}
+
+class TitrationResult(object):
+    """Protonation states of the residues over the pH grid of a MCCE titration.
+
+    A single titration can be used to obtain the most likely protonation state at any pH within its grid
+    (see state_at and pdbarr_at) instead of running MCCE at each pH.
+
+    ARGUMENTS
+        pHs - array with the pH values of the titration (i.e. titrationpoints returned by read_fort38)
+        conformers - record array of conformers returned by read_fort38
+        step2lines - optional list of lines of step2_out.pdb, required by pdbarr_at
+
+    ATTRIBUTES
+        residues - record array with one record per residue and fields resname, chain, resnum and residueid
+                   (e.g. 'GLUA0035')
+        charge - array of shape (nresidues, npHs) with the average net charge of each residue at each pH
+        protonated - array of shape (nresidues, npHs) with the occupancy of the protonated state of each
+                     residue (the fraction of the residue with a charge above the lowest charge state)
+        titratable - boolean array with True for the residues that have more than one charge state
+        pKas - pKa of each residue obtained by fitting the Hill equation to the protonated occupancies,
+               or NaN if the residue does not titrate within the pH grid
+        hillcoefficients - fitted Hill coefficient of each residue (NaN if the pKa is not defined)
+    """
+
+    def __init__(self, pHs, conformers, step2lines=None):
+        self.pHs = np.asarray(pHs, dtype=float)
+        self.conformers = conformers
+        self.step2lines = step2lines
+        self._groupstarts, self._groupids = group_residues(conformers)
+
+        first = conformers[self._groupstarts]
+        self.residues = np.rec.fromarrays(
+            [first.resname, first.chain, first.resnum, np.char.add(first.resname, first.confname.astype('U5'))],
+            dtype=[('resname','U3'), ('chain','U1'), ('resnum',int), ('residueid','U8')])
+
+        charges = np.zeros(len(conformers))
+        for charge, value in CONFORMER_CHARGES.items():
+            charges[conformers.charge == charge] = value
+        self.charge = np.add.reduceat(conformers.occupancy * charges[:,np.newaxis], self._groupstarts, axis=0)
+        mincharge = np.minimum.reduceat(charges, self._groupstarts)
+        self.titratable = np.maximum.reduceat(charges, self._groupstarts) > mincharge
+        self.protonated = self.charge - mincharge[:,np.newaxis]
+        self.pKas, self.hillcoefficients = self._fit_pkas()
+
+    def _fit_pkas(self, minoccupancy=0.01):
+        """Fit log10((1-p)/p) = n*(pH - pKa) by least squares for all residues at once.
+
+        Only the pH values where the protonated occupancy p is between minoccupancy and 1-minoccupancy
+        are used. If there is a single such point, the Hill coefficient is assumed to be 1.
+        """
+
+        p = np.clip(self.protonated, minoccupancy, 1 - minoccupancy)
+        y = np.log10((1 - p) / p)
+        w = ((self.protonated > minoccupancy) & (self.protonated < 1 - minoccupancy)
+             & self.titratable[:,np.newaxis]).astype(float)
+        x = self.pHs[np.newaxis,:]
+
+        n = w.sum(axis=1)
+        sx, sy = (w*x).sum(axis=1), (w*y).sum(axis=1)
+        sxx, sxy = (w*x*x).sum(axis=1), (w*x*y).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hill = np.where(n >= 2, (n*sxy - sx*sy) / (n*sxx - sx*sx), 1.0)
+            pkas = (sx - sy/hill) / n
+        undefined = (n == 0) | ~np.isfinite(pkas) | (hill == 0)
+        pkas[undefined] = np.nan
+        hill[undefined] = np.nan
+        return pkas, hill
+
+    def occupancy_at(self, pH):
+        """Return the occupancy of each conformer at pH, linearly interpolated between the titration points."""
+
+        pHs = self.pHs
+        if not (pHs[0] - 1e-6 <= pH <= pHs[-1] + 1e-6):
+            raise ValueError('pH %s is outside the titration range %s-%s' % (pH, pHs[0], pHs[-1]))
+        # Use the titration point exactly if pH is on the grid.
+        closest = np.argmin(np.abs(pHs - pH))
+        if abs(pHs[closest] - pH) < 1e-6:
+            return self.conformers.occupancy[:,closest]
+        i = np.searchsorted(pHs, pH) - 1
+        w = (pH - pHs[i]) / (pHs[i+1] - pHs[i])
+        return (1 - w) * self.conformers.occupancy[:,i] + w * self.conformers.occupancy[:,i+1]
+
+    def state_at(self, pH, manualProtonation={}):
+        """Select the most likely conformer of each residue at pH (see mostlikely_conformers)."""
+
+        occupancy = self.occupancy_at(pH)
+        return self.conformers[_mostlikely_indices(self.conformers, occupancy, self._groupstarts,
+                                                   self._groupids, manualProtonation)]
+
+    def pdbarr_at(self, pH, labeledPDBOnly=False, renameTermini=True, manualProtonation={}):
+        """Return the PDB lines in the most likely protonation state at pH, like protonation_state."""
+
+        if self.step2lines is None:
+            raise RuntimeError('The lines of step2_out.pdb are required to generate the PDB.')
+        selected = self.state_at(pH, manualProtonation=manualProtonation)
+        return process_step2_lines(self.step2lines, selected, labeledPDBOnly=labeledPDBOnly,
+                                   renameTermini=renameTermini)
+
 def ps_mostlikely(fort38path,manualProtonation={}):
     """Finds the set of most likely protonation states from the file fort38path/fort.38. Assumes one set of pH values in the given file.
 
+    Kept for backwards compatibility; ps_processmcce uses read_fort38 and mostlikely_conformers directly.
+
     ARGUMENTS
         fort38path - absolute pathname of the directory in which the fort.38 file produced by MCCE appears
         manualProtonation - Manually specify protonation state of particular residues numbers.
@@ -266,67 +609,20 @@ def ps_mostlikely(fort38path,manualProtonation={}):
         poslines - regular expression query string for positive states
         neglines - regular expression query string for negative states
     """
-    
-    f=open(fort38path+"/fort.38","rt")
-    lines=f.readlines()[1:]         #Skip the header
-    lines2=lines[:] # Make a copy of file contents because the extraction procedure will destroy this copy.
-    f.close()
-    stack=[]
+
+    titrationpoints, conformers = read_fort38(os.path.join(fort38path, 'fort.38'))
+    selected = mostlikely_conformers(conformers, manualProtonation=manualProtonation)
+
     # We want any _000 line - they're common to all protonation states
-    searchstring="_000 "
     #DLM 7/1/2009: Insertion codes may result in residues numbered ie A0221A000 rather than A0221_000 so we need to search for these also
-    for char in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
-       searchstring = searchstring+'|'+char+"000 "
-    #end DLM
-
-    # Overview:
-    # Grab a line and compare to the last one.
-    # If it's the same residue, keep the more likely one.
-    # If a new residue, add the stored line to the master "keep" list and store what we just found.
-    while (len(lines)>0):
-        nextline=lines.pop(0)
-        if (len(stack)==0):
-            stack.append(nextline)
-        else:
-            stackline=stack.pop()
-            nextident=nextline[0:3]+nextline[6:10]
-            stackident=stackline[0:3]+stackline[6:10]
-            if (nextident!=stackident):
-                # Add the identifier to the list of atoms to pull
-                searchstring=searchstring+"|"+stackline[0:3]+r" "+stackline[5:15]
-                #print "Keeping "+stackline[0:15]
-                stack.append(nextline)
-            else:
-                # Next option for the same residue
-                stackprob=float(stackline.split(" ")[1])
-                nextprob=float(nextline.split(" ")[1])
-                residuenum=int(stackline[6:10])
-                # Look if this is specified manually.
-                for key in manualProtonation :
-                    if (key == residuenum) :
-                        if (manualProtonation[key] == stackline[3:4]):
-                            stackprob+=1.0
-                        if (manualProtonation[key] == nextline[3:4]):
-                            nextprob+=1.0
-                # Compare probability
-                if (nextprob > stackprob):
-                    stack.append(nextline)
-                else:
-                    stack.append(stackline)
-    # Handle the last element on the stack
-    stackline=stack.pop()
-    searchstring=searchstring+"|"+stackline[0:3]+r" "+stackline[5:15]
-
-    # Generate regular expressions for neutral/pos/neg states based on charge labeling in our duplicate array.
-    # Select the lines for any particular state, then transform each line into a regular expression, then join lines with | operator.
-    neutrallines='_000 |'
-    #DLM 7/1/2009: Insertion codes may result in residues numbered ie A0221A000 rather than A0221_000 so we need to search for these also
-    for char in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
-       neutrallines=neutrallines+char+'000 |'
-    #End DLM
-    neutrallines = neutrallines+("|".join(map(lambda x: x[0:3]+r" "+x[5:15],filter(lambda x:re.search(r'^...0',x),lines2))))
-    poslines = "|".join(map(lambda x: x[0:3]+r" "+x[5:15],filter(lambda x:re.search(r'^...\+',x),lines2)))
-    neglines = "|".join(map(lambda x: x[0:3]+r" "+x[5:15],filter(lambda x:re.search(r'^...-',x),lines2)))
+    backbone = ['_000 '] + [char+'000 ' for char in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ']
+    def regex(records):
+        return [resname+' '+confname+' ' for resname, confname in zip(records.resname, records.confname)]
+
+    searchstring = '|'.join(backbone + regex(selected))
+    neutrallines = '|'.join(backbone + regex(conformers[conformers.charge == '0']))
+    poslines = '|'.join(regex(conformers[conformers.charge == '+']))
+    neglines = '|'.join(regex(conformers[conformers.charge == '-']))
 
     # Return regular expression search strings.
     return (searchstring,neutrallines,poslines,neglines)        
@@ -343,63 +639,150 @@ def renumber_atoms(pdbarr):
         pdbarr[i]=pdbarr[i][0:6]+str(i+1).rjust(5)+pdbarr[i][11:]        
 
 
-def protonation_state(pdbfile, pH, mccepath, cleanup=True, prmfile=None, labeledPDBOnly=False, renameTermini=True, xtraprms={}, manualProtonation={}):
-    """Performs a pH titration on all titratable residues in a PDB file."""
+def write_pdbarr(pdbarr, outpath):
+    """Write a list of PDB lines (without newline characters) to a file.
+
+    ARGUMENTS
+        pdbarr - list of PDB lines, as returned by protonation_state
+        outpath - path of the PDB file to write (overwriting if already exists)
+    """
+
+    fout = open(outpath,'w')
+    for line in pdbarr:
+        fout.write(line+'\n')
+    fout.close()
+
+
+def protonation_state(pdbfile, pH, mccepath, cleanup=True, prmfile=None, labeledPDBOnly=False, renameTermini=True, xtraprms={}, manualProtonation={}, sandboxdir=None, cache=None, progress=print_progress):
+    """Performs a pH titration on all titratable residues in a PDB file.
+
+    MCCE is run in a new temporary directory created inside sandboxdir (or the default temporary directory
+    if None) without changing the current working directory of the process.
+
+    If cache (a pipeline.FileCache) is given, the result is looked up by a hash of the content of the
+    input PDB file, the full MCCE parameter dictionary and the post-processing options, and MCCE is
+    run only if the result is not already cached.
+
+    The MCCE output is streamed to the file mcce.out in the temporary directory, and progress (a function
+    taking an MCCEProgress) is called at the start of each MCCE step (see run_mcce).
+    """
     
     #Convert PDB file name to path, as paramgen expects an absolute path
     pdbpath=os.path.join(os.getcwd(),pdbfile)
     print('pdbpath', pdbpath)
     
     # Set up the parameters for the MCCE run
-    params=paramgen(pdbpath,mccepath, fromfile=None, xtraprms=xtraprms)
-    params['TITR_PH0']=str(pH)
-    params['TITR_PHD']="1.0" #pH titration interval (i.e. stepsize)
-    params['TITR_STEPS']="1"
+    params=protonation_params(pdbpath, pH, mccepath, xtraprms=xtraprms)
+
+    # Return the cached result if this calculation has already been performed.
+    if cache is not None:
+        cachekey = protonation_state_key(pdbpath, params, labeledPDBOnly=labeledPDBOnly,
+                                         renameTermini=renameTermini, manualProtonation=manualProtonation)
+        pdbarr = read_cached_pdbarr(cache, cachekey)
+        if pdbarr is not None:
+            return pdbarr
         
-    # Create a temporary directory with the run.prm file and run MCCE
-    tempdir=tempfile.mkdtemp();
+    # Create a temporary sandbox directory with the run.prm file and run MCCE
+    tempdir=tempfile.mkdtemp(dir=sandboxdir)
 
     print("Running MCCE in temporary directory %s..." % tempdir)
 
-    # remember our current working directory
-    thisdir = '%s'%os.path.abspath(os.getcwd())
-        
-    # run mcce in the temporary directory
-    os.chdir(tempdir)
-    output = run_mcce(params)
-    print(output)
-        
-    # chdir back to where we came from
-    os.chdir(thisdir)
+    # run mcce in the temporary directory without changing our working directory
+    output = run_mcce(params, workdir=tempdir, progress=progress)
 
-    pdbarr = ps_processmcce(tempdir, labeledPDBOnly=labeledPDBOnly, renameTermini=renameTermini, manualProtonation=manualProtonation)
-    print(pdbarr)
+    try:
+        with instrumentation.stage('mcce-process', pH=pH) as record:
+            pdbarr = ps_processmcce(tempdir, labeledPDBOnly=labeledPDBOnly, renameTermini=renameTermini, manualProtonation=manualProtonation)
+            record['n_items'] = len(pdbarr)
+    except Exception:
+        # Show the end of the MCCE output to help diagnose the failure.
+        print(output)
+        raise
 
     # Generate a breakpoint for interactive testing...
     #       raw_input("about to clean house...")
     
-    # clean up the temp dir
-    # In the OLD version of MMCE: There should only be files, no subdirs --Imran(?)
-    # BUT, in mcce2.2:            There is an "energies" subdir -- added lines to remove these --vv
+    # clean up the temp dir (in mcce2.2 this includes the "energies" subdir)
     if (cleanup):
-        cwd = os.getcwd()
-        os.chdir(tempdir)
-        for i in os.listdir(tempdir):
-            thisdir = os.path.join(tempdir,i) 
-            if os.path.isdir(thisdir):
-                for j in os.listdir(thisdir):
-                    os.unlink(os.path.join(thisdir,j))
-                os.rmdir(thisdir) 
-            else:
-                print('removing', i, '...')
-                os.unlink(thisdir)
-        os.chdir(cwd)
-        os.rmdir(tempdir)
+        shutil.rmtree(tempdir)
+
+    if cache is not None:
+        write_cached_pdbarr(cache, cachekey, pdbarr)
         
     return pdbarr
 
-def titrate(pdbfile, pHstart, pHstep, pHiters, mccepath, cleanup=True, prmfile=None, xtraprms={}):
-    """Performs a pH titration on all titratable residues in a PDB file."""
+def protonation_params(pdbpath, pH, mccepath, xtraprms={}):
+    """Generate the dictionary of MCCE parameters to determine the protonation state at a single pH.
+
+    ARGUMENTS
+        pdbpath - absolute path to the input PDB file
+        pH - solvent pH at which to determine protonation state
+        mccepath - the base directory in which MCCE is installed
+
+    OPTIONAL ARGUMENTS
+        xtraprms - any additional MCCE parameters (see paramgen)
+
+    RETURNS
+        A dictionary of MCCE parameters
+    """
+
+    params=paramgen(pdbpath,mccepath, fromfile=None, xtraprms=xtraprms)
+    params['TITR_PH0']=str(pH)
+    params['TITR_PHD']="1.0" #pH titration interval (i.e. stepsize)
+    params['TITR_STEPS']="1"
+    return params
+
+def read_cached_pdbarr(cache, cachekey):
+    """Return the cached list of PDB lines or None if not cached.
+
+    Lines are stored as JSON since labeled lines may contain newline characters.
+    """
+
+    cachedpath = cache.get(cachekey)
+    if cachedpath is None:
+        return None
+    print("Found cached MCCE result %s" % cachedpath)
+    fin = open(cachedpath,'r')
+    pdbarr = json.load(fin)
+    fin.close()
+    return pdbarr
+
+def write_cached_pdbarr(cache, cachekey, pdbarr):
+    """Store a list of PDB lines in the cache (see read_cached_pdbarr)."""
+
+    def writecache(path):
+        fout = open(path,'w')
+        json.dump(pdbarr, fout)
+        fout.close()
+    cache.put(cachekey, writecache)
+
+# Increment this when the processing of the MCCE output changes to invalidate the cached protonation states.
+PROTONATION_STATE_VERSION = 1
+
+def protonation_state_key(pdbpath, mcceparams, **options):
+    """Return the hash identifying the result of an MCCE protonation calculation.
+
+    ARGUMENTS
+        pdbpath - path to the input PDB file; its content, not its path, is hashed
+        mcceparams - dictionary of MCCE parameters (from the paramgen function)
+        options - any other option affecting the result (e.g. labeledPDBOnly, renameTermini, manualProtonation)
+
+    RETURNS
+        key - hexadecimal SHA256 digest
+    """
+
+    params = dict(mcceparams)
+    del params['INPDB']
+    return hash_parameters({'version': PROTONATION_STATE_VERSION, 'pdb': hash_file(pdbpath), 'params': params,
+                            'options': options})
+
+def titrate(pdbfile, pHstart, pHstep, pHiters, mccepath, cleanup=True, prmfile=None, xtraprms={}, sandboxdir=None, progress=print_progress, processor=None):
+    """Performs a pH titration on all titratable residues in a PDB file.
+
+    By default, returns the concatenated lines of pK.out and fort.38 (see ps_processMCCETitration).
+    If processor is given, it is called with the MCCE directory and its result is returned instead
+    (e.g. processor=read_titration returns a TitrationResult).
+    """
     
     #Convert PDB file name to path, as paramgen expects an absolute path
     pdbpath=os.path.join(os.getcwd(),pdbfile)
@@ -413,44 +796,30 @@ def titrate(pdbfile, pHstart, pHstep, pHiters, mccepath, cleanup=True, prmfile=N
     params['TITR_PHD']=str(pHstep)
     params['TITR_STEPS']=str(pHiters)
 
-    # Create a temporary directory with the run.prm file and run MCCE
-    tempdir=tempfile.mkdtemp();
+    # Create a temporary sandbox directory with the run.prm file and run MCCE
+    tempdir=tempfile.mkdtemp(dir=sandboxdir)
     print("Running MCCE in temporary directory %s..." % tempdir)
 
-    # remember our curent working directory
-    thisdir = os.getcwd()
-        
-    # run mcce in the temporary directory
-    os.chdir(tempdir)
-    output = run_mcce(params)
-    print(output)
-
-    # chdir back to where we came from
-    os.chdir(thisdir)
+    # run mcce in the temporary directory without changing our working directory
+    output = run_mcce(params, workdir=tempdir, progress=progress)
     
     # Read data from the temporary directory.
-    pdbarr = ps_processMCCETitration(tempdir)
+    if processor is None:
+        processor = ps_processMCCETitration
+    try:
+        pdbarr = processor(tempdir)
+    except Exception:
+        # Show the end of the MCCE output to help diagnose the failure.
+        print(output)
+        raise
     
-    # clean up the temp dir
-    # In the OLD version of MMCE: There should only be files, no subdirs --Imran(?)
-    # BUT, in mcce2.2:            There is an "energies" subdir -- added lines to remove these --vv
+    # clean up the temp dir (in mcce2.2 this includes the "energies" subdir)
     if (cleanup):
-        # Remove contents of temporary directory.
-        for i in os.listdir(tempdir):
-            thisdir = os.path.join(tempdir,i) 
-            if os.path.isdir(thisdir):
-                for j in os.listdir(thisdir):
-                    os.unlink(os.path.join(thisdir,j))
-                    os.rmdir(thisdir) 
-            else:
-                print('removing', i, '...')
-                os.unlink(thisdir)
-        # Delete the temporary directory.
-        os.rmdir(tempdir)
+        shutil.rmtree(tempdir)
         
     return pdbarr
 
-def protonatePDB(pdbfile, outfile, pH, mccepath, cleanup=True, prmfile=None, labeledPDBOnly=False, renameTermini=True, xtraprms={}, manualProtonation={}):
+def protonatePDB(pdbfile, outfile, pH, mccepath, cleanup=True, prmfile=None, labeledPDBOnly=False, renameTermini=True, xtraprms={}, manualProtonation={}, cache=None):
     """Determine the most likely protonation state for a given protein structure and writes it out using AMBER residue naming terminology.
 
     REQUIRED ARGUMENTS
@@ -469,23 +838,14 @@ def protonatePDB(pdbfile, outfile, pH, mccepath, cleanup=True, prmfile=None, lab
                           These are specified as a dictionary, e.g.: {82:'+', 87:'0',43:'-'} (residue number:protonation state)
                           Note that MCCE considers protonation state of residues independently, 
                           so one should think carefully whether this option affects protonation state of surrounding residues.
+        cache             If given, a pipeline.FileCache used to store and reuse the results of identical MCCE calculations.
     """
 
-    # Store current working directory.
-    thisdir = os.getcwd()
-    
     # Determine most likely protonation state, storing result in 'pdbarr'.
-    pdbarr = protonation_state(pdbfile,pH,mccepath,cleanup=cleanup, prmfile=prmfile, labeledPDBOnly=labeledPDBOnly, renameTermini=renameTermini, xtraprms=xtraprms, manualProtonation=manualProtonation)
+    pdbarr = protonation_state(pdbfile,pH,mccepath,cleanup=cleanup, prmfile=prmfile, labeledPDBOnly=labeledPDBOnly, renameTermini=renameTermini, xtraprms=xtraprms, manualProtonation=manualProtonation, cache=cache)
     
     # Write PDB file name to absolute path
-    outpath=os.path.join(thisdir,outfile)
-    fout = open(outpath,'w')
-    for line in pdbarr:
-        fout.write(line+'\n')
-    fout.close()       
-
-    # return from the directory we came from
-    os.chdir(thisdir)
+    write_pdbarr(pdbarr, os.path.abspath(outfile))
     
     return
         
@@ -519,6 +879,187 @@ def titratePDB(pdbfile, outfile, pHstart, pHstep, pHiters, mccepath, cleanup=Tru
         
     return
 
+def _protonation_state_job(job):
+    """Run protonation_state with the keyword arguments in job. Executed by the worker processes."""
+    return protonation_state(**job)
+
+def protonation_states(jobs, mccepath, max_workers=None, sandboxdir=None, **kwargs):
+    """Determine the most likely protonation states of several structures concurrently.
+
+    Each MCCE calculation runs on a pool of worker processes in its own sandbox directory,
+    and the working directory of the calling process is never changed.
+
+    REQUIRED ARGUMENTS
+        jobs              List of (pdbfile, pH) pairs to protonate.
+        mccepath          Path to MCCE executable.
+
+    OPTIONAL ARGUMENTS
+        max_workers       Maximum number of MCCE calculations running at the same time (default is the number of CPUs).
+        sandboxdir        Directory in which the temporary directories of the jobs are created.
+        Any other keyword argument is passed to protonation_state (e.g. cleanup, xtraprms, manualProtonation).
+
+    RETURNS
+        A generator yielding ((pdbfile, pH), pdbarr) pairs in the order in which the jobs complete.
+    """
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for pdbfile, pH in jobs:
+            job = dict(kwargs, pdbfile=os.path.abspath(pdbfile), pH=pH,
+                       mccepath=mccepath, sandboxdir=sandboxdir)
+            futures[executor.submit(_protonation_state_job, job)] = (pdbfile, pH)
+
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+# Parameters that affect only MCCE step 4 (Monte Carlo sampling of the protonation states).
+MONTE_CARLO_PARAMS_PREFIXES = ('DO_', 'TITR_', 'MONTE_', 'NSTATE_MAX')
+
+def energies_key(pdbpath, mcceparams):
+    """Return the hash identifying the pH-independent output of MCCE steps 1-3.
+
+    ARGUMENTS
+        pdbpath - path to the input PDB file; its content, not its path, is hashed
+        mcceparams - dictionary of MCCE parameters; those affecting only step 4 are ignored
+
+    RETURNS
+        key - hexadecimal SHA256 digest
+    """
+
+    params = {key: value for key, value in mcceparams.items()
+              if key != 'INPDB' and not key.startswith(MONTE_CARLO_PARAMS_PREFIXES)}
+    return hash_parameters({'pdb': hash_file(pdbpath), 'params': params})
+
+def titration_protonation_states(pdbfile, pHs, mccepath, pHstep=0.05, cleanup=True, labeledPDBOnly=False, renameTermini=True, xtraprms={}, manualProtonation={}, sandboxdir=None, progress=print_progress):
+    """Determine the most likely protonation states at several pH values from a single MCCE titration.
+
+    The titration covers the range of pHs in steps of pHstep. Unlike staged_protonation_states, the Monte
+    Carlo sampling is run once for all pH values, and the occupancies at the pHs that are not on the
+    titration grid are interpolated between the two closest titration points.
+
+    REQUIRED ARGUMENTS
+        pdbfile           The path to the PDB file used as input for MCCE.
+        pHs               List of solvent pH values at which to determine protonation states.
+        mccepath          Path to MCCE executable.
+
+    OPTIONAL ARGUMENTS
+        pHstep            The pH interval between the titration points.
+        See protonatePDB for the other arguments.
+
+    RETURNS
+        titration         The TitrationResult.
+        pdbarrs           A dictionary mapping each pH to the list of PDB lines in the most likely protonation state.
+    """
+
+    pHstart = min(pHs)
+    pHiters = int(np.ceil((max(pHs) - pHstart) / pHstep - 1e-6)) + 1
+    with instrumentation.stage('mcce-titration', pHs=list(pHs)) as record:
+        titration = titrate(pdbfile, pHstart, pHstep, pHiters, mccepath, cleanup=cleanup, xtraprms=xtraprms,
+                            sandboxdir=sandboxdir, progress=progress, processor=read_titration)
+        record['n_items'] = len(pHs)
+
+    pdbarrs = {}
+    for pH in pHs:
+        pdbarrs[pH] = titration.pdbarr_at(pH, labeledPDBOnly=labeledPDBOnly, renameTermini=renameTermini,
+                                          manualProtonation=manualProtonation)
+    return titration, pdbarrs
+
+def staged_protonation_states(pdbfile, pHs, mccepath, workdir=None, cleanup=True, labeledPDBOnly=False, renameTermini=True, xtraprms={}, manualProtonation={}, sandboxdir=None, cache=None, progress=print_progress):
+    """Determine the most likely protonation states of a structure at several pH values.
+
+    Only the Monte Carlo sampling (MCCE step 4) depends on pH. Steps 1-3 (structure preparation,
+    conformer generation and pairwise energy tables) are run once, and their output is kept in
+    workdir, where step 4 is repeated for each pH. If workdir already contains the output of
+    steps 1-3 for the same structure and parameters, these are not run again, so adding a pH
+    point to a previous calculation costs only a Monte Carlo run.
+
+    REQUIRED ARGUMENTS
+        pdbfile           The path to the PDB file used as input for MCCE.
+        pHs               List of solvent pH values at which to determine protonation states.
+        mccepath          Path to MCCE executable.
+
+    OPTIONAL ARGUMENTS
+        workdir           Directory where MCCE steps 1-3 output is kept. If None, a temporary directory is
+                          created inside sandboxdir and, if cleanup=True, deleted at the end.
+        cache             If given, a pipeline.FileCache shared with protonation_state.
+        progress          Function called with an MCCEProgress at the start of each MCCE step (see run_mcce).
+        See protonatePDB for the other arguments.
+
+    RETURNS
+        A dictionary mapping each pH to the list of PDB lines in the most likely protonation state.
+    """
+
+    #Convert PDB file name to path, as paramgen expects an absolute path
+    pdbpath=os.path.abspath(pdbfile)
+    postoptions = dict(labeledPDBOnly=labeledPDBOnly, renameTermini=renameTermini, manualProtonation=manualProtonation)
+
+    # Resolve the calculations that have been already cached.
+    pdbarrs = {}
+    cachekeys = {}
+    for pH in pHs:
+        if cache is not None:
+            params = protonation_params(pdbpath, pH, mccepath, xtraprms=xtraprms)
+            cachekeys[pH] = protonation_state_key(pdbpath, params, **postoptions)
+            pdbarr = read_cached_pdbarr(cache, cachekeys[pH])
+            if pdbarr is not None:
+                pdbarrs[pH] = pdbarr
+    missingpHs = [pH for pH in pHs if pH not in pdbarrs]
+    if len(missingpHs) == 0:
+        return pdbarrs
+
+    # Set up the working directory.
+    istemporary = workdir is None
+    if istemporary:
+        workdir = tempfile.mkdtemp(dir=sandboxdir)
+    else:
+        os.makedirs(workdir, exist_ok=True)
+    keypath = os.path.join(workdir, 'energies.key')
+
+    # Run steps 1-3 only if their output for this structure and parameters is not in workdir.
+    params = protonation_params(pdbpath, missingpHs[0], mccepath, xtraprms=xtraprms)
+    stepskey = energies_key(pdbpath, params)
+    try:
+        fin = open(keypath,'r')
+        hasenergies = fin.read().strip() == stepskey
+        fin.close()
+    except IOError:
+        hasenergies = False
+    if not hasenergies:
+        print("Running MCCE steps 1-3 in directory %s..." % workdir)
+        params['DO_MONTE'] = 'f'
+        output = run_mcce(params, workdir=workdir, progress=progress)
+        # head3.lst is the conformer list written by step 3.
+        if not os.path.exists(os.path.join(workdir, 'head3.lst')):
+            print(output)
+            raise RuntimeError('MCCE steps 1-3 failed in %s' % workdir)
+        fout = open(keypath,'w')
+        fout.write(stepskey)
+        fout.close()
+
+    # Run only step 4 for each pH.
+    for pH in missingpHs:
+        print("Running MCCE step 4 at pH %s in directory %s..." % (pH, workdir))
+        params = protonation_params(pdbpath, pH, mccepath, xtraprms=xtraprms)
+        params['DO_PREMCCE'] = 'f'
+        params['DO_ROTAMERS'] = 'f'
+        params['DO_ENERGY'] = 'f'
+        params['DO_MONTE'] = 't'
+        output = run_mcce(params, workdir=workdir, progress=progress)
+        try:
+            with instrumentation.stage('mcce-process', pH=pH) as record:
+                pdbarrs[pH] = ps_processmcce(workdir, **postoptions)
+                record['n_items'] = len(pdbarrs[pH])
+        except Exception:
+            print(output)
+            raise
+        if cache is not None:
+            write_cached_pdbarr(cache, cachekeys[pH], pdbarrs[pH])
+
+    if istemporary and cleanup:
+        shutil.rmtree(workdir)
+
+    return pdbarrs
+
 def ps_processmcce(tempdir, labeledPDBOnly=False, renameTermini=True, manualProtonation={}, verbose = False):
     """Handles the file processing work for protonation_state
     
@@ -527,33 +1068,44 @@ def ps_processmcce(tempdir, labeledPDBOnly=False, renameTermini=True, manualProt
 
     """
 
-    # Build and use a regex to grab the appropriate entries from the MCCE PDB
-    sstr,neut,pos,neg=ps_mostlikely(tempdir,manualProtonation=manualProtonation)
-    rx=re.compile(sstr)
+    # Select the most likely conformers and map their names to charge states.
+    titrationpoints, conformers = read_fort38(os.path.join(tempdir, 'fort.38'))
+    selected = mostlikely_conformers(conformers, manualProtonation=manualProtonation)
     if verbose:
-        print("searchstring: \"", sstr)
-        print("neut: \"", neut)
-        print("pos: \"", pos)
-        print("neg: \"", neg)
+        print("most likely conformers:", ' '.join(selected.confid))
+
     f=open(tempdir+"/step2_out.pdb","rt")
-    pdbarr=list(filter(lambda x:rx.search(x),f.readlines()))
+    pdbarr = process_step2_lines(f, selected, labeledPDBOnly=labeledPDBOnly, renameTermini=renameTermini)
     f.close()
-        
-        
-    # Label the lines of the PDB file with charge state
-    rxn=re.compile(neut)
-    rxp=re.compile(pos)
-    rxm=re.compile(neg)
-    for i in range(len(pdbarr)):
-        if (rxn.search(pdbarr[i])):
-            pdbarr[i]=pdbarr[i]+"0"
-        elif (rxp.search(pdbarr[i])):
-            pdbarr[i]=pdbarr[i]+"+"
-        elif (rxm.search(pdbarr[i])):
-            pdbarr[i]=pdbarr[i]+"-"
+    return pdbarr
+
+def process_step2_lines(step2lines, selected, labeledPDBOnly=False, renameTermini=True):
+    """Build the PDB lines of a protonation state from the lines of step2_out.pdb.
+
+    ARGUMENTS
+        step2lines - iterable over the lines of step2_out.pdb
+        selected - record array of the selected conformers (see mostlikely_conformers)
+        labeledPDBOnly - if True, return the lines labeled with the charge state without renaming the residues
+        renameTermini - passed to rename.rename_residues
+    """
+
+    labels = conformer_labels(selected)
+
+    # Grab the backbone (conformer 000, common to all protonation states) and the most likely conformers
+    # from the MCCE PDB, and label the lines of the PDB file with charge state.
+    pdbarr = []
+    for line in step2lines:
+        #DLM 7/1/2009: Insertion codes may result in residues numbered ie A0221A000 rather than A0221_000
+        if line[27:30] == '000' and (line[26] == '_' or line[26].isupper()):
+            label = '0'
         else:
+            label = labels.get(line[17:30])
+            if label is None:
+                continue
+        if label not in ('0', '+', '-'):
             print("ERROR!")
             raise RuntimeError("Missed a case in charge state labeling")
+        pdbarr.append(line+label)
         
     renumber_atoms(pdbarr)
 
@@ -587,3 +1139,20 @@ def ps_processMCCETitration(tempdir):
     return lines
             
             
+
+def read_titration(tempdir):
+    """Read the output of a MCCE titration into a TitrationResult.
+
+    ARGUMENTS
+        tempdir - the directory in which MCCE had been run
+
+    RETURNS
+        titration - TitrationResult with the lines of step2_out.pdb, so that it can generate the PDB
+                    at any pH after tempdir has been deleted
+    """
+
+    titrationpoints, conformers = read_fort38(os.path.join(tempdir, 'fort.38'))
+    f=open(os.path.join(tempdir, 'step2_out.pdb'),'rt')
+    step2lines = f.readlines()
+    f.close()
+    return TitrationResult(titrationpoints, conformers, step2lines=step2lines)
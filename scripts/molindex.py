@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Byte-offset index of multi-molecule mol2 and SDF files.
+
+The first time a multi-molecule file is opened, it is scanned once to
+record the byte offset, length, name, and number of atoms of each
+molecule. The index is saved in a sidecar JSON file next to the original
+so that, afterwards, any molecule can be read by seeking directly to its
+record without parsing the rest of the file. The sidecar is rebuilt when
+the size of the file changes or its modification time changes and its
+content hash doesn't match anymore.
+
+Run ``python molindex.py FILE`` to list the molecules in a file, or
+``python molindex.py FILE --select 4 5 --output OUTPUT`` to extract the
+molecules 4 and 5 into a new file.
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import json
+import argparse
+from collections import namedtuple
+
+from pipeline import hash_file
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+INDEX_FILE_SUFFIX = '.index.json'
+
+# Increment this when the format of the sidecar changes.
+_INDEX_VERSION = 1
+
+_MOL2_EXTENSIONS = ('.mol2',)
+_SDF_EXTENSIONS = ('.sdf', '.sd', '.mol')
+
+
+# =============================================================================
+# PARSERS
+# =============================================================================
+
+MoleculeEntry = namedtuple('MoleculeEntry', ['name', 'offset', 'length', 'n_atoms'])
+MoleculeEntry.__doc__ = """A molecule record in a multi-molecule file.
+
+The record of the molecule spans the bytes [offset, offset+length)."""
+
+
+def _scan_mol2(f):
+    """Yield the MoleculeEntry of each molecule in a mol2 file opened in binary mode."""
+    entry = None  # [name, offset, n_atoms] of the current molecule.
+    line_in_record = 0
+    offset = 0
+    for line in f:
+        if line.startswith(b'@<TRIPOS>MOLECULE'):
+            if entry is not None:
+                yield MoleculeEntry(entry[0], entry[1], offset - entry[1], entry[2])
+            entry = [None, offset, None]
+            line_in_record = 0
+        elif entry is not None:
+            line_in_record += 1
+            # The molecule name and the atom count are in the two lines after the header.
+            if line_in_record == 1:
+                entry[0] = line.decode().strip()
+            elif line_in_record == 2:
+                entry[2] = int(line.split()[0])
+        offset += len(line)
+    if entry is not None:
+        yield MoleculeEntry(entry[0], entry[1], offset - entry[1], entry[2])
+
+
+def _scan_sdf(f):
+    """Yield the MoleculeEntry of each molecule in a SDF file opened in binary mode."""
+    name = None
+    n_atoms = None
+    start = 0
+    line_in_record = 0
+    offset = 0
+    for line in f:
+        offset += len(line)
+        line_in_record += 1
+        if line_in_record == 1:
+            name = line.decode().strip()
+        elif line_in_record == 4:
+            # The counts line. In V3000 files, the atom count is in the CTAB block.
+            if b'V3000' not in line:
+                n_atoms = int(line[0:3])
+        elif n_atoms is None and line.startswith(b'M  V30 COUNTS'):
+            n_atoms = int(line.split()[3])
+        elif line.startswith(b'$$$$'):
+            yield MoleculeEntry(name, start, offset - start, n_atoms)
+            start = offset
+            line_in_record = 0
+            n_atoms = None
+
+    # Last record without the terminating $$$$.
+    if line_in_record > 0 and name:
+        yield MoleculeEntry(name, start, offset - start, n_atoms)
+
+
+def get_file_format(file_path):
+    """Return the format ('mol2' or 'sdf') of a molecule file from its extension."""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in _MOL2_EXTENSIONS:
+        return 'mol2'
+    elif extension in _SDF_EXTENSIONS:
+        return 'sdf'
+    raise ValueError('Unsupported molecule file format: {}'.format(file_path))
+
+
+def scan_molecules(file_path):
+    """Scan a multi-molecule file and return the list of its MoleculeEntry.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to a mol2 or SDF file (the format is determined from the
+        extension).
+
+    Returns
+    -------
+    entries : list of MoleculeEntry
+        The entries of the molecules in the order in which they appear.
+
+    """
+    scan = {'mol2': _scan_mol2, 'sdf': _scan_sdf}[get_file_format(file_path)]
+    with open(file_path, 'rb') as f:
+        return list(scan(f))
+
+
+# =============================================================================
+# INDEXED FILE
+# =============================================================================
+
+class MoleculeFile(object):
+    """Random access to the molecules of a multi-molecule mol2 or SDF file.
+
+    The index is loaded from the sidecar file ``file_path + INDEX_FILE_SUFFIX``
+    if it is still valid, or built and saved otherwise. If the sidecar can't
+    be written (e.g., read-only directory), the index is kept only in memory.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the mol2 or SDF file.
+
+    Examples
+    --------
+    >>> molecules = MoleculeFile('ligands.mol2')  # doctest: +SKIP
+    >>> len(molecules)  # doctest: +SKIP
+    10000
+    >>> mol2_record = molecules[4]  # doctest: +SKIP
+
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.index_file_path = file_path + INDEX_FILE_SUFFIX
+        self.entries = self._load_index()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, molecule_index):
+        """The text of the record of the molecule."""
+        return self.read_molecules([molecule_index])[0]
+
+    @property
+    def names(self):
+        """The names of the molecules in the file."""
+        return [entry.name for entry in self.entries]
+
+    def find(self, name):
+        """Return the index of the first molecule with the given name."""
+        for molecule_index, entry in enumerate(self.entries):
+            if entry.name == name:
+                return molecule_index
+        raise KeyError('Molecule {} not found in {}'.format(name, self.file_path))
+
+    def read_molecules(self, molecule_indices):
+        """Read the records of the given molecules.
+
+        Parameters
+        ----------
+        molecule_indices : iterable of int
+            The indices of the molecules in the file. Negative indices
+            count from the end.
+
+        Returns
+        -------
+        records : list of str
+            The text of the molecule records, in the order of molecule_indices.
+
+        """
+        records = []
+        with open(self.file_path, 'rb') as f:
+            for molecule_index in molecule_indices:
+                entry = self.entries[molecule_index]
+                f.seek(entry.offset)
+                records.append(f.read(entry.length).decode())
+        return records
+
+    def extract(self, molecule_indices, output_file_path):
+        """Write the selected molecules to a new file in the same format."""
+        with open(output_file_path, 'w') as f:
+            for record in self.read_molecules(molecule_indices):
+                f.write(record)
+
+    def _get_file_state(self):
+        stat = os.stat(self.file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load_index(self):
+        size, mtime_ns = self._get_file_state()
+        try:
+            with open(self.index_file_path, 'r') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = None
+
+        if index is not None and index.get('version') == _INDEX_VERSION and index['size'] == size:
+            entries = [MoleculeEntry(*entry) for entry in index['entries']]
+            if index['mtime_ns'] == mtime_ns:
+                return entries
+            # The file has been touched. Check if its content has changed.
+            sha256 = hash_file(self.file_path)
+            if index['sha256'] == sha256:
+                self._save_index(entries, size, mtime_ns, sha256)
+                return entries
+
+        entries = scan_molecules(self.file_path)
+        self._save_index(entries, size, mtime_ns, hash_file(self.file_path))
+        return entries
+
+    def _save_index(self, entries, size, mtime_ns, sha256):
+        index = {'version': _INDEX_VERSION, 'size': size, 'mtime_ns': mtime_ns,
+                 'sha256': sha256, 'entries': [list(entry) for entry in entries]}
+        tmp_file_path = self.index_file_path + '.tmp'
+        try:
+            with open(tmp_file_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_file_path, self.index_file_path)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List or extract the molecules in a mol2 or SDF file.')
+    parser.add_argument('file_path', help='The multi-molecule mol2 or SDF file.')
+    parser.add_argument('--select', type=int, nargs='+', default=None,
+                        help='The indices of the molecules to extract.')
+    parser.add_argument('--output', dest='output_file_path', default=None,
+                        help='The file where the selected molecules are written.')
+    args = parser.parse_args()
+
+    molecule_file = MoleculeFile(args.file_path)
+    if args.select is None:
+        for molecule_index, entry in enumerate(molecule_file.entries):
+            print('{:6d} {:>8} atoms  {}'.format(molecule_index, entry.n_atoms, entry.name))
+    elif args.output_file_path is None:
+        parser.error('--select requires --output')
+    else:
+        molecule_file.extract(args.select, args.output_file_path)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Cell-list neighbor search.
+
+The coordinates are binned in a regular grid of cubic cells. Atoms
+within a distance cutoff are found by comparing each atom only to the
+atoms in the neighboring cells so that the cost of the search scales
+linearly with the number of atoms rather than quadratically.
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import itertools
+
+import numpy as np
+
+
+# =============================================================================
+# CELL LIST
+# =============================================================================
+
+class CellList(object):
+    """Spatial index of a set of coordinates.
+
+    Parameters
+    ----------
+    coords : array-like of shape (n_atoms, 3)
+        The coordinates to index.
+    cell_size : float
+        The side of the cubic cells. Searches are fastest when this is
+        close to the distance cutoff.
+
+    """
+
+    def __init__(self, coords, cell_size):
+        if cell_size <= 0:
+            raise ValueError('The cell size must be positive.')
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.cell_size = float(cell_size)
+
+        # Assign the coordinates to the cells.
+        if len(self.coords) == 0:
+            self.origin = np.zeros(3)
+        else:
+            self.origin = self.coords.min(axis=0)
+        self._cell_coords = self._get_cell_coords(self.coords)
+        self.shape = self._cell_coords.max(axis=0, initial=0) + 1
+
+        # Sort the atoms by cell so that the atoms in
+        # a cell can be retrieved with a binary search.
+        cell_ids = np.ravel_multi_index(self._cell_coords.T, self.shape)
+        self._order = np.argsort(cell_ids, kind='stable')
+        self._sorted_cell_ids = cell_ids[self._order]
+
+    def query_pairs(self, max_dist, min_dist=0.0):
+        """Find all the pairs of indexed atoms within a distance range.
+
+        Parameters
+        ----------
+        max_dist : float
+            The maximum distance (inclusive).
+        min_dist : float, optional
+            The minimum distance (inclusive, default is 0).
+
+        Returns
+        -------
+        pairs : numpy.ndarray of shape (n_pairs, 2)
+            The indices (i, j) of the atoms in each pair with i < j, sorted.
+
+        """
+        queries, atoms = self._get_candidates(self._cell_coords, max_dist)
+        is_pair = queries < atoms
+        queries, atoms = queries[is_pair], atoms[is_pair]
+        return self._filter_by_distance(self.coords[queries], queries, atoms, max_dist, min_dist)
+
+    def query_points(self, points, max_dist):
+        """Find the indexed atoms within a distance from each point.
+
+        Parameters
+        ----------
+        points : array-like of shape (n_points, 3)
+            The query coordinates.
+        max_dist : float
+            The distance cutoff (inclusive).
+
+        Returns
+        -------
+        pairs : numpy.ndarray of shape (n_pairs, 2)
+            The indices (point index, atom index) of each pair, sorted.
+
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        queries, atoms = self._get_candidates(self._get_cell_coords(points), max_dist)
+        return self._filter_by_distance(points[queries], queries, atoms, max_dist)
+
+    def _get_cell_coords(self, coords):
+        return np.floor((coords - self.origin) / self.cell_size).astype(int)
+
+    def _get_candidates(self, cell_coords, max_dist):
+        """Return the pairs (query index, atom index) of atoms in the cells around the queries."""
+        n_layers = int(np.ceil(max_dist / self.cell_size))
+        all_queries, all_atoms = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+
+        for offset in itertools.product(range(-n_layers, n_layers + 1), repeat=3):
+            neighbor_cell_coords = cell_coords + offset
+            is_valid = np.all((neighbor_cell_coords >= 0) & (neighbor_cell_coords < self.shape), axis=1)
+            neighbor_cell_ids = np.ravel_multi_index(neighbor_cell_coords[is_valid].T, self.shape)
+
+            # Find the range of the sorted atoms in each cell.
+            starts = np.searchsorted(self._sorted_cell_ids, neighbor_cell_ids, side='left')
+            counts = np.searchsorted(self._sorted_cell_ids, neighbor_cell_ids, side='right') - starts
+            if counts.sum() == 0:
+                continue
+
+            # Expand the ranges into one entry per pair.
+            queries = np.repeat(np.flatnonzero(is_valid), counts)
+            range_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            all_queries.append(queries)
+            all_atoms.append(self._order[np.repeat(starts, counts) + range_offsets])
+
+        return np.concatenate(all_queries), np.concatenate(all_atoms)
+
+    def _filter_by_distance(self, query_coords, queries, atoms, max_dist, min_dist=0.0):
+        delta = query_coords - self.coords[atoms]
+        distances = np.sqrt(delta[:, 0]*delta[:, 0] + delta[:, 1]*delta[:, 1] + delta[:, 2]*delta[:, 2])
+        within = (distances >= min_dist) & (distances <= max_dist)
+        pairs = np.stack([queries[within], atoms[within]], axis=1)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def pairs_within(coords, max_dist, min_dist=0.0):
+    """Find all the pairs of atoms within a distance range.
+
+    Parameters
+    ----------
+    coords : array-like of shape (n_atoms, 3)
+        The atom coordinates.
+    max_dist : float
+        The maximum distance (inclusive).
+    min_dist : float, optional
+        The minimum distance (inclusive, default is 0).
+
+    Returns
+    -------
+    pairs : numpy.ndarray of shape (n_pairs, 2)
+        The indices (i, j) of the atoms in each pair with i < j, sorted.
+
+    """
+    return CellList(coords, cell_size=max_dist).query_pairs(max_dist, min_dist)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Shared store of the GAFF parameters of the YAML molecules.
+
+YANK charges and parameterizes every molecule with ``openeye`` and
+``antechamber`` options in each of its output directories, so that the
+same ligands are charged again for every protocol variant. This module
+keeps the charged ``.gaff.mol2`` and ``.frcmod`` files in a store shared
+by all the YAML scripts, keyed by the molecular graph, the charging
+options, and the force field version.
+
+Run
+
+    python parameters.py restore path/to/experiment.yaml
+
+before the setup to copy the parameters already in the store to the
+setup directory of YANK (``output_dir/setup_dir/molecules/MOLECULE_ID``),
+which then skips the charging when ``resume_setup`` is set, and
+
+    python parameters.py harvest path/to/experiment.yaml
+
+after the setup to add the new parameters to the store.
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import shutil
+import argparse
+from collections import namedtuple
+
+import yaml
+
+from molindex import MoleculeFile, get_file_format
+from pipeline import ArtifactStore, hash_parameters
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+PARAMETER_STORE_DIR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        '..', '.prepare-artifacts')
+
+# The options of the molecules charged and parameterized by YANK.
+CHARGING_OPTIONS = ('openeye', 'antechamber')
+
+# The leaprc files determining the version of the small molecule force field.
+FORCE_FIELD_LEAPRCS = ('leaprc.gaff', 'leaprc.gaff2')
+
+# The default values of the YANK options determining the setup directory.
+DEFAULT_OUTPUT_DIR = 'output'
+DEFAULT_SETUP_DIR = 'setup'
+
+_STAGE_NAME = 'parameters'
+_GAFF_MOL2_FILE_NAME = 'molecule.gaff.mol2'
+_FRCMOD_FILE_NAME = 'molecule.frcmod'
+
+
+# =============================================================================
+# MOLECULAR GRAPHS
+# =============================================================================
+
+MoleculeGraph = namedtuple('MoleculeGraph', ['elements', 'bonds', 'coords'])
+MoleculeGraph.__doc__ = """The atoms and bonds of a molecule in the order of its input file.
+
+The bond orders are not part of the graph since, for a fixed protonation
+state, they are determined by the connectivity of the atoms and mol2 and
+SDF files encode aromatic bonds differently."""
+
+
+def _read_mol2_graph(record):
+    elements, bonds, coords = [], [], []
+    section = None
+    for line in record.splitlines():
+        if line.startswith('@<TRIPOS>'):
+            section = line.strip()
+            continue
+        fields = line.split()
+        if not fields:
+            continue
+        if section == '@<TRIPOS>ATOM':
+            # The element is the first part of the SYBYL atom type (e.g., C.ar).
+            elements.append(fields[5].split('.')[0])
+            coords.append([float(x) for x in fields[2:5]])
+        elif section == '@<TRIPOS>BOND':
+            bonds.append((int(fields[1]) - 1, int(fields[2]) - 1))
+    return elements, bonds, coords
+
+
+def _read_sdf_graph(record):
+    lines = record.splitlines()
+    counts_line = lines[3]
+    if 'V3000' in counts_line:
+        raise ValueError('V3000 SDF records are not supported.')
+    n_atoms, n_bonds = int(counts_line[0:3]), int(counts_line[3:6])
+    elements, bonds, coords = [], [], []
+    for line in lines[4:4+n_atoms]:
+        coords.append([float(line[0:10]), float(line[10:20]), float(line[20:30])])
+        elements.append(line[31:34].strip())
+    for line in lines[4+n_atoms:4+n_atoms+n_bonds]:
+        bonds.append((int(line[0:3]) - 1, int(line[3:6]) - 1))
+    return elements, bonds, coords
+
+
+def read_molecule_graph(file_path, molecule_index=0):
+    """Read the graph of a molecule in a mol2 or SDF file.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the mol2 or SDF file.
+    molecule_index : int, optional
+        The index of the molecule in a multi-molecule file (default is 0).
+
+    Returns
+    -------
+    graph : MoleculeGraph
+        The elements, bonds (as sorted pairs of 0-based atom indices),
+        and coordinates of the molecule.
+
+    """
+    return read_molecule_graphs(file_path, [molecule_index])[0]
+
+
+def read_molecule_graphs(file_path, molecule_indices=None):
+    """Read the graphs of several molecules in a mol2 or SDF file.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the mol2 or SDF file.
+    molecule_indices : iterable of int, optional
+        The indices of the molecules in the file. By default, all the
+        molecules are read.
+
+    Returns
+    -------
+    graphs : list of MoleculeGraph
+        The graphs of the molecules in the order of molecule_indices.
+
+    """
+    molecule_file = MoleculeFile(file_path)
+    if molecule_indices is None:
+        molecule_indices = range(len(molecule_file))
+    if get_file_format(file_path) == 'mol2':
+        read_graph = _read_mol2_graph
+    else:
+        read_graph = _read_sdf_graph
+
+    graphs = []
+    for record in molecule_file.read_molecules(molecule_indices):
+        elements, bonds, coords = read_graph(record)
+        bonds = sorted(tuple(sorted(bond)) for bond in bonds)
+        graphs.append(MoleculeGraph(elements, bonds, coords))
+    return graphs
+
+
+def get_graph_hash(graph):
+    """Return the hash of the molecular graph.
+
+    The hash depends on the order of the atoms so that the cached charges
+    can be mapped one-to-one onto the atoms of the input file.
+
+    """
+    return hash_parameters({'elements': graph.elements, 'bonds': graph.bonds})
+
+
+def _replace_mol2_coords(gaff_mol2, coords):
+    """Return the text of a mol2 file with the atom coordinates replaced."""
+    lines = gaff_mol2.splitlines(keepends=True)
+    atom_index = 0
+    section = None
+    for line_index, line in enumerate(lines):
+        if line.startswith('@<TRIPOS>'):
+            section = line.strip()
+            continue
+        fields = line.split()
+        if section != '@<TRIPOS>ATOM' or not fields:
+            continue
+        x, y, z = coords[atom_index]
+        lines[line_index] = '{:>7s} {:<8s}{:>10.4f}{:>11.4f}{:>11.4f} {}\n'.format(
+            fields[0], fields[1], x, y, z, ' '.join(fields[5:]))
+        atom_index += 1
+    if atom_index != len(coords):
+        raise ValueError('The mol2 file has {} atoms, expected {}.'.format(atom_index, len(coords)))
+    return ''.join(lines)
+
+
+# =============================================================================
+# PARAMETER STORE
+# =============================================================================
+
+class ParameterStore(object):
+    """Content-addressed store of charged GAFF molecules.
+
+    Parameters
+    ----------
+    store_dir_path : str, optional
+        The root directory of the store. Default is PARAMETER_STORE_DIR_PATH.
+
+    """
+
+    def __init__(self, store_dir_path=PARAMETER_STORE_DIR_PATH):
+        self._artifact_store = ArtifactStore(store_dir_path)
+
+    @staticmethod
+    def get_key(graph, charging_options, force_field):
+        """The key of the parameters of a molecule.
+
+        Parameters
+        ----------
+        graph : MoleculeGraph
+            The graph of the molecule.
+        charging_options : dict
+            The ``openeye`` and ``antechamber`` options of the YAML molecule.
+        force_field : list of str
+            The leaprc files of the small molecule force field.
+
+        """
+        return hash_parameters({'graph': get_graph_hash(graph),
+                                'charging_options': charging_options,
+                                'force_field': sorted(force_field)})
+
+    def has_parameters(self, key):
+        """True if the parameters of the molecule are in the store."""
+        return self._artifact_store.has_artifact(_STAGE_NAME, key)
+
+    def add_parameters(self, key, gaff_mol2_path, frcmod_path):
+        """Copy the .gaff.mol2 and .frcmod files of a molecule to the store."""
+        def producer(output_dir_path):
+            shutil.copyfile(gaff_mol2_path, os.path.join(output_dir_path, _GAFF_MOL2_FILE_NAME))
+            shutil.copyfile(frcmod_path, os.path.join(output_dir_path, _FRCMOD_FILE_NAME))
+        self._artifact_store.create_artifact(_STAGE_NAME, key, producer)
+
+    def restore_parameters(self, key, coords, gaff_mol2_path, frcmod_path):
+        """Write the stored parameters of a molecule with the given coordinates.
+
+        Returns
+        -------
+        restored : bool
+            False if the parameters of the molecule are not in the store.
+
+        """
+        if not self.has_parameters(key):
+            return False
+        artifact_dir_path = self._artifact_store.get_artifact_dir_path(_STAGE_NAME, key)
+        with open(os.path.join(artifact_dir_path, _GAFF_MOL2_FILE_NAME), 'r') as f:
+            gaff_mol2 = _replace_mol2_coords(f.read(), coords)
+        with open(gaff_mol2_path, 'w') as f:
+            f.write(gaff_mol2)
+        shutil.copyfile(os.path.join(artifact_dir_path, _FRCMOD_FILE_NAME), frcmod_path)
+        return True
+
+
+# =============================================================================
+# YAML SCRIPTS
+# =============================================================================
+
+class _YankLoader(yaml.SafeLoader):
+    """Loader of YANK scripts reading !Combinatorial as a plain list."""
+
+
+_YankLoader.add_constructor('!Combinatorial', lambda loader, node: loader.construct_sequence(node))
+
+YamlMolecule = namedtuple('YamlMolecule', ['molecule_id', 'file_path', 'molecule_index',
+                                           'setup_dir_path', 'key'])
+
+
+def _expand_yaml_molecules(yaml_script_path):
+    """Yield the YamlMolecule of each molecule parameterized by YANK in the script.
+
+    Molecules selected from a multi-molecule file are expanded as YANK does
+    into one molecule with ID ``MOLECULE_ID_INDEX`` per selected index.
+
+    """
+    with open(yaml_script_path, 'r') as f:
+        script = yaml.load(f, Loader=_YankLoader)
+    script_dir_path = os.path.dirname(os.path.abspath(yaml_script_path))
+
+    options = script.get('options', {})
+    output_dir_path = os.path.join(script_dir_path, options.get('output_dir', DEFAULT_OUTPUT_DIR))
+    molecules_dir_path = os.path.join(output_dir_path, options.get('setup_dir', DEFAULT_SETUP_DIR),
+                                      'molecules')
+
+    # The small molecule force field is loaded in the systems.
+    force_field = set()
+    for system in script.get('systems', {}).values():
+        for leaprc in system.get('leap', {}).get('parameters', []):
+            if leaprc in FORCE_FIELD_LEAPRCS:
+                force_field.add(leaprc)
+
+    for molecule_id, description in script.get('molecules', {}).items():
+        if not any(option in description for option in CHARGING_OPTIONS):
+            continue
+        file_path = os.path.join(script_dir_path, description.get('filepath', ''))
+        try:
+            get_file_format(file_path)
+        except ValueError:
+            print('Skipping {}: only mol2 and SDF files are supported.'.format(molecule_id))
+            continue
+        if not os.path.isfile(file_path):
+            print('Skipping {}: {} not found.'.format(molecule_id, file_path))
+            continue
+        charging_options = {option: description.get(option) for option in CHARGING_OPTIONS}
+
+        select = description.get('select', None)
+        if select is None:
+            molecule_ids_indices = [(molecule_id, 0)]
+        elif isinstance(select, int):
+            molecule_ids_indices = [(molecule_id, select)]
+        else:
+            if select == 'all':
+                select = range(len(MoleculeFile(file_path)))
+            molecule_ids_indices = [('{}_{}'.format(molecule_id, index), index) for index in select]
+
+        for expanded_id, molecule_index in molecule_ids_indices:
+            graph = read_molecule_graph(file_path, molecule_index)
+            yield YamlMolecule(expanded_id, file_path, molecule_index,
+                               os.path.join(molecules_dir_path, expanded_id),
+                               ParameterStore.get_key(graph, charging_options, force_field))
+
+
+def _get_setup_file_paths(yaml_molecule):
+    file_path = os.path.join(yaml_molecule.setup_dir_path, yaml_molecule.molecule_id)
+    return file_path + '.gaff.mol2', file_path + '.frcmod'
+
+
+def restore(yaml_script_path, parameter_store=None):
+    """Copy the stored parameters of the molecules of a YAML script to its setup directory.
+
+    Molecules that have been already set up are left untouched.
+
+    Returns
+    -------
+    n_restored : int
+        The number of molecules whose parameters have been restored.
+
+    """
+    if parameter_store is None:
+        parameter_store = ParameterStore()
+    n_restored = 0
+    for yaml_molecule in _expand_yaml_molecules(yaml_script_path):
+        gaff_mol2_path, frcmod_path = _get_setup_file_paths(yaml_molecule)
+        if os.path.isfile(gaff_mol2_path) and os.path.isfile(frcmod_path):
+            continue
+        if not parameter_store.has_parameters(yaml_molecule.key):
+            continue
+        coords = read_molecule_graph(yaml_molecule.file_path, yaml_molecule.molecule_index).coords
+        os.makedirs(yaml_molecule.setup_dir_path, exist_ok=True)
+        parameter_store.restore_parameters(yaml_molecule.key, coords, gaff_mol2_path, frcmod_path)
+        n_restored += 1
+    return n_restored
+
+
+def harvest(yaml_script_path, parameter_store=None):
+    """Add the parameters generated by YANK for a YAML script to the store.
+
+    Returns
+    -------
+    n_harvested : int
+        The number of molecules added to the store.
+
+    """
+    if parameter_store is None:
+        parameter_store = ParameterStore()
+    n_harvested = 0
+    for yaml_molecule in _expand_yaml_molecules(yaml_script_path):
+        gaff_mol2_path, frcmod_path = _get_setup_file_paths(yaml_molecule)
+        if not (os.path.isfile(gaff_mol2_path) and os.path.isfile(frcmod_path)):
+            continue
+        if parameter_store.has_parameters(yaml_molecule.key):
+            continue
+        parameter_store.add_parameters(yaml_molecule.key, gaff_mol2_path, frcmod_path)
+        n_harvested += 1
+    return n_harvested
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Share the GAFF parameters of the molecules among YAML scripts.')
+    parser.add_argument('command', choices=['restore', 'harvest'],
+                        help='restore the stored parameters before the setup or harvest '
+                             'the new parameters after the setup.')
+    parser.add_argument('yaml_script_paths', nargs='+', metavar='yaml_script_path',
+                        help='The YANK YAML scripts.')
+    parser.add_argument('--store', dest='store_dir_path', default=PARAMETER_STORE_DIR_PATH,
+                        help='The root directory of the parameter store.')
+    args = parser.parse_args()
+
+    store = ParameterStore(args.store_dir_path)
+    command, verb = {'restore': (restore, 'restored'), 'harvest': (harvest, 'harvested')}[args.command]
+    for yaml_script_path in args.yaml_script_paths:
+        n_molecules = command(yaml_script_path, parameter_store=store)
+        print('{}: {} {} molecules'.format(yaml_script_path, verb, n_molecules))
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Content-hashed stage graph to run the input preparation incrementally.
+
+Each stage of the pipeline (e.g., download, PDBFixer, MCCE, docking) is
+identified by a key obtained by hashing its name, its parameters, the
+content of its input files, and the keys of the stages it depends on.
+The output files of a stage are stored in an ``ArtifactStore`` directory
+named after the key so that, when the pipeline is executed again, only
+the stages whose inputs have changed are run.
+
+The module also provides ``FileCache``, a size-bounded on-disk cache
+of single files keyed by hash, for expensive results that are reused
+across stages and runs (e.g., MCCE protonation states).
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import instrumentation
+
+
+# =============================================================================
+# HASHING UTILITIES
+# =============================================================================
+
+def hash_file(file_path, block_size=2**20):
+    """Return the SHA256 hex digest of the content of a file.
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the file to hash.
+    block_size : int, optional
+        The number of bytes read at a time (default is 1MB).
+
+    Returns
+    -------
+    digest : str
+        The hexadecimal SHA256 digest of the file content.
+
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def hash_parameters(parameters):
+    """Return the SHA256 hex digest of a JSON-serializable object.
+
+    Dictionary keys are sorted so that the digest does not depend on the
+    insertion order. Objects that are not JSON-serializable (e.g., numpy
+    scalars) are converted to their string representation.
+
+    Parameters
+    ----------
+    parameters : object
+        The object to hash.
+
+    Returns
+    -------
+    digest : str
+        The hexadecimal SHA256 digest of the serialized object.
+
+    """
+    serialized = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+# =============================================================================
+# ARTIFACT STORE
+# =============================================================================
+
+class ArtifactStore(object):
+    """On-disk store of the stage outputs keyed by the hash of their inputs.
+
+    Each artifact is a directory ``root_dir_path/stage_name/key``. Stages
+    write their output in a temporary directory that is renamed to its
+    final path only when the stage completes successfully so that a
+    failure never leaves behind a partial artifact.
+
+    Parameters
+    ----------
+    root_dir_path : str
+        The directory where the artifacts are stored. It is created if it
+        doesn't exist.
+
+    """
+
+    def __init__(self, root_dir_path):
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        os.makedirs(self.root_dir_path, exist_ok=True)
+
+    def get_artifact_dir_path(self, stage_name, key):
+        """The path to the directory of the artifact (it may not exist)."""
+        return os.path.join(self.root_dir_path, stage_name, key)
+
+    def has_artifact(self, stage_name, key):
+        """True if the artifact has been completely generated."""
+        return os.path.isdir(self.get_artifact_dir_path(stage_name, key))
+
+    def create_artifact(self, stage_name, key, producer):
+        """Generate an artifact atomically.
+
+        Parameters
+        ----------
+        stage_name : str
+            The name of the stage generating the artifact.
+        key : str
+            The hash identifying the artifact.
+        producer : callable
+            A function ``producer(output_dir_path)`` writing the artifact
+            files in the given directory.
+
+        Returns
+        -------
+        artifact_dir_path : str
+            The path to the directory containing the artifact files. If
+            another process created the same artifact in the meantime,
+            this is the existing artifact.
+
+        """
+        artifact_dir_path = self.get_artifact_dir_path(stage_name, key)
+        stage_dir_path = os.path.dirname(artifact_dir_path)
+        os.makedirs(stage_dir_path, exist_ok=True)
+
+        # Work in a temporary directory on the same file system
+        # so that the final rename is atomic.
+        tmp_dir_path = tempfile.mkdtemp(prefix='.' + key[:8] + '-', dir=stage_dir_path)
+        try:
+            producer(tmp_dir_path)
+        except Exception:
+            shutil.rmtree(tmp_dir_path, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_dir_path, artifact_dir_path)
+        except OSError:
+            shutil.rmtree(tmp_dir_path, ignore_errors=True)
+            # Another run (e.g., a job sharing the store) generated the same
+            # artifact in the meantime. Artifacts are identified by their key
+            # so its copy is equivalent.
+            if not self.has_artifact(stage_name, key):
+                raise
+        return artifact_dir_path
+
+
+# =============================================================================
+# FILE CACHE
+# =============================================================================
+
+class FileCache(object):
+    """Size-bounded on-disk cache of files keyed by hash.
+
+    Each entry is a single file. Reading an entry updates its
+    modification time so that, when the total size of the cache exceeds
+    max_size, the least recently used entries are evicted first.
+
+    Parameters
+    ----------
+    cache_dir_path : str
+        The directory where the cached files are stored. It is created
+        if it doesn't exist.
+    max_size : int or None, optional
+        The maximum total size of the cache in bytes. If None, entries
+        are never evicted.
+    suffix : str, optional
+        The extension of the cached files (default is no extension).
+
+    """
+
+    def __init__(self, cache_dir_path, max_size=None, suffix=''):
+        self.cache_dir_path = os.path.abspath(cache_dir_path)
+        self.max_size = max_size
+        self.suffix = suffix
+        os.makedirs(self.cache_dir_path, exist_ok=True)
+
+    def get_file_path(self, key):
+        """The path to the cached file (it may not exist)."""
+        return os.path.join(self.cache_dir_path, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """Return the path to the cached file or None if it is not cached."""
+        file_path = self.get_file_path(key)
+        try:
+            # Mark the entry as recently used.
+            os.utime(file_path)
+        except FileNotFoundError:
+            return None
+        return file_path
+
+    def put(self, key, writer):
+        """Add an entry to the cache atomically.
+
+        Parameters
+        ----------
+        key : str
+            The hash identifying the entry.
+        writer : callable
+            A function ``writer(file_path)`` writing the entry.
+
+        Returns
+        -------
+        file_path : str
+            The path to the cached file.
+
+        """
+        file_path = self.get_file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd, tmp_file_path = tempfile.mkstemp(prefix='.', suffix=self.suffix,
+                                             dir=os.path.dirname(file_path))
+        os.close(fd)
+        try:
+            writer(tmp_file_path)
+            os.replace(tmp_file_path, file_path)
+        except Exception:
+            os.remove(tmp_file_path)
+            raise
+        self.evict()
+        return file_path
+
+    def evict(self):
+        """Remove the least recently used entries exceeding max_size."""
+        if self.max_size is None:
+            return
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(self.cache_dir_path):
+            for file_name in file_names:
+                # Skip temporary files of entries being written.
+                if file_name.startswith('.'):
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+# =============================================================================
+# STAGE GRAPH
+# =============================================================================
+
+class Stage(object):
+    """A node of the stage graph.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the stage in the graph.
+    function : callable
+        The function executing the stage. It is called as
+        ``function(output_dir_path, dependency_dir_paths, **parameters)``,
+        where ``dependency_dir_paths`` is a dictionary mapping the names
+        of the dependencies to the directories containing their output.
+    dependencies : list of str, optional
+        The names of the stages whose output is required by this stage.
+    input_file_paths : list of str, optional
+        Paths to external files read by the stage. Their content is part
+        of the stage key.
+    parameters : dict, optional
+        Keyword arguments passed to ``function``. They must be
+        JSON-serializable as they are part of the stage key.
+    version : int, optional
+        Increment this to invalidate the cached artifacts after changing
+        the implementation of ``function``.
+    trace_labels : dict, optional
+        The fields of the instrumentation record of the stage (e.g.,
+        ``{'stage': 'dock', 'system': 'l99a-55'}``). By default, the
+        record is labeled with the stage name. The labels are not part
+        of the stage key.
+
+    """
+
+    def __init__(self, name, function, dependencies=(), input_file_paths=(),
+                 parameters=None, version=0, trace_labels=None):
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.input_file_paths = list(input_file_paths)
+        self.parameters = {} if parameters is None else dict(parameters)
+        self.version = version
+        self.trace_labels = {'stage': name}
+        if trace_labels is not None:
+            self.trace_labels.update(trace_labels)
+
+
+class StageGraph(object):
+    """A directed acyclic graph of stages backed by an ArtifactStore.
+
+    Parameters
+    ----------
+    artifact_store : ArtifactStore
+        The store used to save and retrieve the stage outputs.
+
+    Examples
+    --------
+    >>> graph = StageGraph(ArtifactStore('artifacts'))  # doctest: +SKIP
+    >>> graph.add_stage('download', download, parameters={'url': url})  # doctest: +SKIP
+    >>> graph.add_stage('pdbfix', pdbfix, dependencies=['download'])  # doctest: +SKIP
+    >>> output_dir_path = graph.run('pdbfix')  # doctest: +SKIP
+
+    """
+
+    def __init__(self, artifact_store):
+        self.artifact_store = artifact_store
+        self._stages = OrderedDict()
+        self._keys = {}
+
+    @property
+    def stage_names(self):
+        """The names of the stages in insertion order."""
+        return list(self._stages.keys())
+
+    def add_stage(self, name, function, **kwargs):
+        """Add a stage to the graph.
+
+        All the dependencies must have been added before. See ``Stage``
+        for a description of the keyword arguments.
+
+        Returns
+        -------
+        stage : Stage
+            The new stage.
+
+        """
+        if name in self._stages:
+            raise ValueError('Stage {} has already been added.'.format(name))
+        stage = Stage(name, function, **kwargs)
+        for dependency in stage.dependencies:
+            if dependency not in self._stages:
+                raise ValueError('Stage {} depends on the unknown stage {}.'.format(
+                    name, dependency))
+        self._stages[name] = stage
+        return stage
+
+    def get_key(self, stage_name):
+        """Compute the hash identifying the output of a stage.
+
+        The key depends on the stage name, version, and parameters, on the
+        content of its input files, and recursively on the keys of its
+        dependencies.
+
+        """
+        try:
+            return self._keys[stage_name]
+        except KeyError:
+            pass
+        stage = self._stages[stage_name]
+        key_data = {
+            'name': stage.name,
+            'version': stage.version,
+            'parameters': stage.parameters,
+            'input_files': [hash_file(file_path) for file_path in stage.input_file_paths],
+            'dependencies': {dependency: self.get_key(dependency)
+                             for dependency in stage.dependencies}
+        }
+        key = hash_parameters(key_data)
+        self._keys[stage_name] = key
+        return key
+
+    def run(self, stage_name):
+        """Execute a stage and its dependencies if they are not cached.
+
+        Parameters
+        ----------
+        stage_name : str
+            The name of the stage to run.
+
+        Returns
+        -------
+        output_dir_path : str
+            The directory containing the output files of the stage.
+
+        """
+        stage = self._stages[stage_name]
+        key = self.get_key(stage_name)
+        if self.artifact_store.has_artifact(stage_name, key):
+            print('Stage {} is up to date.'.format(stage_name))
+            return self.artifact_store.get_artifact_dir_path(stage_name, key)
+
+        # Run dependencies first.
+        dependency_dir_paths = {dependency: self.run(dependency)
+                                for dependency in stage.dependencies}
+
+        print('Running stage {}'.format(stage_name))
+        trace_labels = dict(stage.trace_labels)
+        def producer(output_dir_path):
+            with instrumentation.stage(trace_labels.pop('stage'), **trace_labels):
+                stage.function(output_dir_path, dependency_dir_paths, **stage.parameters)
+        return self.artifact_store.create_artifact(stage_name, key, producer)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Binding pocket detection and cached atom-index selections.
+
+The pocket is the set of receptor residues with at least one atom within
+a distance cutoff from any atom of the docked ligands. The search is a
+single cell-list query of all the ligand coordinates. The atom indices of
+the pocket residues are then selected in a topology, which can be the
+receptor itself or a system containing it (e.g., the complex), by
+matching chain, residue number and residue name, so that restraints and
+analysis can use the atom indices directly instead of evaluating
+selection strings with one term per residue.
+
+The results are cached in ``.npz`` files keyed by the hash of the
+topology, the receptor and ligand coordinates, and the selection options.
+
+Run
+
+    python pocket.py receptor.pdb docked.sdf --output pocket.npz
+
+to print the pocket residues and save the arrays of the pocket.
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import hashlib
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from neighbors import CellList
+from parameters import read_molecule_graphs
+from pipeline import FileCache, hash_file, hash_parameters
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+POCKET_CACHE_DIR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     '..', '.prepare-artifacts', 'pockets')
+
+# The distance used to define the pocket of the c-Met ligands.
+DEFAULT_CUTOFF = 4.5  # In angstroms.
+
+# Increment this when the content of the cached files changes.
+_POCKET_VERSION = 2
+
+
+# =============================================================================
+# PDB TOPOLOGY
+# =============================================================================
+
+def read_pdb_atoms(pdb_file_path):
+    """Read the atoms of the ATOM and HETATM records of a PDB file.
+
+    Parameters
+    ----------
+    pdb_file_path : str
+        The path to the PDB file.
+
+    Returns
+    -------
+    atoms : numpy.recarray
+        One record per atom in the order of the file (i.e., the atom
+        indices of the topology) with fields name, resname, chain, resseq,
+        icode, element, residue_index (the 0-based index of the residue in
+        the order of the file), and coords.
+
+    """
+    fields = []
+    with open(pdb_file_path, 'r') as f:
+        for line in f:
+            if not line.startswith(('ATOM  ', 'HETATM')):
+                continue
+            name = line[12:16].strip()
+            element = line[76:78].strip()
+            if element == '':
+                # Fall back to the first letter of the atom name.
+                element = name.lstrip('0123456789')[:1]
+            fields.append((name, line[17:20].strip(), line[21], int(line[22:26]), line[26].strip(),
+                           element.capitalize(), float(line[30:38]), float(line[38:46]), float(line[46:54])))
+
+    if len(fields) == 0:
+        raise ValueError('{} contains no atoms.'.format(pdb_file_path))
+    names, resnames, chains, resseqs, icodes, elements, x, y, z = zip(*fields)
+
+    # A new residue starts when the residue identifier changes.
+    residue_ids = np.array(['{}{}{}{}'.format(*residue_id)
+                            for residue_id in zip(chains, resseqs, icodes, resnames)])
+    is_new_residue = np.ones(len(residue_ids), dtype=bool)
+    is_new_residue[1:] = residue_ids[1:] != residue_ids[:-1]
+    residue_indices = np.cumsum(is_new_residue) - 1
+
+    return np.rec.fromarrays(
+        [names, resnames, chains, resseqs, icodes, elements, residue_indices, np.stack([x, y, z], axis=1)],
+        dtype=[('name', 'U4'), ('resname', 'U3'), ('chain', 'U1'), ('resseq', int), ('icode', 'U1'),
+               ('element', 'U2'), ('residue_index', int), ('coords', float, (3,))])
+
+
+def get_topology_hash(atoms):
+    """Return the hash of the atoms and residues of a topology, regardless of the coordinates."""
+    sha256 = hashlib.sha256()
+    for field in ('name', 'resname', 'chain', 'resseq', 'icode', 'element', 'residue_index'):
+        sha256.update(np.ascontiguousarray(atoms[field]).tobytes())
+    return sha256.hexdigest()
+
+
+# =============================================================================
+# POCKET DETECTION
+# =============================================================================
+
+Pocket = namedtuple('Pocket', ['chains', 'resseqs', 'resnames', 'residue_indices', 'atom_indices'])
+Pocket.__doc__ = """The residues of a binding pocket and their atoms in a topology.
+
+chains, resseqs and resnames identify the pocket residues, residue_indices and
+atom_indices are the 0-based indices of the pocket residues and of
+their selected atoms in the topology."""
+
+
+def read_ligand_coords(ligand_file_paths):
+    """Return the coordinates of all the atoms of all the molecules in the mol2 or SDF files."""
+    coords = [np.zeros((0, 3))]
+    for ligand_file_path in ligand_file_paths:
+        for graph in read_molecule_graphs(ligand_file_path):
+            coords.append(np.asarray(graph.coords, dtype=float).reshape(-1, 3))
+    return np.concatenate(coords)
+
+
+def find_pocket_residues(receptor_atoms, ligand_coords, cutoff=DEFAULT_CUTOFF):
+    """Find the receptor residues within a distance from the ligands.
+
+    Parameters
+    ----------
+    receptor_atoms : numpy.recarray
+        The receptor atoms (see read_pdb_atoms).
+    ligand_coords : array-like of shape (n_atoms, 3)
+        The coordinates of the ligand atoms in angstroms.
+    cutoff : float, optional
+        The maximum distance in angstroms between the closest atoms of
+        a pocket residue and a ligand (default is 4.5).
+
+    Returns
+    -------
+    residue_indices : numpy.ndarray
+        The sorted residue_index of the pocket residues.
+
+    """
+    cell_list = CellList(receptor_atoms.coords, cell_size=cutoff)
+    pairs = cell_list.query_points(ligand_coords, max_dist=cutoff)
+    return np.unique(receptor_atoms.residue_index[pairs[:, 1]])
+
+
+def select_residue_atoms(atoms, chains, resseqs, resnames, heavy_atoms_only=True):
+    """Select the atoms of the residues identified by chain, residue number and residue name.
+
+    Parameters
+    ----------
+    atoms : numpy.recarray
+        The atoms of the topology (see read_pdb_atoms).
+    chains : array-like of str
+        The chain of each residue.
+    resseqs : array-like of int
+        The residue number of each residue.
+    resnames : array-like of str
+        The residue name of each residue.
+    heavy_atoms_only : bool, optional
+        If True (default), the hydrogens are not selected.
+
+    Returns
+    -------
+    residue_indices : numpy.ndarray
+        The sorted residue_index of the selected residues in the topology.
+    atom_indices : numpy.ndarray
+        The sorted indices of the selected atoms in the topology.
+
+    Raises
+    ------
+    ValueError
+        If a residue is not in the topology or has a different name, or
+        if no atom is selected.
+
+    """
+    # Identify the residues of the topology by their first atom.
+    topology_residue_indices, first_atoms = np.unique(atoms.residue_index, return_index=True)
+    topology_keys = {(chain, resseq): (residue_index, resname) for chain, resseq, resname, residue_index
+                     in zip(atoms.chain[first_atoms], atoms.resseq[first_atoms].tolist(),
+                            atoms.resname[first_atoms], topology_residue_indices.tolist())}
+
+    residue_indices = []
+    for chain, resseq, resname in zip(chains, np.asarray(resseqs).tolist(), resnames):
+        try:
+            residue_index, topology_resname = topology_keys[(chain, resseq)]
+        except KeyError:
+            raise ValueError('Residue {}{} ({}) is not in the topology.'.format(chain, resseq, resname))
+        if topology_resname != resname:
+            raise ValueError('Residue {}{} is {} in the topology instead of {}.'.format(
+                chain, resseq, topology_resname, resname))
+        residue_indices.append(residue_index)
+    residue_indices = np.unique(np.array(residue_indices, dtype=int))
+
+    is_selected = np.isin(atoms.residue_index, residue_indices)
+    if heavy_atoms_only:
+        is_selected &= atoms.element != 'H'
+    atom_indices = np.flatnonzero(is_selected)
+    if len(atom_indices) == 0:
+        raise ValueError('No atom selected.')
+    return residue_indices, atom_indices
+
+
+def compute_pocket(receptor_atoms, ligand_coords, topology_atoms=None, cutoff=DEFAULT_CUTOFF,
+                   heavy_atoms_only=True):
+    """Find the pocket residues and select their atoms.
+
+    Parameters
+    ----------
+    receptor_atoms : numpy.recarray
+        The receptor atoms (see read_pdb_atoms).
+    ligand_coords : array-like of shape (n_atoms, 3)
+        The coordinates of the ligand atoms in angstroms.
+    topology_atoms : numpy.recarray, optional
+        The atoms of the topology where the pocket atoms are selected.
+        By default, this is the receptor.
+    cutoff : float, optional
+        The distance cutoff in angstroms (default is 4.5).
+    heavy_atoms_only : bool, optional
+        If True (default), the hydrogens are not selected.
+
+    Returns
+    -------
+    pocket : Pocket
+
+    """
+    if topology_atoms is None:
+        topology_atoms = receptor_atoms
+    receptor_residue_indices = find_pocket_residues(receptor_atoms, ligand_coords, cutoff)
+    first_atoms = np.searchsorted(receptor_atoms.residue_index, receptor_residue_indices)
+    chains = receptor_atoms.chain[first_atoms]
+    resseqs = receptor_atoms.resseq[first_atoms]
+    resnames = receptor_atoms.resname[first_atoms]
+    residue_indices, atom_indices = select_residue_atoms(topology_atoms, chains, resseqs, resnames,
+                                                         heavy_atoms_only)
+    return Pocket(chains, resseqs, resnames, residue_indices, atom_indices)
+
+
+# =============================================================================
+# CACHED POCKETS
+# =============================================================================
+
+def _save_pocket(pocket, file_path):
+    # np.savez appends .npz to the path if it doesn't have it.
+    with open(file_path, 'wb') as f:
+        np.savez(f, **pocket._asdict())
+
+
+def load_pocket(file_path):
+    """Load a Pocket saved in a .npz file."""
+    with np.load(file_path) as data:
+        return Pocket(*[data[field] for field in Pocket._fields])
+
+
+def get_pocket(receptor_pdb_path, ligand_file_paths, topology_pdb_path=None, cutoff=DEFAULT_CUTOFF,
+               heavy_atoms_only=True, cache=None):
+    """Return the pocket of the docked ligands, computing it only if it is not cached.
+
+    Parameters
+    ----------
+    receptor_pdb_path : str
+        The PDB file of the receptor.
+    ligand_file_paths : list of str
+        The mol2 or SDF files with the docked ligands.
+    topology_pdb_path : str, optional
+        The PDB file of the topology where the pocket atoms are selected
+        (e.g., the solvated complex). By default, this is the receptor.
+    cutoff : float, optional
+        The distance cutoff in angstroms (default is 4.5).
+    heavy_atoms_only : bool, optional
+        If True (default), the hydrogens are not selected.
+    cache : pipeline.FileCache, optional
+        The cache of the pockets. By default, the cache in
+        POCKET_CACHE_DIR_PATH is used. Pass False to disable caching.
+
+    Returns
+    -------
+    pocket : Pocket
+
+    """
+    if cache is None:
+        cache = FileCache(POCKET_CACHE_DIR_PATH, suffix='.npz')
+
+    receptor_atoms = read_pdb_atoms(receptor_pdb_path)
+    if topology_pdb_path is None:
+        topology_atoms = receptor_atoms
+    else:
+        topology_atoms = read_pdb_atoms(topology_pdb_path)
+
+    key = None
+    if cache is not False:
+        key = hash_parameters({
+            'version': _POCKET_VERSION,
+            'topology': get_topology_hash(topology_atoms),
+            'receptor': get_topology_hash(receptor_atoms),
+            'receptor_coords': hashlib.sha256(receptor_atoms.coords.tobytes()).hexdigest(),
+            'ligands': [hash_file(ligand_file_path) for ligand_file_path in ligand_file_paths],
+            'cutoff': cutoff,
+            'heavy_atoms_only': heavy_atoms_only,
+        })
+        file_path = cache.get(key)
+        if file_path is not None:
+            return load_pocket(file_path)
+
+    ligand_coords = read_ligand_coords(ligand_file_paths)
+    pocket = compute_pocket(receptor_atoms, ligand_coords, topology_atoms, cutoff, heavy_atoms_only)
+    if key is not None:
+        cache.put(key, lambda file_path: _save_pocket(pocket, file_path))
+    return pocket
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the receptor residues near the docked ligands.')
+    parser.add_argument('receptor_pdb_path', help='The PDB file of the receptor.')
+    parser.add_argument('ligand_file_paths', nargs='+', metavar='ligand_file_path',
+                        help='The mol2 or SDF files of the docked ligands.')
+    parser.add_argument('--topology', dest='topology_pdb_path', default=None,
+                        help='The PDB file where the pocket atoms are selected (default is the receptor).')
+    parser.add_argument('--cutoff', type=float, default=DEFAULT_CUTOFF,
+                        help='The distance cutoff in angstroms (default is {}).'.format(DEFAULT_CUTOFF))
+    parser.add_argument('--hydrogens', dest='heavy_atoms_only', action='store_false',
+                        help='Select also the hydrogens of the pocket residues.')
+    parser.add_argument('--output', dest='output_file_path', default=None,
+                        help='The .npz file where the arrays of the pocket are saved.')
+    args = parser.parse_args()
+
+    pocket = get_pocket(args.receptor_pdb_path, args.ligand_file_paths, topology_pdb_path=args.topology_pdb_path,
+                        cutoff=args.cutoff, heavy_atoms_only=args.heavy_atoms_only)
+    print('Residues: {}'.format(' '.join('{}{}{}'.format(resname, chain, resseq) for chain, resseq, resname
+                                          in zip(pocket.chains, pocket.resseqs, pocket.resnames))))
+    print('Residue indices: {}'.format(pocket.residue_indices.tolist()))
+    print('Number of selected atoms: {}'.format(len(pocket.atom_indices)))
+    if args.output_file_path is not None:
+        _save_pocket(pocket, args.output_file_path)
@@ -7,7 +7,10 @@
 """Download and prepare the input files for the calculations.
 
 See the docs of ``prepare_cyclodextrin_files()`` and ``prepare_t4lysozyme_files()``
-for an exact description of the preparation.
+for an exact description of the preparation. The intermediate files of
+each preparation stage are cached in ``ARTIFACTS_DIR_PATH`` (see the
+``pipeline`` module) so that re-running the script only executes the
+stages whose inputs have changed.
 
 Requires Python 3 and OpenEye.
 
@@ -20,20 +23,20 @@ Requires Python 3 and OpenEye.
 
 import os
 import json
+import argparse
+import functools
 import shutil
-import tempfile
-import urllib.request
 from collections import namedtuple
 
-import mdtraj
 import numpy as np
-import openmoltools as moltools
-from pdbfixer import PDBFixer
 from simtk import unit
-from simtk.openmm.app import PDBFile
 
+import instrumentation
 from mcce import protonatePDB
-from docking import create_receptor, dock_molecule
+from docking import dock_molecules, ReceptorCache, ChargedMoleculeCache, DOCKING_BACKENDS
+from pipeline import ArtifactStore, FileCache, StageGraph
+from download import Downloader
+from structures import StructureCache
 
 
 # =============================================================================
@@ -42,13 +45,22 @@ from docking import create_receptor, dock_molecule
 
 CD_INPUT_FILES_URL = 'https://raw.githubusercontent.com/MobleyLab/benchmarksets/master/input_files/'
 MCCE_PATH = '/home/andrrizzi/mcce'
+ARTIFACTS_DIR_PATH = os.path.join('..', '.prepare-artifacts')
+DOWNLOAD_CACHE_DIR_PATH = os.path.join(ARTIFACTS_DIR_PATH, 'downloads')
+STRUCTURE_CACHE_DIR_PATH = os.path.join(ARTIFACTS_DIR_PATH, 'structures')
+MCCE_CACHE_DIR_PATH = os.path.join(ARTIFACTS_DIR_PATH, 'mcce')
+MCCE_CACHE_MAX_SIZE = 2**30  # In bytes.
+RECEPTOR_CACHE_DIR_PATH = os.path.join(ARTIFACTS_DIR_PATH, 'receptors')
+RECEPTOR_CACHE_MAX_SIZE = 2**30  # In bytes.
+MOLECULE_CACHE_DIR_PATH = os.path.join(ARTIFACTS_DIR_PATH, 'molecules')
+MOLECULE_CACHE_MAX_SIZE = 2**30  # In bytes.
 
 
 # =============================================================================
 # UTILITY FUNCTIONS
 # =============================================================================
 
-def download_and_save_file(url, file_path, relative_url=True):
+def download_and_save_file(url, file_path, relative_url=True, downloader=None):
     """Download and save a file.
 
     Parameters
@@ -59,24 +71,23 @@ def download_and_save_file(url, file_path, relative_url=True):
         The path of the file to save.
     relative_url : bool
         If True, url is interpreted as relative to CD_INPUT_FILES_URL.
+    downloader : download.Downloader, optional
+        The downloader used to fetch the file. If None, a non-caching
+        downloader with base URL CD_INPUT_FILES_URL is used.
 
     """
-    # Create the directory if it doesn't exist.
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-    # Resolve relative URL.
-    if relative_url:
-        url = CD_INPUT_FILES_URL + url
-
-    # Download and write file.
-    with urllib.request.urlopen(url) as response, open(file_path, 'wb') as f:
-        shutil.copyfileobj(response, f)
+    if downloader is None:
+        downloader = Downloader(base_url=CD_INPUT_FILES_URL)
+    downloader.download(url, file_path, relative_url=relative_url)
 
 
 def merge_mol2_files(input_file_paths, output_file_path):
     """Merge all the input mol2 files into a single multi-conformer file.
 
-    Atom names are standardized. Requires OpenEye Toolkit.
+    Atom names are standardized and the residue name <0> is replaced by
+    MOL. The molecules are streamed one at a time from the input files to
+    the output file so that the memory used doesn't grow with the number
+    of molecules. Requires OpenEye Toolkit.
 
     Parameters
     ----------
@@ -87,89 +98,139 @@ def merge_mol2_files(input_file_paths, output_file_path):
 
     Returns
     -------
-    molecule : list of openeye.chem.OEMol
-        The OpenEye Molecule found in the file.
+    index : list of tuple
+        A (name, byte_offset) pair for each molecule in the output file,
+        where byte_offset is the position of its @<TRIPOS>MOLECULE record.
 
     """
     from openeye import oechem
 
-    # Load all files as OpenEye molecules.
-    molecules = []
-    for input_file_path in input_file_paths:
-        ifs = oechem.oemolistream()
-        if not ifs.open(input_file_path):
-            oechem.OEThrow.Fatal('Unable to open {}'.format(input_file_path))
+    index = []
+    with open(output_file_path, 'wb') as output_file:
+        for input_file_path in input_file_paths:
+            ifs = oechem.oemolistream()
+            if not ifs.open(input_file_path):
+                oechem.OEThrow.Fatal('Unable to open {}'.format(input_file_path))
 
-        for mol in ifs.GetOEMols():
-            molecules.append(oechem.OEMol(mol))
-        ifs.close()
+            for mol in ifs.GetOEMols():
+                # Write the molecule in memory to standardize atom names.
+                ofs = oechem.oemolostream()
+                ofs.SetFormat(oechem.OEFormat_MOL2H)
+                ofs.openstring()
+                oechem.OEWriteMolecule(ofs, mol)
+                mol2 = ofs.GetString()
+                ofs.close()
+                if isinstance(mol2, str):  # Depends on the toolkit version.
+                    mol2 = mol2.encode()
 
-    # Save multi-conformer mol2 file.
-    ofs = oechem.oemolostream(output_file_path)
-    ofs.SetFormat(oechem.OEFormat_MOL2H)
+                # Fix residue name and append to the output file.
+                index.append((mol.GetTitle(), output_file.tell()))
+                output_file.write(mol2.replace(b'<0>', b'MOL'))
+            ifs.close()
 
-    for mol in molecules:
-        # Write all molecules and standardize atom names.
-        oechem.OEWriteMolecule(ofs, mol)
-    ofs.close()
+    return index
 
-    # Fix residue name.
-    with open(output_file_path, 'r') as f:
-        output_lines = f.readlines()
-    with open(output_file_path, 'w') as f:
-        for line in output_lines:
-            f.write(line.replace('<0>', 'MOL'))
 
-    return molecules
+# =============================================================================
+# PIPELINE STAGES
+# =============================================================================
+
+# The functions in this section are executed by the StageGraph. They are
+# called as stage(output_dir_path, dependency_dir_paths, **parameters) and
+# must write all their output files in output_dir_path.
 
+def download_files_stage(output_dir_path, dependency_dir_paths, urls, file_names, downloader):
+    """Download concurrently the files at the relative urls in the stage directory."""
+    file_paths = [os.path.join(output_dir_path, file_name) for file_name in file_names]
+    downloader.download_files(urls, file_paths)
 
-def pdbfix_protein(input_pdb_path, output_pdb_path, find_missing_residues=True,
-                   keep_water=False, ph=None):
-    """Run PDBFixer on the input PDB file.
 
-    Heterogen atoms are always removed.
+def merge_mol2_files_stage(output_dir_path, dependency_dir_paths, groups):
+    """Merge groups of mol2 files generated by the dependencies.
+
+    groups maps the output file name to a list of (dependency, file_name).
+    """
+    for output_file_name, input_files in groups.items():
+        input_file_paths = [os.path.join(dependency_dir_paths[dependency], file_name)
+                            for dependency, file_name in input_files]
+        merge_mol2_files(input_file_paths, os.path.join(output_dir_path, output_file_name))
+
+
+def download_pdb_stage(output_dir_path, dependency_dir_paths, pdb_code, structure_cache):
+    """Download a crystal structure from RCSB into crystal.pdb."""
+    shutil.copyfile(structure_cache.get_crystal_pdb_path(pdb_code),
+                    os.path.join(output_dir_path, 'crystal.pdb'))
+
+
+def pdbfix_stage(output_dir_path, dependency_dir_paths, pdb_code, fixer_options, structure_cache):
+    """Remove ligand and crystal waters to prepare for MCCE protonation."""
+    shutil.copyfile(structure_cache.get_fixed_pdb_path(pdb_code, **fixer_options),
+                    os.path.join(output_dir_path, 'pdbfixer.pdb'))
+
+
+def protonate_stage(output_dir_path, dependency_dir_paths, pdbfix_stage, ph, mcce_cache):
+    """Find the protonation state with MCCE and save it into mcce.pdb."""
+    pdbfixed_pdb_file_path = os.path.join(dependency_dir_paths[pdbfix_stage], 'pdbfixer.pdb')
+    protonatePDB(pdbfixed_pdb_file_path, outfile=os.path.join(output_dir_path, 'mcce.pdb'),
+                 pH=ph, mccepath=MCCE_PATH, cache=mcce_cache)
 
-    Parameters
-    ----------
-    input_pdb_path : str
-        The PDB to fix.
-    output_pdb_path : str
-        The path to the output PDB file.
-    find_missing_residues : bool, optional
-        If True, PDBFixer will try to model the unresolved residues
-        that appear in the amino acid sequence (default is True).
-    keep_water : bool, optional
-        If True, water molecules are not stripped (default is False).
-    ph : float or None, optional
-        If not None, hydrogen atoms will be added at this pH.
 
+def receptor_stage(output_dir_path, dependency_dir_paths, pdb_code, protonate_stage,
+                   ligand_dsl, docking_box_side, docking_backend, structure_cache, receptor_cache):
+    """Create the docking receptor centered on the crystal ligand.
+
+    The receptor is generated only if the receptor cache doesn't already
+    contain one for the same protein structure and box.
     """
-    fixer = PDBFixer(filename=input_pdb_path)
-    if find_missing_residues:
-        fixer.findMissingResidues()
-    else:
-        fixer.missingResidues = {}
-    fixer.findNonstandardResidues()
-    fixer.replaceNonstandardResidues()
-    fixer.removeHeterogens(keep_water)
-    fixer.findMissingAtoms()
-    fixer.addMissingAtoms()
-    if ph is not None:
-        fixer.addMissingHydrogens(ph)
-
-    # print(fixer.nonstandardResidues)
-    # print(fixer.missingAtoms)
-    # print(fixer.missingTerminals)
-
-    with open(output_pdb_path, 'w') as f:
-        PDBFile.writeFile(fixer.topology, fixer.positions, f)
+    # Set the docking box center to the ligand centroid. The parsed
+    # crystal structure is shared by all the pHs of the same set.
+    pdb_traj = structure_cache.get_trajectory(pdb_code)
+    ligand_atoms = pdb_traj.topology.select(ligand_dsl)
+    ligand_positions = np.array(pdb_traj.openmm_positions(0) / unit.angstrom)[ligand_atoms]
+    box_center = np.mean(ligand_positions, axis=0)  # In angstroms.
+
+    # Prepare receptor for docking.
+    box_docking = np.concatenate((box_center + docking_box_side/2,
+                                  box_center - docking_box_side/2))
+    mcce_pdb_file_path = os.path.join(dependency_dir_paths[protonate_stage], 'mcce.pdb')
+    receptor_suffix = DOCKING_BACKENDS[docking_backend].receptor_suffix
+    shutil.copyfile(receptor_cache.get_receptor_path(mcce_pdb_file_path, box_docking),
+                    os.path.join(output_dir_path, 'receptor' + receptor_suffix))
+
+
+def dock_stage(output_dir_path, dependency_dir_paths, receptor_stage, molecules_smiles,
+               docking_backend, n_workers=None, molecule_cache=None):
+    """Dock the molecules in parallel and save the poses as molecule_name.mol2."""
+    backend = DOCKING_BACKENDS[docking_backend]()
+    receptor_file_path = os.path.join(dependency_dir_paths[receptor_stage],
+                                      'receptor' + backend.receptor_suffix)
+    molecule_names = list(molecules_smiles)
+    # The stage wraps the whole loop rather than the dock_molecules generator,
+    # which is suspended while the poses are written.
+    with instrumentation.stage('dock-molecules', backend=docking_backend, n_workers=n_workers) as record:
+        record['n_items'] = 0
+        docked_mol2s = dock_molecules(receptor_file_path, [molecules_smiles[molecule_name]
+                                                           for molecule_name in molecule_names],
+                                      n_workers=n_workers, docker_class=backend.docker_class,
+                                      molecule_cache=molecule_cache)
+        for molecule_name, docked_mol2 in zip(molecule_names, docked_mol2s):
+            docked_molecule_file_path = os.path.join(output_dir_path, molecule_name + '.mol2')
+            with open(docked_molecule_file_path, 'w') as f:
+                f.write(docked_mol2)
+            record['n_items'] += 1
+
+
+def export_artifact_file(artifact_dir_path, file_name, output_file_path):
+    """Copy a file generated by a stage to its final destination."""
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    shutil.copyfile(os.path.join(artifact_dir_path, file_name), output_file_path)
 
 
 # =============================================================================
 # MAIN FUNCTIONS
 # =============================================================================
 
-def prepare_cyclodextrin_files():
+def prepare_cyclodextrin_files(artifact_store=None, downloader=None):
     """Download the CD mol2 files and merge all guests in a single file.
 
     The function downloads the alpha and beta cyclodextrin host and their
@@ -179,8 +240,23 @@ def prepare_cyclodextrin_files():
 
     The files are saved in ../cyclodextrin/input/.
 
+    Parameters
+    ----------
+    artifact_store : pipeline.ArtifactStore, optional
+        The store caching the output of the stages. If None, the store
+        in ARTIFACTS_DIR_PATH is used.
+    downloader : download.Downloader, optional
+        The downloader used to fetch the files. If None, the files are
+        downloaded from CD_INPUT_FILES_URL through the cache in
+        DOWNLOAD_CACHE_DIR_PATH.
+
     """
     input_file_dir_path = os.path.join('..', 'cyclodextrin', 'input')
+    if artifact_store is None:
+        artifact_store = ArtifactStore(ARTIFACTS_DIR_PATH)
+    if downloader is None:
+        downloader = Downloader(base_url=CD_INPUT_FILES_URL, cache_dir_path=DOWNLOAD_CACHE_DIR_PATH)
+    graph = StageGraph(artifact_store)
 
     # Data to download all cyclodextrin molecules.
     # Some of the mol2 guest files are numbered with an extra 's'.
@@ -194,31 +270,40 @@ def prepare_cyclodextrin_files():
     for cd_set_url, host_type, n_s_guests, tot_n_guests in cd_sets:
         n_p_guests = tot_n_guests - n_s_guests
 
-        # Determine all paths.
+        # Determine all file names.
         host_file_name = 'host-{}cd.mol2'.format(host_type)
         merged_guest_file_name = 'guests-{}cd.mol2'.format(host_type)
-        host_file_path = os.path.join(input_file_dir_path, host_file_name)
-        merged_guest_file_path = os.path.join(input_file_dir_path, merged_guest_file_name)
-
-        # Determine all URL to downloads
-        host_url = cd_set_url + host_file_name
-        guest_urls = [cd_set_url + 'guest-{}.mol2'.format(i+1) for i in range(n_p_guests)]
-        guest_urls += [cd_set_url + 'guest-s{}.mol2'.format(n_p_guests+i+1) for i in range(n_s_guests)]
-
-        # Download host file first. This should be ready to go.
-        download_and_save_file(host_url, host_file_path)
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            # Download and save all the guests in a temporary directory.
-            guest_file_paths = [os.path.join(tmp_dir, guest_url) for guest_url in guest_urls]
-            for guest_url, guest_file_path in zip(guest_urls, guest_file_paths):
-                download_and_save_file(guest_url, guest_file_path)
-
-            # Merge all files in a single mol2 file.
-            merge_mol2_files(guest_file_paths, merged_guest_file_path)
-
-
-def prepare_t4lysozyme_files():
+        guest_file_names = ['guest-{}.mol2'.format(i+1) for i in range(n_p_guests)]
+        guest_file_names += ['guest-s{}.mol2'.format(n_p_guests+i+1) for i in range(n_s_guests)]
+
+        # Build the stages: download -> merge.
+        download_stage_name = 'download-{}cd'.format(host_type)
+        merge_stage_name = 'merge-{}cd'.format(host_type)
+        file_names = [host_file_name] + guest_file_names
+        # The downloader is bound outside the parameters since it doesn't
+        # affect the content of the downloaded files.
+        system_name = '{}cd'.format(host_type)
+        graph.add_stage(download_stage_name, functools.partial(download_files_stage, downloader=downloader),
+                        parameters=dict(urls=[cd_set_url + file_name for file_name in file_names],
+                                        file_names=file_names),
+                        trace_labels=dict(stage='download', system=system_name, n_items=len(file_names)))
+        merge_groups = {merged_guest_file_name: [(download_stage_name, file_name)
+                                                 for file_name in guest_file_names]}
+        graph.add_stage(merge_stage_name, merge_mol2_files_stage,
+                        dependencies=[download_stage_name],
+                        parameters=dict(groups=merge_groups), version=1,
+                        trace_labels=dict(stage='merge', system=system_name, n_items=len(guest_file_names)))
+
+        # Run the pipeline and export the host and the merged guests files.
+        export_artifact_file(graph.run(download_stage_name), host_file_name,
+                             os.path.join(input_file_dir_path, host_file_name))
+        export_artifact_file(graph.run(merge_stage_name), merged_guest_file_name,
+                             os.path.join(input_file_dir_path, merged_guest_file_name))
+
+
+def prepare_t4lysozyme_files(artifact_store=None, structure_cache=None, mcce_cache=None,
+                             receptor_cache=None, molecule_cache=None, n_docking_workers=None,
+                             docking_backend='fred'):
     """Prepare the input files for T4 Lysozyme calculations.
 
     The function download two crystal structures from the RCSB protein
@@ -229,9 +314,43 @@ def prepare_t4lysozyme_files():
 
     The ligands are generated
 
+    The preparation is executed as a graph of stages (download -> pdbfix
+    -> protonate -> receptor -> dock -> merge) whose outputs are cached
+    in the artifact store so that only the stages whose input changed
+    are executed again.
+
+    Parameters
+    ----------
+    artifact_store : pipeline.ArtifactStore, optional
+        The store caching the output of the stages. If None, the store
+        in ARTIFACTS_DIR_PATH is used.
+    structure_cache : structures.StructureCache, optional
+        The cache of downloaded and fixed crystal structures. If None,
+        the cache in STRUCTURE_CACHE_DIR_PATH is used.
+    mcce_cache : pipeline.FileCache, optional
+        The cache of MCCE results. Identical MCCE calculations (e.g., the
+        same structure protonated for several buffers) are run only once.
+        If None, the cache in MCCE_CACHE_DIR_PATH is used.
+    receptor_cache : docking.ReceptorCache, optional
+        The cache of receptors keyed by protein structure and docking box.
+        It must use the docking backend. If None, the cache in
+        RECEPTOR_CACHE_DIR_PATH is used.
+    molecule_cache : docking.ChargedMoleculeCache, optional
+        The cache of charged ligand conformers. Ligands shared by several
+        sets and buffers are charged only once. If None, the cache in
+        MOLECULE_CACHE_DIR_PATH is used.
+    n_docking_workers : int, optional
+        The number of processes docking the ligands in parallel. If None,
+        the number of CPUs is used.
+    docking_backend : str, optional
+        The name of the docking backend in docking.DOCKING_BACKENDS. The
+        default is 'fred' (OpenEye). The 'grid' backend does not require
+        OpenEye but it is meant only to test and time the pipeline.
+
     """
     # Configuration.
     docking_box_side = 19.0  # In angstroms.
+    fixer_options = dict(find_missing_residues=False, keep_water=False, ph=None)
 
     # File paths.
     t4lysozyme_dir_path = os.path.join('..', 't4lysozyme', 'input')
@@ -240,6 +359,19 @@ def prepare_t4lysozyme_files():
     # Create output folder if it doesn't exist.
     os.makedirs(t4lysozyme_dir_path, exist_ok=True)
 
+    if artifact_store is None:
+        artifact_store = ArtifactStore(ARTIFACTS_DIR_PATH)
+    if structure_cache is None:
+        structure_cache = StructureCache(STRUCTURE_CACHE_DIR_PATH)
+    if mcce_cache is None:
+        mcce_cache = FileCache(MCCE_CACHE_DIR_PATH, max_size=MCCE_CACHE_MAX_SIZE, suffix='.json')
+    if receptor_cache is None:
+        receptor_cache = ReceptorCache(RECEPTOR_CACHE_DIR_PATH, max_size=RECEPTOR_CACHE_MAX_SIZE,
+                                       backend=DOCKING_BACKENDS[docking_backend]())
+    if molecule_cache is None:
+        molecule_cache = ChargedMoleculeCache(MOLECULE_CACHE_DIR_PATH, max_size=MOLECULE_CACHE_MAX_SIZE)
+    graph = StageGraph(artifact_store)
+
     # Load all molecules to dock.
     with open(t4ligands_file_path, 'r') as f:
         t4ligands_set = json.load(f)
@@ -252,70 +384,111 @@ def prepare_t4lysozyme_files():
     ]
 
     for t4_name, pdb_code, ligand_dsl, phs in t4_sets:
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            for ph in phs:
-                full_name = t4_name + '-' + str(ph).replace('.', '')
-
-                # Temporary file paths.
-                crystal_pdb_file_path = os.path.join(tmp_dir, full_name + '.pdb')
-                pdbfixed_pdb_file_path = os.path.join(tmp_dir, full_name + '.pdbfixer.pdb')
-
-                # Output file path for MCCE.
-                mcce_pdb_file_path = os.path.join(t4lysozyme_dir_path, full_name + '.mcce.pdb')
-
-                # Download crystal structure from RCSB.
-                pdb_traj = mdtraj.load_pdb('http://files.rcsb.org/view/' + pdb_code + '.pdb')
-
-                # Remove ligand and crystal waters to prepare for MCCE protonation.
-                pdb_traj.save(crystal_pdb_file_path)
-                pdbfix_protein(crystal_pdb_file_path, pdbfixed_pdb_file_path,
-                               find_missing_residues=False, keep_water=False, ph=None)
-
-                # Find protonation state MCCE. The reference experiments pH is 5.5.
-                print('Find protonation state of {}'.format(full_name))
-                protonatePDB(pdbfixed_pdb_file_path, outfile=mcce_pdb_file_path,
-                             pH=5.5, mccepath=MCCE_PATH)
-
-                # Set the docking box center to the ligand centroid.
-                ligand_atoms = pdb_traj.topology.select(ligand_dsl)
-                ligand_positions = np.array(pdb_traj.openmm_positions(0) / unit.angstrom)[ligand_atoms]
-                box_center = np.mean(ligand_positions, axis=0)  # In angstroms.
-
-                # Prepare receptor for docking.
-                box_docking = np.concatenate((box_center + docking_box_side/2,
-                                              box_center - docking_box_side/2))
-                receptor = create_receptor(mcce_pdb_file_path, box_docking)
-
-                # Dock and store docked positions.
-                print('Docking ligands for {}'.format(full_name))
-                docked_molecule_file_paths = {}
-                for molecule_name, molecule_data in t4ligands_set[t4_name].items():
-                    if molecule_data['pH'] == ph:
-                        docked_molecule_file_path = os.path.join(tmp_dir, molecule_name + '.mol2')
-                        docked_oemol = dock_molecule(receptor, molecule_data['smiles'])
-                        moltools.openeye.molecule_to_mol2(docked_oemol, docked_molecule_file_path, residue_name='MOL')
-
-                        # Be sure to keep ligands that were assayed in different buffers separated.
-                        # We also isolate the numeric part of the ligand id to name the output file.
-                        reference_doi = molecule_data['doi']
-                        molecule_idx = int(molecule_name.split('-')[-1])
-                        try:
-                            docked_molecule_file_paths[reference_doi][0].append(molecule_idx)
-                            docked_molecule_file_paths[reference_doi][1].append(docked_molecule_file_path)
-                        except KeyError:
-                            docked_molecule_file_paths[reference_doi] = [[molecule_idx],
-                                                                         [docked_molecule_file_path]]
-
-                # Merge docked positions into a multi-molecule mol2 file.
-                for reference_doi, (molecule_indices, file_paths) in docked_molecule_file_paths.items():
-                    # Determine output file name.
-                    suffix = '{}-{}'.format(min(molecule_indices), max(molecule_indices))
-                    ligands_mol2_file_name = 'ligands-{}-{}.mol2'.format(t4_name, suffix)
-                    ligands_mol2_file_path = os.path.join(t4lysozyme_dir_path, ligands_mol2_file_name)
-                    # Merge docked molecules into a single mol2 file.
-                    merge_mol2_files(file_paths, ligands_mol2_file_path)
+        # The crystal structure is downloaded and fixed only once for all pHs.
+        download_stage_name = 'download-' + pdb_code
+        pdbfix_stage_name = 'pdbfix-' + pdb_code
+        graph.add_stage(download_stage_name,
+                        functools.partial(download_pdb_stage, structure_cache=structure_cache),
+                        parameters=dict(pdb_code=pdb_code),
+                        trace_labels=dict(stage='download', system=pdb_code))
+        graph.add_stage(pdbfix_stage_name,
+                        functools.partial(pdbfix_stage, structure_cache=structure_cache),
+                        dependencies=[download_stage_name],
+                        parameters=dict(pdb_code=pdb_code, fixer_options=fixer_options),
+                        trace_labels=dict(stage='pdbfix', system=pdb_code))
+
+        for ph in phs:
+            full_name = t4_name + '-' + str(ph).replace('.', '')
+            protonate_stage_name = 'protonate-' + full_name
+            receptor_stage_name = 'receptor-' + full_name
+            dock_stage_name = 'dock-' + full_name
+            merge_stage_name = 'merge-' + full_name
+
+            # Find protonation state MCCE. The reference experiments pH is 5.5.
+            graph.add_stage(protonate_stage_name,
+                            functools.partial(protonate_stage, mcce_cache=mcce_cache),
+                            dependencies=[pdbfix_stage_name],
+                            parameters=dict(pdbfix_stage=pdbfix_stage_name, ph=5.5), version=1,
+                            trace_labels=dict(stage='protonate', system=full_name))
+
+            # Prepare receptor for docking.
+            graph.add_stage(receptor_stage_name,
+                            functools.partial(receptor_stage, structure_cache=structure_cache,
+                                              receptor_cache=receptor_cache),
+                            dependencies=[download_stage_name, protonate_stage_name],
+                            parameters=dict(pdb_code=pdb_code,
+                                            protonate_stage=protonate_stage_name,
+                                            ligand_dsl=ligand_dsl,
+                                            docking_box_side=docking_box_side,
+                                            docking_backend=docking_backend),
+                            trace_labels=dict(stage='receptor', system=full_name))
+
+            # Dock the molecules assayed at this pH. Be sure to keep ligands
+            # that were assayed in different buffers separated. We also isolate
+            # the numeric part of the ligand id to name the output file.
+            molecules_smiles = {}
+            molecules_by_doi = {}
+            for molecule_name, molecule_data in t4ligands_set[t4_name].items():
+                if molecule_data['pH'] == ph:
+                    molecules_smiles[molecule_name] = molecule_data['smiles']
+                    molecules_by_doi.setdefault(molecule_data['doi'], []).append(molecule_name)
+            graph.add_stage(dock_stage_name,
+                            functools.partial(dock_stage, n_workers=n_docking_workers,
+                                              molecule_cache=molecule_cache),
+                            dependencies=[receptor_stage_name],
+                            parameters=dict(receptor_stage=receptor_stage_name,
+                                            molecules_smiles=molecules_smiles,
+                                            docking_backend=docking_backend),
+                            trace_labels=dict(stage='dock', system=full_name,
+                                              n_items=len(molecules_smiles)))
+
+            # Merge docked positions into a multi-molecule mol2 file.
+            merge_groups = {}
+            for molecule_names in molecules_by_doi.values():
+                # Determine output file name.
+                molecule_indices = [int(molecule_name.split('-')[-1]) for molecule_name in molecule_names]
+                suffix = '{}-{}'.format(min(molecule_indices), max(molecule_indices))
+                ligands_mol2_file_name = 'ligands-{}-{}.mol2'.format(t4_name, suffix)
+                merge_groups[ligands_mol2_file_name] = [(dock_stage_name, molecule_name + '.mol2')
+                                                        for molecule_name in molecule_names]
+            graph.add_stage(merge_stage_name, merge_mol2_files_stage, dependencies=[dock_stage_name],
+                            parameters=dict(groups=merge_groups), version=1,
+                            trace_labels=dict(stage='merge', system=full_name,
+                                              n_items=len(molecules_smiles)))
+
+            # Run the pipeline and export the final files.
+            print('Find protonation state of {}'.format(full_name))
+            export_artifact_file(graph.run(protonate_stage_name), 'mcce.pdb',
+                                 os.path.join(t4lysozyme_dir_path, full_name + '.mcce.pdb'))
+            print('Docking ligands for {}'.format(full_name))
+            merge_dir_path = graph.run(merge_stage_name)
+            for ligands_mol2_file_name in merge_groups:
+                export_artifact_file(merge_dir_path, ligands_mol2_file_name,
+                                     os.path.join(t4lysozyme_dir_path, ligands_mol2_file_name))
 
 
 if __name__ == '__main__':
-    prepare_cyclodextrin_files()
-    prepare_t4lysozyme_files()
+    parser = argparse.ArgumentParser(description='Download and prepare the input files for the calculations.')
+    parser.add_argument('--mirror', type=str, dest='mirror_dir_path', default=None,
+                        help='Work offline and resolve the files relative to CD_INPUT_FILES_URL '
+                             'against this local mirror directory.')
+    parser.add_argument('--jobs', type=int, dest='max_workers', default=8,
+                        help='Maximum number of concurrent downloads.')
+    parser.add_argument('--docking-jobs', type=int, dest='n_docking_workers', default=None,
+                        help='Number of processes docking the ligands in parallel '
+                             '(default is the number of CPUs).')
+    parser.add_argument('--trace', type=str, dest='trace_file_path', default=None,
+                        help='Append the timing and memory usage of each stage to this JSONL file '
+                             '(see instrumentation.py).')
+    parser.add_argument('--docking-backend', choices=sorted(DOCKING_BACKENDS), default='fred',
+                        help='The docking backend (default is fred). The grid backend does not '
+                             'require OpenEye but it is meant only to test the pipeline.')
+    args = parser.parse_args()
+
+    if args.trace_file_path is not None:
+        instrumentation.enable_tracing(args.trace_file_path)
+    downloader = Downloader(base_url=CD_INPUT_FILES_URL, cache_dir_path=DOWNLOAD_CACHE_DIR_PATH,
+                            mirror_dir_path=args.mirror_dir_path, max_workers=args.max_workers)
+    prepare_cyclodextrin_files(downloader=downloader)
+    prepare_t4lysozyme_files(n_docking_workers=args.n_docking_workers,
+                             docking_backend=args.docking_backend)
@@ -1,4 +1,6 @@
-import math
+import numpy as np
+
+from neighbors import pairs_within
 
 """
 Rename MCCE output PDB residue names for compatibility with AMBER leap.
@@ -23,6 +25,168 @@ TO DO:
 """
 
 
+class ColumnarPDB(object):
+    """Columnar representation of a list of fixed-width PDB lines.
+
+    The lines are stored in a NumPy matrix of characters so that each fixed-width field (e.g. the residue names in
+    columns 17-19) can be read and modified for all atoms at once with vectorized masks. The text of the PDB lines is
+    regenerated only once by to_lines().
+
+    Residues are identified once on construction following the same rules of nest_pdb: residue i spans the atoms
+    residue_starts[i]:residue_starts[i+1].
+
+    ARGUMENTS
+        pdbarr - list of lines from PDB file (in MCCE output, the last character of each line is the charge state label)
+    """
+
+    def __init__(self, pdbarr):
+        self.natoms = len(pdbarr)
+        self.linelengths = np.array([len(line) for line in pdbarr], dtype=int)
+        width = max(self.linelengths.max(initial=0), 1)
+        self._chars = np.array(pdbarr, dtype='U%d' % width).view('U1').reshape(self.natoms, width)
+        self._coords = None
+        self._atomindex = None
+
+        self.residue_starts = self._find_residue_starts()
+        self.residue_index = np.zeros(self.natoms, dtype=int)
+        self.residue_index[self.residue_starts[1:]] = 1
+        self.residue_index = np.cumsum(self.residue_index)
+
+    @property
+    def nresidues(self):
+        return len(self.residue_starts)
+
+    def column(self, start, stop):
+        """Return a copy of the characters start:stop of all lines as an array of strings."""
+        return np.ascontiguousarray(self._chars[:,start:stop]).view('U%d' % (stop-start)).ravel()
+
+    def set_column(self, start, stop, values):
+        """Overwrite the characters start:stop of all lines.
+
+        ARGUMENTS
+            values - array of strings, each exactly stop-start characters long
+        """
+        width = stop - start
+        values = np.ascontiguousarray(values, dtype='U%d' % width)
+        if np.any(np.char.str_len(values) != width):
+            raise ValueError("Values must be %d characters long" % width)
+        self._chars[:,start:stop] = values.view('U1').reshape(self.natoms, width)
+
+    @property
+    def atomnames(self):
+        return self.column(12,16)
+
+    @property
+    def resnames(self):
+        return self.column(17,20)
+
+    @property
+    def labels(self):
+        """The last character of each line (the charge state label in MCCE output)."""
+        return self._chars[np.arange(self.natoms), self.linelengths-1]
+
+    @property
+    def coords(self):
+        """Array of shape (natoms, 3) with the atom coordinates, parsed only once."""
+        if self._coords is None:
+            self._coords = self.atom_coords(np.arange(self.natoms))
+        return self._coords
+
+    def atom_coords(self, indices):
+        """Return the array of shape (len(indices), 3) with the coordinates of the given atoms."""
+        if self._coords is not None:
+            return self._coords[indices]
+        chars = self._chars[indices,30:54]
+        return np.ascontiguousarray(chars).view('U8').reshape(-1, 3).astype(float)
+
+    def find_atoms(self, atomname, residues):
+        """Find the first atom with the given name in each of the given residues.
+
+        The atoms are indexed by name and residue on the first call so that each query is a binary search.
+
+        ARGUMENTS
+            atomname - the name of the atom (leading and trailing whitespace is ignored)
+            residues - array of residue indices
+
+        RETURNS
+            indices - array of atom indices, as long as residues, with -1 for the residues where the atom is missing
+        """
+        if self._atomindex is None:
+            uniquenames, namecodes = np.unique(np.char.strip(self.atomnames), return_inverse=True)
+            keys = namecodes.ravel() * self.nresidues + self.residue_index
+            order = np.argsort(keys, kind='stable')
+            self._atomindex = (uniquenames, keys[order], order)
+        uniquenames, sortedkeys, order = self._atomindex
+
+        residues = np.asarray(residues, dtype=int)
+        indices = np.full(len(residues), -1, dtype=int)
+        namecode = np.searchsorted(uniquenames, atomname.strip())
+        if namecode == len(uniquenames) or uniquenames[namecode] != atomname.strip():
+            return indices
+        keys = namecode * self.nresidues + residues
+        positions = np.minimum(np.searchsorted(sortedkeys, keys), len(sortedkeys)-1)
+        found = sortedkeys[positions] == keys
+        indices[found] = order[positions[found]]
+        return indices
+
+    def residue_values(self, values, first=True):
+        """Select the value of each residue from a per-atom array, taking the first (or last) atom of the residue."""
+        if first:
+            return values[self.residue_starts]
+        return values[np.append(self.residue_starts[1:], self.natoms) - 1]
+
+    def residue_mask(self, residues):
+        """Return the boolean mask of the atoms in the given residues (boolean mask or indices over the residues)."""
+        selected = np.zeros(self.nresidues, dtype=bool)
+        selected[residues] = True
+        return selected[self.residue_index]
+
+    def to_lines(self):
+        """Return the list of PDB lines."""
+        return self._chars.view('U%d' % self._chars.shape[1]).ravel().tolist()
+
+    def _find_residue_starts(self):
+        """Find the index of the first atom of each residue (see nest_pdb)."""
+        if self.natoms == 0:
+            return np.zeros(0, dtype=int)
+
+        # A residue starts where columns 17-26 (residue name, chain, and number) change.
+        residuekeys = self.column(17,27)
+        isfirst = np.ones(self.natoms, dtype=bool)
+        isfirst[1:] = residuekeys[1:] != residuekeys[:-1]
+        starts = np.flatnonzero(isfirst)
+
+        #DLM 7/1/2009: Two consecutive residues with the same name may have the same key (mcce removes insertion
+        #codes), so a second copy of an atom in the same key starts a new residue EXCEPT for N-terminal residues.
+        # Only keys with repeated atom names need to be scanned atom by atom. As in the original implementation,
+        # the atom in the first line of the file is not recorded as used.
+        atoms = np.char.strip(self.column(12,17))
+        atomcodes = np.unique(atoms, return_inverse=True)[1].ravel()
+        keyindex = np.cumsum(isfirst) - 1
+        pairs = keyindex[1:] * (atomcodes.max()+1) + atomcodes[1:]
+        pairs, counts = np.unique(pairs, return_counts=True)
+        duplicatedkeys = np.unique(pairs[counts > 1] // (atomcodes.max()+1))
+        if len(duplicatedkeys) == 0:
+            return starts
+
+        ends = np.append(starts[1:], self.natoms)
+        resnames = self.resnames
+        newstarts = []
+        for key in duplicatedkeys:
+            usedatoms = set()
+            for i in range(starts[key], ends[key]):
+                if i == 0:
+                    continue
+                elif atoms[i] not in usedatoms:
+                    usedatoms.add(atoms[i])
+                #DLM 8/19/2009: N-terminal residues may have two of the same atom names due to capping.
+                elif not resnames[i] == 'NTR' and not resnames[i][0] == 'N':
+                    print("Starting new residue for:", ''.join(self._chars[i]))
+                    newstarts.append(i)
+                    usedatoms = set([atoms[i]])
+        return np.sort(np.concatenate([starts, np.array(newstarts, dtype=int)]))
+
+
 def rename_residues(pdbarr, renameTermini=True):
     """Convert residue names (and some hydrogen names) to AMBER format.
     
@@ -37,24 +201,21 @@ def rename_residues(pdbarr, renameTermini=True):
     # DEBUG check.
     print("At start of renaming, pdbarr has", len(pdbarr), "items")
      
-    # Transform the PDB file into a nested format that is easier to manipulate.
-    npdb = nest_pdb(pdbarr)
-    
-    # DEBUG check.
-    print("Nest/unnest leads to", len(unnest_pdb(npdb)), "items")
+    # Transform the PDB file into a columnar format that is easier to manipulate.
+    pdb = ColumnarPDB(pdbarr)
 
     # Convert residue and atom names to be appropriate for AMBER.
-    npdb = rename_standard_hydrogens(npdb)
-    npdb = rename_charged(npdb)
-    npdb = histidine_search(npdb)
-    npdb = disulfide_search(npdb)
+    pdb = rename_standard_hydrogens(pdb)
+    pdb = rename_charged(pdb)
+    pdb = histidine_search(pdb)
+    pdb = disulfide_search(pdb)
     
     print('### renameTermini =', renameTermini)
     if (renameTermini):
-        npdb = rename_termini(npdb)
+        pdb = rename_termini(pdb)
 
-    # Un-nest PDB
-    pdbarr = unnest_pdb(npdb)
+    # Write back the PDB lines.
+    pdbarr = pdb.to_lines()
     
     # DEBUG check.
     #print "At end of renaming, pdbarr has ", len(pdbarr), "items"
@@ -63,11 +224,11 @@ def rename_residues(pdbarr, renameTermini=True):
     return pdbarr
 
 
-def rename_standard_hydrogens(npdb):
+def rename_standard_hydrogens(pdb):
     """Fix the atom naming of standard hydrogens.
 
     ARGUMENTS
-        npdb - "nested" PDB data structure generated by nest_pdb.
+        pdb - ColumnarPDB; modified to reflect AMBER names.
 
     """
     # Special conversions for the 3 hydrogens of the N-terminus.
@@ -88,61 +249,59 @@ def rename_standard_hydrogens(npdb):
         ('1HG1', '3HG1'): frozenset(['ILE'])
     }
 
-    for i, pdb_residue in enumerate(npdb):
-        resname = pdb_residue[-1][17:20]
-        conversions = [conversion for conversion, resnames in conversions_by_atom.items()
-                       if resname in resnames]
+    atomnames = pdb.atomnames
+    resnames = pdb.resnames
+    # The renamed atoms are followed by a blank alternate location indicator.
+    blankaltloc = pdb.column(16,17) == ' '
 
-        # Handle N-termini.
-        if i == 0:
-            conversions.extend(conversions_n_terminus)
+    for (original_atom_name, replaced_atom_name), conversion_resnames in conversions_by_atom.items():
+        mask = blankaltloc & (atomnames == original_atom_name) & np.isin(resnames, list(conversion_resnames))
+        atomnames[mask] = replaced_atom_name
 
-        # Perform conversions
-        for original_atom_name, replaced_atom_name in conversions:
-            assert len(original_atom_name) == 4 and len(replaced_atom_name) == 4
-            original_str = '{} {}'.format(original_atom_name, resname)
-            replaced_str = '{} {}'.format(replaced_atom_name, resname)
-            npdb[i] = list(map(lambda x: x.replace(original_str, replaced_str), npdb[i]))
+    # Handle N-termini.
+    nterminus = blankaltloc & (pdb.residue_index == 0)
+    for original_atom_name, replaced_atom_name in conversions_n_terminus:
+        atomnames[nterminus & (atomnames == original_atom_name)] = replaced_atom_name
 
-    return npdb
+    pdb.set_column(12, 16, atomnames)
+    return pdb
 
 
-def rename_charged(npdb):
+def rename_charged(pdb):
     """Generate AMBER-specific residue names for charged residues from MCCE residue names. Also fix some problems with atom naming (specifically hydrogens) for charged residues.
         
     ARGUMENTS
-        npdb - "nested" PDB data structure generated by nest_pdb. Modified to reflect AMBER names.
+        pdb - ColumnarPDB; modified to reflect AMBER names.
 
     CHANGE LOG:
     - DLM 7-1-2009: Modified to fix naming of HE1 in GLH to HE2 to conform to ffamber rtp.
     """
-        
-    resname_and_state = list(map(lambda x:x[-1][17:20]+x[-1][-1],npdb))
 
-    for i in range(len(npdb)):
-        if (resname_and_state[i]=='LYS0'):
-            npdb[i] = list(map(lambda x: x.replace('LYS','LYN'), npdb[i]))
-        elif (resname_and_state[i]=='LYS+'):
-            npdb[i] = list(map(lambda x: x.replace('LYS','LYS'), npdb[i]))
-        elif (resname_and_state[i]=='CYS0'):
-            npdb[i] = list(map(lambda x: x.replace('CYS','CYS'), npdb[i]))
-        elif (resname_and_state[i]=='CYS-'):
-            npdb[i] = list(map(lambda x: x.replace('CYS','CYM'), npdb[i]))
-        elif (resname_and_state[i]=='ASP0'):
-            npdb[i] = list(map(lambda x: x.replace('ASP','ASH'), npdb[i]))
-        elif (resname_and_state[i]=='GLU0'):
-            npdb[i] = list(map(lambda x: x.replace('GLU','GLH'), npdb[i]))
+    # The charge state of each residue is the label of its last atom.
+    resnames = pdb.resnames
+    resname_and_state = pdb.residue_values(np.char.add(resnames, pdb.labels), first=False)
 
-        # Also, charge states for TYR are ignored....
+    conversions = {
+        'LYS0': 'LYN',
+        'CYS-': 'CYM',
+        'ASP0': 'ASH',
+        'GLU0': 'GLH',
+    }
+    for state, replaced_resname in conversions.items():
+        mask = pdb.residue_mask(resname_and_state == state) & (resnames == state[:3])
+        resnames[mask] = replaced_resname
+
+    # Also, charge states for TYR are ignored....
 
-    return npdb
+    pdb.set_column(17, 20, resnames)
+    return pdb
 
 
-def rename_termini(npdb):
+def rename_termini(pdb):
     """Renames the 'NTR' and 'CTR' residues generated by MCCE.
 
     ARGUMENTS
-        npdb - 
+        pdb - ColumnarPDB
 
     """
 
@@ -153,45 +312,36 @@ def rename_termini(npdb):
     # demarcate the N- and C- terminal parts of the terminal residues
 
     # First find *all* instances of termini
-    NTerminiRes = []
-    CTerminiRes = []
-    for i in range(0,len(npdb)):
-        if (npdb[i][0][17:20] == 'NTR') | (npdb[i][0][17:20] == 'NTG'):
-            NTerminiRes.append(i)
-        if npdb[i][0][17:20] == 'CTR':
-            CTerminiRes.append(i)
-            
-    print('### NTerminiRes:', NTerminiRes)
-    print('### CTerminiRes:', CTerminiRes)
+    resnames = pdb.resnames
+    firstresnames = pdb.residue_values(resnames)
+    NTerminiRes = np.flatnonzero((firstresnames == 'NTR') | (firstresnames == 'NTG'))
+    CTerminiRes = np.flatnonzero(firstresnames == 'CTR')
+
+    print('### NTerminiRes:', NTerminiRes.tolist())
+    print('### CTerminiRes:', CTerminiRes.tolist())
             
     # check to see if there are equal numbers of termini residues found
     if len(NTerminiRes) != len(CTerminiRes):
         raise RuntimeError("len(NTerminiRes) != len(CTerminiRes)")
 
     # Do renamimng for all pairs of termini found
-    for k in range(0,len(CTerminiRes)):
-        
-        NResIndex = NTerminiRes[k]
-        CResIndex = CTerminiRes[k]
+    for NResIndex, CResIndex in zip(NTerminiRes, CTerminiRes):
 
         # Get three-letter residue names of N- and C-termini.
-        ntrname = npdb[NResIndex+1][0][17:20]
-        ctrname = npdb[CResIndex-1][0][17:20]
+        ntrname = resnames[pdb.residue_starts[NResIndex+1]]
+        ctrname = resnames[pdb.residue_starts[CResIndex-1]]
         
         print('### renaming NTR to', ntrname)
         print('### renaming CTR to', ctrname)
     
         # Rename NTR to its residue name.
-        for j in [NResIndex, NResIndex+1]:
-          for i in range(len(npdb[j])):
-            npdb[j][i] = npdb[j][i][0:17] + ntrname + npdb[j][i][20:]
+        resnames[pdb.residue_mask([NResIndex, NResIndex+1])] = ntrname
 
         # Rename CTR to its residue name.
-        for j in [CResIndex-1, CResIndex]:
-            for i in range(len(npdb[j])):
-                npdb[j][i] = npdb[j][i][0:17] + ctrname + npdb[j][i][20:]
+        resnames[pdb.residue_mask([CResIndex-1, CResIndex])] = ctrname
 
-    return npdb
+    pdb.set_column(17, 20, resnames)
+    return pdb
 
 
 def nest_pdb(pdbarr):
@@ -203,39 +353,11 @@ def nest_pdb(pdbarr):
     RETURNS
         nestedpdb - nested PDB file, such that nestedpdb[i][j] will be line j from residue i.
     """
-    
-    nestedpdb=[]
-    residue=[]
-    usedatoms = [] #DLM edit 7/1/2009
-    for line in pdbarr:
-        atom = line[12:17].strip() #DLM edit 7/1/2009
-        if (len(residue) == 0):
-            residue.append(line)
-        else:
-            #DLM 7/1/2009: The following should be OK even for residues with insertion codes (mcce removes the insertion code) EXCEPT if the two residues in sequence have the same residue name (in which case they will be packed into the same residue here). To fix this, store a list of atoms that are already found for the present residue and start a new residue anytime a second copy of an atom is found. See noted edits.
-            #DLM 8/19/2009: This breaks cases of N-terminal residues, which may have two of the same atom names due to capping. Fix by only starting a new residue if the residue name is NOT NTR (which it will be if this is N-terminal) 
-            if (line[17:27] == residue[-1][17:27]):
-                #DLM 7/1/2009:
-                if usedatoms.count(atom)==0:
-                    usedatoms.append(atom)
-                    residue.append(line) #Original line
-                else: 
-                    if not line[17:20]=='NTR' and not line[17]=='N':
-                        #If we are finding a second copy of the atom it means we need to start a new residue EXCEPT if it is N-terminal
-                        print("Starting new residue for:", line)
-                        nestedpdb.append(residue)
-                        residue=[line]
-                        usedatoms=[atom]
-                    else: #If it IS n-terminal, just save like before
-                        residue.append(line)
-                    
-                #End DLM
-            else:
-                nestedpdb.append(residue)
-                residue=[line]
-                usedatoms=[atom]
-    nestedpdb.append(residue)
-    
+
+    #DLM 7/1/2009: The residue boundaries are OK even for residues with insertion codes (mcce removes the insertion code) EXCEPT if the two residues in sequence have the same residue name; see ColumnarPDB.
+    residue_starts = ColumnarPDB(pdbarr).residue_starts.tolist()
+    nestedpdb = [pdbarr[start:end] for start, end in zip(residue_starts, residue_starts[1:] + [len(pdbarr)])]
+
     # Return the nexted PDB file.
     return nestedpdb
 
@@ -257,32 +379,27 @@ def unnest_pdb(npdb):
     return pdbarr
     
 
-def get_coords(atomname,residue):
-    """Extract coordinates from given atom in list of PDB lines (such as all those lines for a residue in a nested PDB file).
-    
+def get_atom_indices(pdb, atomname, residues):
+    """Find the index of the first atom with the given name in each of the given residues.
+
     ARGUMENTS
+        pdb - ColumnarPDB
         atomname - the name of the atom
-        residue - list of lines from PDB file
+        residues - array of residue indices
 
     RETURNS
-        (x,y,z) - tuple of atom coordinates, as floats
-    
+        indices - array of atom indices, as long as residues
     """
-    for n in range(len(residue)):
-        if (residue[n][12:16].strip() == atomname.strip()):
-            iX=float(residue[n][30:38])
-            iY=float(residue[n][38:46])
-            iZ=float(residue[n][46:54])
-            return (iX,iY,iZ)
+    indices = pdb.find_atoms(atomname, residues)
+    if np.any(indices < 0):
+        raise RuntimeError("Atom not found!")
+    return indices
 
-    raise "Atom not found!"        
-
-
-def disulfide_search(npdb, min_dist = 1.8, max_dist = 2.2):
+def disulfide_search(pdb, min_dist = 1.8, max_dist = 2.2):
     """Rename CYS to CYX if it participates in a disulfide bond, as judged by distance range (inclusive). DLM modification: Also check for CYD, which is what MCCE names disulfides; we want to use the same checking criteria for those.
     
     ARGUMENTS
-        npdb - nested PDB file
+        pdb - ColumnarPDB
         
     OPTIONAL ARGUMENTS
         min_dist - minium distance cutoff for perceiving disulfide bond (default 1.8 A)
@@ -291,78 +408,46 @@ def disulfide_search(npdb, min_dist = 1.8, max_dist = 2.2):
     TO DO:
         Sometimes MCCE erroneously identifies a disulfide bond and renames the residues as CYD; these should be changed back in such cases.
     """
-        
-    residues_to_rename=set([])
-    for i in range(len(npdb)):
-        if (npdb[i][0][17:20] != 'CYS' and npdb[i][0][17:20] != 'CYD'):
-            continue
-        # Found a cysteine, now track down the sulfur
-        iX,iY,iZ=get_coords('SG',npdb[i])
-                
-        for j in range(i+1,len(npdb)):
-            if (npdb[j][0][17:20]!= 'CYS' and npdb[j][0][17:20] != 'CYD'):
-                continue
-            (jX,jY,jZ) = get_coords('SG',npdb[j])
-                
-            dX=iX-jX
-            dY=iY-jY
-            dZ=iZ-jZ
-
-            distance = math.sqrt(dX*dX+dY*dY+dZ*dZ)
-            if (distance >= min_dist and distance <= max_dist):
-                residues_to_rename = residues_to_rename | set([i,j])
+
+    resnames = pdb.resnames
+    firstresnames = pdb.residue_values(resnames)
+    cysteines = np.flatnonzero((firstresnames == 'CYS') | (firstresnames == 'CYD'))
+
+    # Found the cysteines, now track down the sulfurs
+    sulfurs = pdb.atom_coords(get_atom_indices(pdb, 'SG', cysteines))
+    bonded = pairs_within(sulfurs, max_dist, min_dist=min_dist)
+    residues_to_rename = cysteines[np.unique(bonded)]
         
     # Rename the residues we selected
-    for i in residues_to_rename:
-        npdb[i] = list(map(lambda x:x.replace('CYS ','CYX'),npdb[i]))
-        npdb[i] = list(map(lambda x:x.replace('CYD ','CYX'),npdb[i]))
+    mask = pdb.residue_mask(residues_to_rename) & ((resnames == 'CYS') | (resnames == 'CYD'))
+    resnames[mask] = 'CYX'
+    pdb.set_column(17, 20, resnames)
         
-    return npdb
+    return pdb
 
 
-def atom_is_present(pdblines, atomname):
-    """Returns TRUE if the given atom is present in the given PDB atom lines.
+def histidine_search(pdb):
+    """Rename HIS residues to HID, HIE, or HIP by examining which protons are present.
     
     ARGUMENTS
-        pdblines - list of PDB lines
-        atomname - the name of the atom to check the existence of
-
-    RETURNS
-        is_present - True if the given atom name is present, False otherwise
-
+        pdb - ColumnarPDB
     """
 
-    is_present = False
-    for pdbline in pdblines:
-        if (pdbline[13:16] == atomname):
-            is_present = True
+    resnames = pdb.resnames
+    histidines = np.flatnonzero(pdb.residue_values(resnames) == 'HIS')
+    HE_present = pdb.find_atoms('HE2', histidines) >= 0 # bonded to NE2
+    HD_present = pdb.find_atoms('HD1', histidines) >= 0 # bonded to ND1
 
-    return is_present
+    if np.any(~HD_present & ~HE_present):
+        raise RuntimeError("No protons found for histidine.")
 
+    ishistidine = resnames == 'HIS'
+    resnames[ishistidine & pdb.residue_mask(histidines[HD_present & HE_present])] = 'HIP'
+    resnames[ishistidine & pdb.residue_mask(histidines[HE_present & ~HD_present])] = 'HIE'
+    resnames[ishistidine & pdb.residue_mask(histidines[HD_present & ~HE_present])] = 'HID'
+    pdb.set_column(17, 20, resnames)
 
-def histidine_search(npdb):
-    """Rename HIS residues to HID, HIE, or HIP by examining which protons are present.
-    
-    ARGUMENTS
-        npdb - nested  PDB
-    """
-    
-    for i in range(len(npdb)):
-        resname = npdb[i][0][17:20]
-        if (resname == 'HIS'):
-            HE_present = atom_is_present(npdb[i], 'HE2') # bonded to NE2
-            HD_present = atom_is_present(npdb[i], 'HD1') # bonded to ND1
-            
-            if (HD_present and HE_present):
-                npdb[i] = list(map(lambda x:x.replace('HIS','HIP'),npdb[i]))
-            elif (HE_present):
-                npdb[i] = list(map(lambda x:x.replace('HIS','HIE'),npdb[i]))
-            elif (HD_present):
-                npdb[i] = list(map(lambda x:x.replace('HIS','HID'),npdb[i]))
-            else:
-                raise "No protons found for histidine."
-
-    return npdb
+    return pdb
 
 
 def pdb_cleanup(pdbarr):
@@ -374,31 +459,27 @@ def pdb_cleanup(pdbarr):
     RETURNS
         updated_pdbarr - updated list of PDB lines
     """
-    # Nuke everything after the coordinates
-    # Use a default occupancy of 1 and a default B-factor of 0
-    for i in range(len(pdbarr)):
-        atom=pdbarr[i][0:54]
-        # The atom symbol will be the first character after stripping
-        # whitespace and numbers
-        # NOTE: this will fail for atoms with more than one letter in their symbol
-        #            eg, counterions
-        atomsymbol = atom[12:16].strip(" 0123456789")[0]
-        atom = atom + "1.00".rjust(6) + "0.00".rjust(6) + " "*10 + atomsymbol.rjust(2)+ " "*2
-        pdbarr[i]=atom
-
-    npdb=nest_pdb(pdbarr)
-
-    for i in range(len(npdb)):
-        # Set the residue index numbers
-        # NOTE: We set chain identifier to blank, so this won't work for multi-chain PDBs
-        for j in range(len(npdb[i])):
-            atom = npdb[i][j]
-            atom = atom[:21]+ " " + str(i+1).rjust(4)+ " "*4 + atom[30:]
-            #print len(atom)
-            npdb[i][j] = atom
-            
-    updated_pdbarr = unnest_pdb(npdb)
-        
-    return updated_pdbarr
+    pdb = ColumnarPDB(pdbarr)
+
+    # The atom symbol will be the first character after stripping
+    # whitespace and numbers
+    # NOTE: this will fail for atoms with more than one letter in their symbol
+    #            eg, counterions
+    atomsymbols = np.char.strip(pdb.atomnames, " 0123456789").astype('U1')
 
+    # Set the residue index numbers
+    # NOTE: We set chain identifier to blank, so this won't work for multi-chain PDBs
+    resids = np.char.rjust((pdb.residue_index + 1).astype('U'), 4)
 
+    # Nuke everything after the coordinates
+    # Use a default occupancy of 1 and a default B-factor of 0
+    suffix = "1.00".rjust(6) + "0.00".rjust(6) + " "*10
+    updated_pdbarr = np.char.add(pdb.column(0,21), " ")
+    updated_pdbarr = np.char.add(updated_pdbarr, resids)
+    updated_pdbarr = np.char.add(updated_pdbarr, " "*4)
+    updated_pdbarr = np.char.add(updated_pdbarr, pdb.column(30,54))
+    updated_pdbarr = np.char.add(updated_pdbarr, suffix)
+    updated_pdbarr = np.char.add(updated_pdbarr, np.char.rjust(atomsymbols, 2))
+    updated_pdbarr = np.char.add(updated_pdbarr, " "*2)
+
+    return updated_pdbarr.tolist()
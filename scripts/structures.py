@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# =============================================================================
+# MODULE DOCSTRING
+# =============================================================================
+
+"""Memoized download and preparation of crystal structures.
+
+The ``StructureCache`` downloads each crystal structure and runs it
+through PDBFixer only once. The results are stored on disk, keyed by
+the PDB code and the PDBFixer options, and the parsed structures are
+kept in an in-memory LRU cache so that the pH-dependent steps of the
+preparation can reuse them without downloading or parsing them again.
+
+"""
+
+
+# =============================================================================
+# GLOBAL IMPORTS
+# =============================================================================
+
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import mdtraj
+from pdbfixer import PDBFixer
+from simtk.openmm.app import PDBFile
+
+from pipeline import hash_parameters
+
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+
+RCSB_URL = 'http://files.rcsb.org/view/'
+
+
+# =============================================================================
+# UTILITY FUNCTIONS
+# =============================================================================
+
+def pdbfix_protein(input_pdb_path, output_pdb_path, find_missing_residues=True,
+                   keep_water=False, ph=None):
+    """Run PDBFixer on the input PDB file.
+
+    Heterogen atoms are always removed.
+
+    Parameters
+    ----------
+    input_pdb_path : str
+        The PDB to fix.
+    output_pdb_path : str
+        The path to the output PDB file.
+    find_missing_residues : bool, optional
+        If True, PDBFixer will try to model the unresolved residues
+        that appear in the amino acid sequence (default is True).
+    keep_water : bool, optional
+        If True, water molecules are not stripped (default is False).
+    ph : float or None, optional
+        If not None, hydrogen atoms will be added at this pH.
+
+    """
+    fixer = PDBFixer(filename=input_pdb_path)
+    if find_missing_residues:
+        fixer.findMissingResidues()
+    else:
+        fixer.missingResidues = {}
+    fixer.findNonstandardResidues()
+    fixer.replaceNonstandardResidues()
+    fixer.removeHeterogens(keep_water)
+    fixer.findMissingAtoms()
+    fixer.addMissingAtoms()
+    if ph is not None:
+        fixer.addMissingHydrogens(ph)
+
+    # print(fixer.nonstandardResidues)
+    # print(fixer.missingAtoms)
+    # print(fixer.missingTerminals)
+
+    with open(output_pdb_path, 'w') as f:
+        PDBFile.writeFile(fixer.topology, fixer.positions, f)
+
+
+# =============================================================================
+# STRUCTURE CACHE
+# =============================================================================
+
+class StructureCache(object):
+    """In-memory and on-disk cache of downloaded and fixed structures.
+
+    Parameters
+    ----------
+    cache_dir_path : str
+        The directory where the PDB files are stored.
+    max_cached_structures : int, optional
+        The maximum number of parsed structures kept in memory. The least
+        recently used structures are discarded first (default is 8).
+
+    """
+
+    def __init__(self, cache_dir_path, max_cached_structures=8):
+        self.cache_dir_path = cache_dir_path
+        self.max_cached_structures = max_cached_structures
+        self._memory_cache = OrderedDict()
+        os.makedirs(cache_dir_path, exist_ok=True)
+
+    def get_crystal_pdb_path(self, pdb_code):
+        """Return the path to the crystal structure, downloading it if necessary.
+
+        Parameters
+        ----------
+        pdb_code : str
+            The RCSB code of the structure.
+
+        Returns
+        -------
+        pdb_file_path : str
+            The path to the cached PDB file.
+
+        """
+        pdb_file_path = os.path.join(self.cache_dir_path, pdb_code + '.pdb')
+        if not os.path.exists(pdb_file_path):
+            pdb_traj = mdtraj.load_pdb(RCSB_URL + pdb_code + '.pdb')
+            self._memoize(('crystal', pdb_code), pdb_traj)
+            self._atomic_write(pdb_file_path, pdb_traj.save)
+        return pdb_file_path
+
+    def get_trajectory(self, pdb_code):
+        """Return the parsed crystal structure.
+
+        Parameters
+        ----------
+        pdb_code : str
+            The RCSB code of the structure.
+
+        Returns
+        -------
+        pdb_traj : mdtraj.Trajectory
+            The crystal structure, including ligands and waters.
+
+        """
+        key = ('crystal', pdb_code)
+        try:
+            return self._recall(key)
+        except KeyError:
+            pdb_traj = mdtraj.load_pdb(self.get_crystal_pdb_path(pdb_code))
+            self._memoize(key, pdb_traj)
+            return pdb_traj
+
+    def get_fixed_pdb_path(self, pdb_code, **fixer_options):
+        """Return the path to the PDBFixed structure, fixing it if necessary.
+
+        Parameters
+        ----------
+        pdb_code : str
+            The RCSB code of the structure.
+        **fixer_options
+            Keyword arguments for pdbfix_protein().
+
+        Returns
+        -------
+        pdb_file_path : str
+            The path to the cached PDB file of the fixed structure.
+
+        """
+        options_hash = hash_parameters(fixer_options)
+        pdb_file_path = os.path.join(self.cache_dir_path, '{}.pdbfixer.{}.pdb'.format(
+            pdb_code, options_hash[:16]))
+        if not os.path.exists(pdb_file_path):
+            crystal_pdb_path = self.get_crystal_pdb_path(pdb_code)
+            self._atomic_write(pdb_file_path, lambda tmp_file_path: pdbfix_protein(
+                crystal_pdb_path, tmp_file_path, **fixer_options))
+        return pdb_file_path
+
+    def _recall(self, key):
+        """Return a memoized structure and mark it as recently used."""
+        structure = self._memory_cache.pop(key)
+        self._memory_cache[key] = structure
+        return structure
+
+    def _memoize(self, key, structure):
+        """Store a structure in memory evicting the least recently used."""
+        self._memory_cache.pop(key, None)
+        self._memory_cache[key] = structure
+        while len(self._memory_cache) > self.max_cached_structures:
+            self._memory_cache.popitem(last=False)
+
+    def _atomic_write(self, file_path, writer):
+        """Call writer(tmp_file_path) and move the result to file_path."""
+        fd, tmp_file_path = tempfile.mkstemp(suffix='.pdb', dir=self.cache_dir_path)
+        os.close(fd)
+        try:
+            writer(tmp_file_path)
+            shutil.move(tmp_file_path, file_path)
+        except Exception:
+            os.remove(tmp_file_path)
+            raise